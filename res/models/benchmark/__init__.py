@@ -0,0 +1,10 @@
+"""
+Bachelor Thesis
+Nils Harbke
+> Optimized Out-of-Core Rendering for Interactive
+> Presentation of Large Point Clouds
+HAW Hamburg
+
+Benchmarks of the preprocessing scripts, run from res/models with
+python -m benchmark.<name>
+"""
@@ -0,0 +1,284 @@
+# bin/include/python3.7
+
+"""
+Bachelor Thesis
+Nils Harbke
+> Optimized Out-of-Core Rendering for Interactive
+> Presentation of Large Point Clouds
+HAW Hamburg
+
+Runs the preprocessing stages (point sorting and tree building) on
+synthetic point clouds under fixed memory caps. Every stage runs in its
+own process, whose process tree is sampled for the resident memory. The
+points per second, peak RSS, temp bytes written and wall time of every
+stage are appended to a JSON history file and compared with the last run
+of the same configuration, so performance regressions show up.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import psutil
+import socket
+import argparse
+import platform
+import tempfile
+import subprocess
+import numpy as np
+
+MODELS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, MODELS_DIR)
+from fileformat import open_list, read_tree_header
+from benchmark.point_cloud import DISTRIBUTIONS, FORMATS, write_ply
+
+SORT  = 'sort'
+BUILD = 'build'
+STAGES = [ SORT, BUILD ]
+
+# name of the history file in the workdir, unless another path is given
+HISTORY_NAME = "history.json"
+
+# seconds between two samples of a running stage
+POLL_S = 0.05
+
+# slowdown of the points per second reported as a regression
+TOLERANCE = 0.1
+
+GB_IN_B = 1000000000
+MB_IN_B = 1000000
+
+
+def run_stage(command, workdir, log_path):
+	""" Run the command of a stage in workdir until it exits. Returns the
+	wall time, the peak resident memory of the stage and its workers and
+	the bytes written by write calls. The exited stage is only reaped
+	after its I/O counters are read, which then include the workers it
+	has reaped. Memory mapped writes aren't counted. """
+
+	with open(log_path,'wb') as log_file:
+		time_start = time.time()
+		stage = psutil.Popen(command, cwd=workdir, stdout=log_file,
+			stderr=subprocess.STDOUT)
+		peak_rss = 0
+		while True:
+			rss = 0
+			for process in [ stage ]+stage.children(recursive=True):
+				try:
+					rss += process.memory_info().rss
+				except psutil.NoSuchProcess:
+					pass
+			peak_rss = max(peak_rss, rss)
+			# wait for the exit without reaping the stage
+			if os.waitid(os.P_PID, stage.pid, os.WEXITED | os.WNOHANG
+				| os.WNOWAIT) is not None:
+				break
+			time.sleep(POLL_S)
+		seconds = time.time() - time_start
+		written = stage.io_counters().write_chars
+		if stage.wait() != 0:
+			with open(log_path,'rb') as log_file:
+				tail = log_file.read().decode(errors='replace')[-2000:]
+			raise RuntimeError("%s failed:\n%s"%(' '.join(command),tail))
+	return { 'seconds':seconds, 'peak_rss':peak_rss, 'written':written }
+
+
+def file_sizes(workdir):
+	# sizes of the files directly in workdir
+	return { name:os.path.getsize(os.path.join(workdir,name))
+		for name in os.listdir(workdir)
+		if os.path.isfile(os.path.join(workdir,name)) }
+
+
+def run_benchmark(nelems, fmt, distribution, memcap, workers, bucket,
+	stages, workdir, scratch_dirs=None, seed=0, verify=False, tree_workers=1):
+	""" Generate a point cloud in workdir and run the stages on it.
+	Returns the metrics of every stage, with the metrics file written by
+	the script of the stage. Temp bytes are the bytes written by a stage
+	less its output files. """
+
+	ply_path = os.path.join(workdir, "cloud.ply")
+	write_ply(ply_path, nelems, fmt, distribution, seed)
+	if scratch_dirs is None:
+		scratch_dirs = [ os.path.join(workdir,"scratch") ]
+	for path in scratch_dirs:
+		os.makedirs(path, exist_ok=True)
+
+	commands = {
+		SORT : [ os.path.join(MODELS_DIR,"ooc_point_sorting.py"),
+			"-i", ply_path, "-m", str(memcap/GB_IN_B), "-w", str(workers),
+			"-s" ]+scratch_dirs,
+		BUILD : [ os.path.join(MODELS_DIR,"build_tree.py"),
+			"-d", ply_path[:-4]+"_DATA.bin", "-x", ply_path[:-4]+"_X.bin",
+			"-y", ply_path[:-4]+"_Y.bin", "-z", ply_path[:-4]+"_Z.bin",
+			"-b", str(bucket), "-m", str(memcap/GB_IN_B),
+			"--tree-workers", str(tree_workers), "-s" ]+scratch_dirs }
+
+	metrics = {}
+	for stage in STAGES:
+		if stage not in stages:
+			continue
+		before = file_sizes(workdir)
+		metrics_path = os.path.join(workdir,"%s.metrics"%stage)
+		result = run_stage([ sys.executable, "-O" ]+commands[stage]
+			+[ "--metrics", metrics_path ], workdir,
+			os.path.join(workdir,"%s.log"%stage))
+		outputs = sum(size for name, size in file_sizes(workdir).items()
+			if before.get(name) != size and not name.endswith((".log",".metrics")))
+		with open(metrics_path) as metrics_file:
+			steps = json.load(metrics_file)['stages']
+		metrics[stage] = {
+			'seconds'		: round(result['seconds'], 3),
+			'points_per_s'	: round(nelems/max(result['seconds'],1e-9), 1),
+			'peak_rss'		: result['peak_rss'],
+			'temp_bytes'	: max(result['written'] - outputs, 0),
+			# seconds and counters of the stages within the script
+			'steps'			: steps }
+		print("{:<6} {:>9.3f}s {:>14.0f} points/s {:>8} MB RSS {:>8} MB temp"
+			.format(stage,result['seconds'],metrics[stage]['points_per_s'],
+			result['peak_rss']//MB_IN_B,metrics[stage]['temp_bytes']//MB_IN_B))
+		if verify:
+			check_outputs(stage, ply_path, nelems, bucket)
+	return metrics
+
+
+def check_outputs(stage, ply_path, nelems, bucket):
+	""" Check the sorted lists of the sort stage against the point data,
+	or the header of the tree written by the build stage """
+
+	base = ply_path[:-4]
+	if stage == SORT:
+		data = np.fromfile(base+"_DATA.bin", dtype='<f4').reshape(-1,3)
+		for d, dim in enumerate("XYZ"):
+			order = np.asarray(open_list("%s_%s.bin"%(base,dim)))
+			if (len(order) != nelems or not np.array_equal(np.sort(order),
+				np.arange(nelems)) or np.any(np.diff(data[order,d]) < 0)):
+				raise AssertionError("index list of axis %s isn't sorted"%dim)
+	else:
+		with open(base+"_SPHERE_B%d.bin"%bucket,'rb') as tree:
+			count = read_tree_header(tree)[0]
+		if count != nelems:
+			raise AssertionError("tree holds %d of %d points"%(count,nelems))
+
+
+def load_history(path):
+	if not os.path.exists(path):
+		return []
+	with open(path) as history_file:
+		return json.load(history_file)
+
+
+def save_history(path, history):
+	# replace the history at once, so an interrupted run can't damage it
+	with open(path+'.tmp','w') as history_file:
+		json.dump(history, history_file, indent=1)
+	os.replace(path+'.tmp', path)
+
+
+def compare(history, entry, tolerance=TOLERANCE):
+	""" Print the change of every stage compared with the last run of the
+	same configuration. Returns the stages slower by more than tolerance. """
+
+	previous = [ run for run in history if run['config'] == entry['config'] ]
+	if not previous:
+		return []
+	regressions = []
+	for stage, metrics in entry['stages'].items():
+		if stage not in previous[-1]['stages']:
+			continue
+		before = previous[-1]['stages'][stage]['points_per_s']
+		change = metrics['points_per_s']/max(before,1e-9) - 1
+		print("{:<6} {:+6.1f}% points/s since {}".format(stage,change*100,
+			previous[-1]['time']))
+		if change < -tolerance:
+			regressions.append(stage)
+	return regressions
+
+
+def git_revision():
+	# commit of the benchmarked scripts, if they are in a git repository
+	try:
+		return subprocess.check_output([ "git", "rev-parse", "--short", "HEAD" ],
+			cwd=MODELS_DIR, stderr=subprocess.DEVNULL).decode().strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+
+if __name__ == '__main__':
+
+	parser = argparse.ArgumentParser(description = "[Pipeline Benchmark]\nRuns point sorting and tree building on synthetic point clouds and records their performance.")
+	parser.add_argument("-n","--nelems", type=float, nargs='+', default=[ 1e5 ],
+		help="numbers of points")
+	parser.add_argument("-f","--format", nargs='+', default=[ FORMATS[0] ],
+		choices=FORMATS,
+		help="PLY formats")
+	parser.add_argument("-d","--distribution", nargs='+',
+		default=[ DISTRIBUTIONS[0] ], choices=DISTRIBUTIONS,
+		help="distributions of the points")
+	parser.add_argument("-m","--memcap", type=float, nargs='+', default=[ 0.5 ],
+		help="memory caps of the stages in GB")
+	parser.add_argument("-w","--workers", type=int, default=3,
+		help="number of worker processes of the sort")
+	parser.add_argument("--tree-workers", type=int, default=1,
+		help="number of worker processes building subtrees")
+	parser.add_argument("-b","--bucket", type=int, default=20,
+		help="size of the tree leafs")
+	parser.add_argument("--stages", nargs='+', default=STAGES, choices=STAGES,
+		help="stages to run, the build stage reads the lists of the sort stage")
+	parser.add_argument("-o","--history",
+		help="JSON file the results are appended to (default: %s in the workdir)"
+		%HISTORY_NAME)
+	parser.add_argument("--workdir", default=".",
+		help="directory for the generated point clouds and outputs")
+	parser.add_argument("-s","--scratch", nargs='+',
+		help="scratch directories of the stages (default: in the workdir)")
+	parser.add_argument("--seed", type=int, default=0,
+		help="seed of the point cloud generator")
+	parser.add_argument("--verify", action='store_true',
+		help="check the outputs of every stage")
+	parser.add_argument("--keep", action='store_true',
+		help="keep the generated point clouds and outputs")
+	args = parser.parse_args()
+	if args.history is None:
+		# the history stays next to the benchmark runs, outside the sources
+		args.history = os.path.join(args.workdir, HISTORY_NAME)
+
+	history = load_history(args.history)
+	regressions = []
+	for nelems in map(int, args.nelems):
+		for fmt in args.format:
+			for distribution in args.distribution:
+				for memcap in args.memcap:
+					config = { 'nelems':nelems, 'format':fmt,
+						'distribution':distribution, 'memcap':int(memcap*GB_IN_B),
+						'workers':args.workers, 'tree_workers':args.tree_workers,
+						'bucket':args.bucket, 'seed':args.seed }
+					print("\n{nelems} points, {format}, {distribution}, "
+						.format(**config)+"{} GB".format(memcap))
+					# the stages run in the workdir, which has to be absolute
+					workdir = os.path.abspath(tempfile.mkdtemp(prefix="benchmark_",
+						dir=args.workdir))
+					try:
+						stages = run_benchmark(nelems, fmt, distribution,
+							config['memcap'], args.workers, args.bucket,
+							args.stages, workdir, args.scratch, args.seed,
+							args.verify, args.tree_workers)
+					finally:
+						if not args.keep:
+							shutil.rmtree(workdir)
+					entry = { 'time':time.strftime("%Y-%m-%d %H:%M:%S"),
+						'revision':git_revision(), 'host':socket.gethostname(),
+						'cpus':os.cpu_count(), 'python':platform.python_version(),
+						'numpy':np.__version__, 'config':config, 'stages':stages }
+					regressions += [ (config, stage) for stage
+						in compare(history, entry) ]
+					history.append(entry)
+					save_history(args.history, history)
+
+	if regressions:
+		print("\nRegressions:")
+		for config, stage in regressions:
+			print("  {} of {nelems} points, {format}, {distribution}, "
+				.format(stage,**config)+"{} MB".format(config['memcap']//MB_IN_B))
+		sys.exit(1)
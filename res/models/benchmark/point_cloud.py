@@ -0,0 +1,147 @@
+# bin/include/python3.7
+
+"""
+Bachelor Thesis
+Nils Harbke
+> Optimized Out-of-Core Rendering for Interactive
+> Presentation of Large Point Clouds
+HAW Hamburg
+
+Generates synthetic PLY point clouds of any size for the benchmarks.
+Points are generated and written in blocks, and the same seed always
+produces the same file.
+"""
+
+import argparse
+import numpy as np
+
+# point distributions: uniform in a cube, gaussian clusters, scan lines
+# over a thin wavy surface, and few distinct points repeated many times
+UNIFORM	   = 'uniform'
+CLUSTERED  = 'clustered'
+SURFACE	   = 'surface'
+DUPLICATES = 'duplicates'
+DISTRIBUTIONS = [ UNIFORM, CLUSTERED, SURFACE, DUPLICATES ]
+
+FORMATS = [ 'binary_little_endian', 'binary_big_endian', 'ascii' ]
+
+# edge length of the cube holding the points
+EXTENT = 2000.0
+
+# points generated and written at once
+BLOCK_POINTS = 2**20
+
+# points per cluster, points per scan line and distinct points per
+# duplicated point
+CLUSTER_POINTS	 = 100000
+SCANLINE_POINTS	 = 4000
+DUPLICATE_FACTOR = 100
+
+
+def generate_points(nelems, distribution, seed=0, block_points=BLOCK_POINTS):
+	""" Generator of (first, points) blocks of nelems float32 points of
+	a distribution. The blocks only depend on the seed and nelems. """
+
+	if distribution not in DISTRIBUTIONS:
+		raise ValueError("unknown distribution %s"%distribution)
+	rng = np.random.default_rng(seed)
+
+	# parameters shared by all blocks
+	if distribution == CLUSTERED:
+		clusters = max(nelems // CLUSTER_POINTS, 1)
+		centers	 = (rng.random((clusters,3)) - 0.5) * EXTENT
+		sigmas	 = rng.uniform(0.002, 0.02, clusters) * EXTENT
+	elif distribution == DUPLICATES:
+		# distinct points on a coarse grid, drawn over and over
+		distinct = max(nelems // DUPLICATE_FACTOR, 1)
+		pool = (rng.integers(-100, 100, (distinct,3)) * (EXTENT/200))
+
+	for first in range(0, nelems, block_points):
+		count = min(block_points, nelems-first)
+		if distribution == UNIFORM:
+			points = (rng.random((count,3)) - 0.5) * EXTENT
+		elif distribution == CLUSTERED:
+			cluster = rng.integers(0, clusters, count)
+			points	= centers[cluster] + rng.normal(size=(count,3)) \
+				* sigmas[cluster,None]
+		elif distribution == SURFACE:
+			# points in scan order along lines across the surface
+			index = np.arange(first, first+count)
+			lines = max(nelems // SCANLINE_POINTS, 1)
+			u = (index // SCANLINE_POINTS) / lines - 0.5
+			v = (index % SCANLINE_POINTS) / SCANLINE_POINTS - 0.5
+			points = np.empty((count,3))
+			points[:,0] = u * EXTENT
+			points[:,1] = v * EXTENT
+			points[:,2] = (np.sin(u*12) * np.cos(v*9) * 0.1
+				+ rng.normal(0, 0.0005, count)) * EXTENT
+		else:
+			points = pool[rng.integers(0, len(pool), count)]
+		yield first, points.astype(np.float32)
+
+
+def ply_header(nelems, fmt, colors=False):
+	# PLY header of a vertex element with xyz and optional colors
+	header = "ply\nformat %s 1.0\ncomment synthetic point cloud\n"%fmt \
+		+"element vertex %d\n"%nelems \
+		+"property float x\nproperty float y\nproperty float z\n"
+	if colors:
+		header += "property uchar red\nproperty uchar green\nproperty uchar blue\n"
+	return (header+"end_header\n").encode()
+
+
+def write_ply(path, nelems, fmt=FORMATS[0], distribution=UNIFORM, seed=0,
+	colors=False, block_points=BLOCK_POINTS):
+	""" Write a PLY file of nelems synthetic points. Colors are derived
+	from the coordinates. Returns the size of the file. """
+
+	if fmt not in FORMATS:
+		raise ValueError("unknown PLY format %s"%fmt)
+	order = '>' if fmt == 'binary_big_endian' else '<'
+	dtype = [ ('x',order+'f4'), ('y',order+'f4'), ('z',order+'f4') ]
+	if colors:
+		dtype += [ ('red','u1'), ('green','u1'), ('blue','u1') ]
+	dtype = np.dtype(dtype)
+
+	with open(path,'wb') as ply_file:
+		ply_file.write(ply_header(nelems, fmt, colors))
+		for _, points in generate_points(nelems, distribution, seed,
+			block_points):
+			block = np.empty(len(points), dtype=dtype)
+			for d, axis in enumerate('xyz'):
+				block[axis] = points[:,d]
+			if colors:
+				rgb = ((points/EXTENT + 0.5).clip(0,1) * 255).astype(np.uint8)
+				block['red'], block['green'], block['blue'] = rgb.T
+			if fmt == 'ascii':
+				# 9 significant digits read back as the same float32
+				columns = [ block[name] for name in dtype.names ]
+				np.savetxt(ply_file, np.column_stack(columns),
+					fmt=['%.9g']*3+['%d']*(len(columns)-3))
+			else:
+				block.tofile(ply_file)
+		return ply_file.tell()
+
+
+if __name__ == '__main__':
+
+	parser = argparse.ArgumentParser(description = "[Point Cloud Generator]\nWrites synthetic PLY point clouds for the benchmarks.")
+	parser.add_argument("output",
+		help="PLY file to write")
+	parser.add_argument("-n","--nelems", type=float, default=1e6,
+		help="number of points")
+	parser.add_argument("-f","--format", default=FORMATS[0], choices=FORMATS,
+		help="PLY format")
+	parser.add_argument("-d","--distribution", default=UNIFORM,
+		choices=DISTRIBUTIONS,
+		help="distribution of the points")
+	parser.add_argument("--seed", type=int, default=0,
+		help="seed of the random generator")
+	parser.add_argument("--colors", action='store_true',
+		help="add red, green and blue properties")
+	args = parser.parse_args()
+
+	size = write_ply(args.output, int(args.nelems), args.format,
+		args.distribution, args.seed, args.colors)
+	print("{}: {} points, {} MB".format(args.output,int(args.nelems),
+		size//1000000))
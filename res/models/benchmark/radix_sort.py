@@ -0,0 +1,88 @@
+# bin/include/python3.7
+
+"""
+Bachelor Thesis
+Nils Harbke
+> Optimized Out-of-Core Rendering for Interactive
+> Presentation of Large Point Clouds
+HAW Hamburg
+
+Compares the radix sort of chunks with the stable argsort on float32
+keys. Keys are generated and sorted in chunks that fit the memory cap,
+like the chunks of ooc_point_sorting.py, so the benchmark runs for any
+number of keys.
+"""
+
+import os
+import sys
+import time
+import argparse
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from radix import radix_argsort
+from ooc_point_sorting import GB_IN_B, SORT_BYTES_PER_POINT, \
+	RADIX_BYTES_PER_POINT
+
+# key distributions: uniform coordinates, or coordinates on a grid with
+# many duplicate values
+DISTRIBUTIONS = [ 'uniform', 'duplicates' ]
+
+
+def generate_keys(rng, count, distribution):
+	if distribution == 'uniform':
+		return (rng.random(count, dtype=np.float32) - 0.5) * 2000
+	return (rng.integers(-1000, 1000, count) * 0.25).astype(np.float32)
+
+
+def benchmark(nkeys, memcap, distribution, verify, seed=0):
+	""" Sort nkeys keys in chunks fitting memcap by both sorters. Returns
+	the seconds taken by argsort and by the radix sort. """
+
+	capacity = int(min(nkeys, memcap // (4 + max(SORT_BYTES_PER_POINT,
+		RADIX_BYTES_PER_POINT))))
+	rng = np.random.default_rng(seed)
+	times = [ 0.0, 0.0 ]
+	for first in range(0, nkeys, capacity):
+		keys = generate_keys(rng, min(capacity, nkeys-first), distribution)
+
+		time_start = time.time()
+		expected = np.argsort(keys, kind='stable')
+		times[0] += time.time() - time_start
+		if not verify:
+			del expected
+
+		time_start = time.time()
+		order = radix_argsort(keys)
+		times[1] += time.time() - time_start
+
+		if verify and not np.array_equal(order, expected):
+			raise AssertionError("radix sort differs from argsort")
+		del keys, order
+	return times
+
+
+if __name__ == '__main__':
+
+	parser = argparse.ArgumentParser(description = "[Radix Sort Benchmark]\nCompares the radix sort of chunks with the stable argsort on float32 keys.")
+	parser.add_argument("-n","--nkeys", type=float, nargs='+',
+		default=[ 1e7, 1e8, 1e9 ],
+		help="numbers of keys to sort")
+	parser.add_argument("-m","--memcap", type=float, default=2,
+		help="memory available for one chunk in GB")
+	parser.add_argument("-d","--distribution", default=DISTRIBUTIONS[0],
+		choices=DISTRIBUTIONS,
+		help="distribution of the keys")
+	parser.add_argument("--verify", action='store_true',
+		help="check that both sorters produce the same order")
+	args = parser.parse_args()
+
+	print("{:>12} {:>15} {:>15} {:>8}".format("keys","argsort keys/s","radix keys/s",
+		"speedup"))
+	for nkeys in args.nkeys:
+		nkeys = int(nkeys)
+		argsort_s, radix_s = benchmark(nkeys, int(args.memcap*GB_IN_B),
+			args.distribution, args.verify)
+		print("{:>12} {:>15.0f} {:>15.0f} {:>7.2f}x".format(nkeys,
+			nkeys/max(argsort_s,1e-9), nkeys/max(radix_s,1e-9),
+			argsort_s/max(radix_s,1e-9)))
@@ -11,12 +11,21 @@ HAW Hamburg
 
 import os
 import sys
+import math
 import time
-import queue
+import array
+import struct
 import psutil
 import argparse
-import threading
 import numpy as np
+import concurrent.futures
+
+from scratch import ScratchSpace
+from metrics import Metrics, log, flush_log
+from fileformat import MAGIC_TREE, MAGIC_LIST, HEADER_DTYPE, write_header, \
+	read_header, open_list, index_width, tree_index_width, index_dtype
+
+import ooc_point_sorting
 
 # color codes for console output
 W = '\033[0m'  # white
@@ -35,152 +44,413 @@ DIM_COLOR	= { XDIM:R, YDIM:G, ZDIM:B }
 
 SPHERE 	   = 'SPHERE'
 AABB   	   = 'AABB'
+NONE	   = 'NONE'
 SPLITPLANE = 'SPLITPLANE'
 
+# bounding volume flag stored in the tree header
+BV_FLAGS = { SPHERE:0, AABB:1, NONE:2, SPLITPLANE:3 }
+
 MIN_IN_S	= 60
 HOUR_IN_S	= MIN_IN_S * 60
+GB_IN_B		= 1000000000
+MB_IN_B		= 1000000
 
-tree_depth = 0
+# name prefix of the work directories in the scratch directories
+SCRATCH_PREFIX = "build_tree_"
 
-if __debug__:
-	LOG_QUEUE = queue.Queue(maxsize=5)
-	MERGE_PROGRESS = { XDIM : dict(), YDIM : dict(), ZDIM : dict() }
-	
+# points of a node from which on its partition is logged
+PROGRESS_POINTS = 2**16
 
-def main(args):
+# side of a point relative to the splitting plane of a node
+LEFT_SIDE	= 0
+RIGHT_SIDE	= 1
+MEDIAN_SIDE = 2
 
-	global tree_depth
+# bytes per point of the in-core build besides the index lists: the
+# point data, and the side of every point with the sides and the mask
+# taken from it while a node is split
+DATA_BYTES_PER_POINT	  = 12
+PARTITION_BYTES_PER_POINT = 5
 
-	# create/empty tmp folder for chunk files
-	# ---------------------------------------
-	if os.path.exists('tmp'):
-		for file in os.listdir('tmp'):
-			os.unlink('tmp/'+file)
+# indices of a list read and written at once while a node too large for
+# memory is split on disk, with the coordinates of the cut axis and the
+# masks of the sides taken from them
+BLOCK_POINTS = 2**20
+STAGING_BYTES_PER_POINT = 8
+
+# subtrees handed to every worker process, so workers finishing early
+# take over the remaining subtrees
+SUBTREES_PER_WORKER = 4
+
+# bytes of a segment copied into the tree file at once
+STITCH_BYTES = 64*2**20
+
+# bytes of nodes buffered before they are written to the tree file
+TREE_BUFFER_BYTES = 16*2**20
+
+# bytes of the interpreter, NumPy and the logger, which the memory cap
+# doesn't leave to the tree, and of a forked worker process
+RESERVED_BYTES 		  = 64 * MB_IN_B
+WORKER_RESERVED_BYTES = 32 * MB_IN_B
+
+# struct codes of the bounding volume of an inner node
+BV_CODES = { SPHERE:'f', AABB:'6f', NONE:'', SPLITPLANE:'I' }
+
+
+""" Settings and state of one tree build. Every build keeps its own job
+instead of module state, so several trees can be built in the threads of
+one process. The TreeWriter of the tree file, the type of its indices,
+the depth, the sides of the points, the memory cap of subtrees built in
+memory and the worker pool building subtrees in parallel are set up by
+main(). """
+class TreeJob:
+
+	def __init__(self, bucket=2, boundingvolume=SPHERE, scratch_dirs=[ "." ],
+		metrics=None):
+		self.bucket			= bucket
+		self.boundingvolume = boundingvolume
+		self.scratch_dirs	= list(scratch_dirs)
+		self.metrics		= metrics if metrics is not None else Metrics()
+		self.scratch		= None
+		self.tree_file		= None
+		# type of the point indices, child offsets and leaf sizes in the
+		# tree file, uint64 once the tree doesn't fit 32 bit offsets
+		self.tree_index		= np.uint32
+		self.depth			= 0
+		# side of every point in the node being split
+		self.side			= None
+		# bytes a subtree may take to be built in memory, by every worker
+		# if there are workers, and the point index of every local index
+		# of the subtree built in memory
+		self.memcap			= None
+		self.index_map		= None
+		# index lists written to the scratch directories
+		self.list_prefix	= "list"
+		self.list_files		= 0
+		# subtrees of the nodes at split_depth are built by the workers of
+		# pool into segment files, as (child offset position, segment
+		# path, future) in the order they were handed out
+		self.pool			= None
+		self.workers		= 1
+		self.split_depth	= None
+		self.data_path		= None
+		self.segments		= []
+		# positions of the child offsets written by a worker
+		self.relocations	= None
+		# progress lines of the nodes being split, which only the main
+		# process logs, as the workers are forked next to its Logger
+		self.progress		= True
+
+
+def main(job, data_path=None, lists=None, ply_path=None, memcap=None,
+	workers=3, tree_workers=1):
+	""" Build the tree of job from the point data at data_path and the
+	index lists of all axes at lists, or sort the PLY file at ply_path
+	first with workers, which may be a list of PLY files sorted into one
+	dataset. The tree is built in memory if in_core_bytes() fits the
+	memory_budget() of the memory cap in bytes, or of the available
+	memory without one. Otherwise the nodes are split on disk until
+	their subtrees fit the memory cap. With more than one tree worker,
+	the top levels of the tree are split on disk here and their subtrees
+	built by the tree workers, with a share of the memory budget each,
+	otherwise the tree is written in preorder. The PLY file is sorted
+	with the memory cap, or 2 GB without one. Returns the outputs as
+	described by build_tree(). """
+
+	if job.bucket < 2:
+		raise ValueError("the bucket size has to be at least 2")
+
+	# create work directories for temp files
+	# --------------------------------------
+	job.scratch = ScratchSpace(job.scratch_dirs, SCRATCH_PREFIX)
+	try:
+		return build(job, data_path, lists, ply_path, memcap, workers,
+			tree_workers)
+	except BaseException:
+		# the tree file of a failed build is incomplete
+		if job.tree_file is not None:
+			job.tree_file.file.close()
+			os.unlink(job.tree_file.file.name)
+		raise
+	finally:
+		# clean up work directories, also if the build failed
+		# ---------------------------------------------------
+		if job.pool is not None:
+			for _, _, future in job.segments:
+				future.cancel()
+			job.pool.shutdown()
+		job.scratch.remove()
+	
+	
+def build(job, data_path, lists, ply_path, memcap, workers, tree_workers):
+	""" Sort and load phase and build phase of main(), with the work
+	directories set up. """
+	
+	METRICS = job.metrics
+	# with tree workers, the budget is shared by the workers building
+	# the subtrees, and the top levels of the tree are split on disk
+	shares = tree_workers if tree_workers > 1 else 0
+	
+	if memcap is None:
+		memcap = psutil.virtual_memory().available
+		sort_memcap = 2*GB_IN_B
 	else:
-		os.mkdir('tmp')
-	
-	KD_OUT = open(args.data[:-8]+'%s_B%s.bin'%(args.boundingvolume,args.bucket), 'wb+')
+		sort_memcap = memcap
+	
+	if ply_path:
+		# sort the PLY file first, and if the tree is built in memory,
+		# take the sorted indices from the last merge pass instead of
+		# writing and reading index lists
+		# ----------------------------------------------------------
+		nelems = ooc_point_sorting.PlyTiles([ ply_path ] if isinstance(
+			ply_path, str) else ply_path).nelems
+		job.memcap = memory_budget(memcap, index_width(nelems), shares)
+		in_core = not shares and fits_memory(job, nelems, index_width(nelems))
+		sorted_ply = ooc_point_sorting.sort_ply(ply_path,
+			sort_memcap, workers, job.scratch_dirs,
+			write_lists=not in_core, metrics=METRICS, keep_failed=False)
+		data_path = sorted_ply['data']
+		METRICS.start('load')
+		if in_core:
+			streams = sorted_ply['streams']
+			try:
+				XMAP, YMAP, ZMAP = [ np.concatenate([ np.empty(0,
+					streams[dim].dtype) ]+list(streams[dim]))
+					for dim in [ XDIM, YDIM, ZDIM ] ]
+			finally:
+				# the work directories of the sort are removed with the
+				# streams
+				for stream in streams.values():
+					stream.close()
+		else:
+			lists = sorted_ply['lists']
+	else:
+		METRICS.start('load')
+	
+	if ply_path is None or not in_core:
+		# memory map the input files
+		# --------------------------
+		XMAP = open_list(lists[XDIM])
+		YMAP = open_list(lists[YDIM])
+		ZMAP = open_list(lists[ZDIM])
+		job.memcap = memory_budget(memcap, XMAP.dtype.itemsize, shares)
+		in_core = not shares and fits_memory(job, len(XMAP),
+			XMAP.dtype.itemsize)
+	
+	tree_path = data_path[:-8]+'%s_B%s.bin'%(job.boundingvolume,job.bucket)
+	KD_OUT = open(tree_path, 'wb+')
 	#KD_OUT = np.memmap(args.data[:-8]+'KDTREE_B%s_%s.bin'%(args.bucket,args.type), dtype=np.uint32, mode='w+')
 
-	# memory map the input files
-	# --------------------------
-	XMAP = np.memmap(args.x, dtype=np.uint32, mode='r', offset=4)
-	YMAP = np.memmap(args.y, dtype=np.uint32, mode='r', offset=4)
-	ZMAP = np.memmap(args.z, dtype=np.uint32, mode='r', offset=4)
-	DATA = np.memmap(args.data, 
-		dtype=[(XDIM, np.float32), (YDIM, np.float32), (ZDIM, np.float32)],
-		mode='r')
+	DATA = open_data(data_path)
 	
 	# write header information into KD_OUT
 	# ------------------------------------
-	KD_OUT.write(np.uint32(-1))		   # tree depth (placeholder)
-	KD_OUT.write(np.uint32(len(XMAP))) # number of elements
-	if args.boundingvolume == SPHERE:  # BVH flag
-		KD_OUT.write(np.uint32(0))
-	elif args.boundingvolume == AABB: 
-		KD_OUT.write(np.uint32(1))
-	elif args.boundingvolume == NONE:
-		KD_OUT.write(np.uint32(2))
-	elif args.boundingvolume == SPLITPLANE:
-		KD_OUT.write(np.uint32(3))
-	
-	# check if everything fits into memory
-	# ------------------------------------
-	# note: this is entirely made up and not accurate at all as the size
-	# of values in memory tremendously differs from the bytesize in storage
-	# TODO
-	lists_size	= XMAP[0] * 8  # [nb indices] *  sizeof(uint32) * 2
-		# note: don't forget that the lists are doubled when
-		# being split into two newly sortet subsets
-	data_size	= XMAP[0] * 12 # [nb indices] * (sizeof(float32)*3)
-	expected_memory = lists_size + data_size
-	
-	if expected_memory < psutil.virtual_memory().available:
+	width = tree_index_width(len(XMAP))
+	job.tree_index = index_dtype(width).type
+	if __debug__:
+		log("Tree indices: {0}{1} bit\n".format(G,8*width))
+	write_header(KD_OUT, MAGIC_TREE, len(XMAP), width) # number of elements
+	KD_OUT.write(np.uint32(np.iinfo(np.uint32).max)) # tree depth (placeholder)
+	KD_OUT.write(np.uint32(BV_FLAGS[job.boundingvolume])) # BVH flag
+	job.tree_file = TreeWriter(KD_OUT, job.tree_index, job.boundingvolume)
+	
+	# build in memory if the estimated peak fits the memory cap
+	# --------------------------------------------------------
+	nelems = len(XMAP)
+	expected_memory = in_core_bytes(nelems, XMAP.dtype.itemsize)
+	METRICS.maximum(expected_memory=expected_memory)
+	if in_core:
 		
 		# load everything into memory replacing the memory mapped files
-		# with actual in-memory lists
+		# with in-memory arrays
 		# -------------------------------------------------------------
-		xlist = [np.uint32] * len(XMAP)
-		ylist = [np.uint32] * len(YMAP)
-		zlist = [np.uint32] * len(ZMAP)
-		
-		data_dict = dict()
-		
-		for i in range(len(XMAP)):
-			
-			xlist[i] = XMAP[i]
-			ylist[i] = YMAP[i]
-			zlist[i] = ZMAP[i]
-			
-			# load only the required subset of the whole data file as
-			# dict to still be able to use the original indexing
-			# note: luckily arrays and dicts share some of their syntax
-			# ---------------------------------------------------------
-			# Key = Index ; Value = Point
-			data_dict[XMAP[i]] = DATA[XMAP[i]]
-			
-			if __debug__:
-				log("\rMove whole data into memory: {0}{1: >3.0f}%".format(G,(i/len(XMAP)*100)))
 		if __debug__:
-			log('\n')
-		
-		# replace mapped lists with in-memory lists
-		# -----------------------------------------
-		XMAP = xlist
-		YMAP = ylist
-		ZMAP = zlist
-	
-		DATA = data_dict
+			log("Move whole data into memory: {0}{1} MB\n".format(G,
+				expected_memory//10**6))
+		XMAP, YMAP, ZMAP = [ np.array(MAP) if isinstance(MAP, np.memmap)
+			else MAP for MAP in [ XMAP, YMAP, ZMAP ] ]
+		DATA = np.array(DATA)
 		
 	elif __debug__:
-		log("Not fitting into memory.")
+		log("Not fitting into memory: {0}{1} MB\n".format(R,
+			expected_memory//10**6))
+	METRICS.add(points=nelems)
+	METRICS.stop()
 			
-	# begin kd-sorting function
-	# -------------------------
-	kdtree(XMAP,YMAP,ZMAP,DATA,args.bucket,args.boundingvolume,KD_OUT,-1, 'root',1)
-	
-	KD_OUT.seek(0,0)
-	KD_OUT.write(np.uint32(tree_depth))
-	
+	# begin kd-sorting function, handing the lists over to the root node
+	# ------------------------------------------------------------------
+	METRICS.start('build')
+	if tree_workers > 1:
+		# the nodes at split_depth are the roots of enough subtrees to
+		# keep all workers busy, the workers are forked once the tree
+		# phase starts, so they don't idle next to the sort, and leave
+		# logging to the main process
+		job.workers = tree_workers
+		job.split_depth = 1 + math.ceil(math.log2(
+			tree_workers*SUBTREES_PER_WORKER))
+		job.data_path = data_path
+		job.pool = concurrent.futures.ProcessPoolExecutor(
+			max_workers=tree_workers)
+	if in_core:
+		job.side = np.empty(nelems, dtype=np.uint8)
+		ROOT = [ XMAP, YMAP, ZMAP ]
+		del XMAP, YMAP, ZMAP
+		kdtree(job,ROOT,DATA,-1,'root',1)
+	else:
+		ROOT = [ IndexFile.open(lists[dim]) for dim in [ XDIM, YDIM, ZDIM ] ]
+		del XMAP, YMAP, ZMAP
+		kdtree_ooc(job,ROOT,DATA,-1,'root',1)
+	if job.pool is not None:
+		stitch_segments(job)
+	job.tree_file.finish()
+	
+	KD_OUT.seek(HEADER_DTYPE.itemsize,0)
+	KD_OUT.write(np.uint32(job.depth))
+	
+	KD_OUT.seek(0,2)
+	METRICS.add(bytes_written=KD_OUT.tell())
 	KD_OUT.close()
+	METRICS.stop()
 	
-	# clean up tmp folder
-	# -------------------
-	for file in os.listdir('tmp'):
-		os.unlink('tmp/'+file)
-		# this should never be called as each merge thread calls os.unlink()
-		# on merged chunks to remove them
-		log(R+"%s wasn't properly removed from tmp/ folder\n"%file)
-	os.rmdir('tmp')
+	for file in job.scratch.files():
+		# this should never be called as each node removes its lists
+		# once it is split, the work directories are removed by main()
+		log(R+"%s wasn't properly removed from the scratch directory\n"%file)
+	return { 'tree':tree_path, 'nelems':nelems, 'depth':job.depth }
 	
 	
-def kdtree(X,Y,Z,DATA,BUCKET,TYPE,KD_OUT,child_offset_pos,name,depth):
+def open_data(data_path):
+	""" Memory map the points of a sorted dataset. A dataset without points
+	can't be mapped, its tree is a single empty leaf. """
 	
-	global tree_depth
+	dtype = [(XDIM, np.float32), (YDIM, np.float32), (ZDIM, np.float32)]
+	if os.path.getsize(data_path) == 0:
+		return np.empty(0, dtype=dtype)
+	return np.memmap(data_path, dtype=dtype, mode='r')
+
+
+def memory_budget(memcap, width=4, workers=0):
+	""" Bytes of the memory cap left for the lists, point data and sides
+	of a subtree built in memory, besides the interpreter, the buffer of
+	the tree file and the blocks of lists of width bytes per index staged
+	while a node is split on disk. With workers, the rest is shared by
+	the workers, which hold their own tree buffers and staged blocks,
+	and the budget of one worker is returned. """
+	
+	staging = TREE_BUFFER_BYTES + BLOCK_POINTS*(2*width
+		+ STAGING_BYTES_PER_POINT)
+	budget = memcap - RESERVED_BYTES - staging \
+		- workers*(WORKER_RESERVED_BYTES + staging)
+	if budget < max(workers, 1):
+		raise ValueError("memory cap of %d MB is too small, at least %d MB "
+			%(memcap//MB_IN_B, (memcap-budget)//MB_IN_B+1)+"are required")
+	return budget // max(workers, 1)
+
+
+def fits_memory(job, nelems, width, local=False):
+	""" Whether the subtree of nelems points with indices of width bytes
+	is built in memory within the memory budget of job. A subtree whose
+	points are numbered locally keeps the map of its indices as well. """
 	
-	# write file offset to parent node
-	# --------------------------------
-	if child_offset_pos != -1:
-		current_pos = KD_OUT.tell()
-		KD_OUT.seek(child_offset_pos,0)
-		KD_OUT.write(np.uint32(current_pos/4)) 
-			# '/4' for direct use with float pointers in C++ and less work
-			# for the loading process
-		KD_OUT.seek(current_pos,0)
+	index_map = nelems*width if local else 0
+	return in_core_bytes(nelems, width) + index_map <= job.memcap
+
+
+def in_core_bytes(nelems, width=4):
+	""" Peak memory in bytes of building the tree of nelems points in
+	memory from index lists of width bytes per index. The lists of the
+	children of a node are created next to the lists of the node, so the
+	lists take up to twice their size. While the lists are loaded, the
+	point data is copied next to its mapped pages. """
+	
+	load  = nelems*(3*width + 2*DATA_BYTES_PER_POINT)
+	build = nelems*(DATA_BYTES_PER_POINT + 2*3*width
+		+ PARTITION_BYTES_PER_POINT)
+	return max(load, build)
+	
+	
+""" Index list of a node too large for memory, which is read from its
+file in blocks instead of being memory mapped. The lists of the root are
+the sorted lists of the input, the lists of the other nodes are raw
+indices in the scratch directories, which are removed once the node is
+split. """
+class IndexFile:
+
+	def __init__(self, path, count, dtype, offset=0, temp=True):
+		self.path	= path
+		self.count	= count
+		self.dtype	= np.dtype(dtype)
+		self.offset = offset
+		self.temp	= temp
+		self.nbytes = count*self.dtype.itemsize
+	
+	@classmethod
+	def open(cls, path):
+		# sorted index list of the input, which is kept
+		with open(path,'rb') as file:
+			count, width, offset = read_header(file, MAGIC_LIST,
+				os.path.getsize(path))
+		return cls(path, count, index_dtype(width), offset, temp=False)
+	
+	def __len__(self):
+		return self.count
+	
+	def __getitem__(self, i):
+		# single index, like the lists in memory
+		if i < 0:
+			i += self.count
+		with open(self.path,'rb') as file:
+			file.seek(self.offset + i*self.dtype.itemsize)
+			return np.fromfile(file, dtype=self.dtype, count=1)[0]
+	
+	def blocks(self, block_points=BLOCK_POINTS):
+		# generator of the indices in blocks of block_points
+		with open(self.path,'rb') as file:
+			file.seek(self.offset)
+			for first in range(0, self.count, block_points):
+				yield np.fromfile(file, dtype=self.dtype,
+					count=min(block_points, self.count-first))
+	
+	def load(self):
+		with open(self.path,'rb') as file:
+			file.seek(self.offset)
+			return np.fromfile(file, dtype=self.dtype, count=self.count)
+	
+	def remove(self):
+		if self.temp:
+			os.unlink(self.path)
+	
+	
+def kdtree(job,lists,DATA,child_offset_pos,name,depth):
+	
+	BUCKET, KD_OUT = job.bucket, job.tree_file
+	TREE_INDEX, METRICS = job.tree_index, job.metrics
+	
+	# take the index lists over from the caller, so they are freed as
+	# soon as the node is split
+	# ---------------------------------------------------------------
+	X, Y, Z = lists
+	lists.clear()
+	INDEX_MAP = job.index_map
 	
 	# get the number of elements m to be sorted
 	# ---------------------------------------
 	m = len(X)
 	
+	# write file offset to parent node
+	# --------------------------------
+	link_node(job, child_offset_pos)
+	
 	#if __debug__: print('')
 	
 	if m <= BUCKET:
-		if depth > tree_depth:
-			tree_depth = depth
-		KD_OUT.write(np.float32(0))
-		KD_OUT.write(np.uint32(len(X)))
-		for element in X:
-			KD_OUT.write(np.uint32(element*3))
+		if depth > job.depth:
+			job.depth = depth
+		if INDEX_MAP is not None:
+			X = INDEX_MAP[X]
+		KD_OUT.leaf(X.astype(TREE_INDEX)*3)
+		METRICS.add(leaves=1, points=len(X))
+		METRICS.maximum(depth=depth)
 		return
 	
 	LISTS = {XDIM:X, YDIM:Y, ZDIM:Z}
@@ -191,10 +461,61 @@ def kdtree(X,Y,Z,DATA,BUCKET,TYPE,KD_OUT,child_offset_pos,name,depth):
 	
 	# read median point index from the list of that cutting dimension
 	# ---------------------------------------------------------------
-	median = LISTS[cutdim][np.uint32(m/2)]
+	median = LISTS[cutdim][m//2]
 	
 	split_point = DATA[median]
 	
+	# sort the points to left/right of the splitting plane: the side of
+	# every point is looked up once by its index, and every list keeps
+	# its order by taking the points of one side at a time
+	# -----------------------------------------------------------------
+	SIDE = job.side
+	SIDE[X] = ~(DATA[cutdim][X] < split_point[cutdim])
+	SIDE[median] = MEDIAN_SIDE
+	XS, YS, ZS = SIDE[X], SIDE[Y], SIDE[Z]
+	XL, XR = X[XS == LEFT_SIDE], X[XS == RIGHT_SIDE]
+	YL, YR = Y[YS == LEFT_SIDE], Y[YS == RIGHT_SIDE]
+	ZL, ZR = Z[ZS == LEFT_SIDE], Z[ZS == RIGHT_SIDE]
+	del XS, YS, ZS
+	
+	if __debug__ and job.progress and m >= PROGRESS_POINTS:
+		log("\rSort lists: {0}m:{1: >10d} {2}{3}".format(O,m,W,name))
+	
+	# clear memory by deleting no longer needed lists
+	# -----------------------------------------------
+	del X,Y,Z,LISTS
+	
+	# write current node
+	# ------------------
+	if INDEX_MAP is not None:
+		median = INDEX_MAP[median]
+	child_offset_pos = write_node(job, cutdim, median, split_point,
+		min_vals, max_vals)
+	METRICS.add(nodes=1, points=1, partitioned=m)
+	
+	# branch further into recursion
+	LEFT, RIGHT = [ XL, YL, ZL ], [ XR, YR, ZR ]
+	del XL,YL,ZL,XR,YR,ZR
+	if m/2 > 0:
+		kdtree(job,LEFT,DATA,child_offset_pos,name+R+'>L',depth+1)
+	if m/2 +1 < m:
+		kdtree(job,RIGHT,DATA,
+			child_offset_pos+np.dtype(TREE_INDEX).itemsize,name+G+'>R',depth+1)
+	
+	
+def link_node(job, child_offset_pos):
+	# write the offset of the node written next to its parent node
+	if child_offset_pos != -1:
+		job.tree_file.link(child_offset_pos)
+	
+	
+def write_node(job, cutdim, median, split_point, min_vals, max_vals):
+	""" Write an inner node with the bounding volume of the job, split at
+	the point with the index median. Returns the position of its child
+	offsets, which are written by link_node() once the children are. """
+	
+	TYPE, KD_OUT = job.boundingvolume, job.tree_file
+	
 	# calculate bounding sphere with center split_point
 	# ---------------------------------------------
 	if TYPE == SPHERE:
@@ -214,76 +535,312 @@ def kdtree(X,Y,Z,DATA,BUCKET,TYPE,KD_OUT,child_offset_pos,name,depth):
 			'height': abs(max_vals[YDIM] - min_vals[YDIM]),
 			'depth' : abs(max_vals[ZDIM] - min_vals[ZDIM])
 		}
-			
-	# initialize child arrays
-	# -----------------------
-	if type(X) is type(np.memmap):
-		XL = np.memmap('tmp/'+name+'-XL.bin', dtype=np.uint32, mode='w+')
-		XR = np.memmap('tmp/'+name+'-XR.bin', dtype=np.uint32, mode='w+')
-		YL = np.memmap('tmp/'+name+'-YL.bin', dtype=np.uint32, mode='w+')
-		YR = np.memmap('tmp/'+name+'-YR.bin', dtype=np.uint32, mode='w+')
-		ZL = np.memmap('tmp/'+name+'-ZL.bin', dtype=np.uint32, mode='w+')
-		ZR = np.memmap('tmp/'+name+'-ZR.bin', dtype=np.uint32, mode='w+')
-	else:
-		XL,XR = [],[]
-		YL,YR = [],[]
-		ZL,ZR = [],[]
-	
-	# iterate over all points and sort them to left/right of the
-	# splitting plane
-	# ----------------------------------------------------------
-	for i in range(m):
-		
-		if DATA[X[i]][cutdim] < split_point[cutdim]:
-			XL.append(X[i])
-		elif X[i] != median:
-			XR.append(X[i])
-			
-		if DATA[Y[i]][cutdim] < split_point[cutdim]:
-			YL.append(Y[i])
-		elif Y[i] != median:
-			YR.append(Y[i])
-			
-		if DATA[Z[i]][cutdim] < split_point[cutdim]:
-			ZL.append(Z[i])
-		elif Z[i] != median:
-			ZR.append(Z[i])
-			
-		if __debug__:
-			#log("\r{0} {3}m: {1}{4} Sort lists: {2: >3.0f}%".format(name,m,(i/m*100),O,W),end='')
-			log("\rSort lists: {0}{1: >3.0f}% {2}m:{3: >10d} {4}{5}".format(
-				G,(i/m*100),O,m,W,name))
-	#if __debug__: print('')
-	
-	# clear memory by deleting no longer needed lists
-	# -----------------------------------------------
-	del X,Y,Z
 	
 	# write current node
 	# ------------------
 	if TYPE == SPHERE:
-		KD_OUT.write(np.float32(radius))
+		volume = [ radius ]
 	elif TYPE == AABB:
-		KD_OUT.write(np.float(aabb[XDIM]))
-		KD_OUT.write(np.float(aabb[YDIM]))
-		KD_OUT.write(np.float(aabb[ZDIM]))
-		KD_OUT.write(np.float(aabb['width']))
-		KD_OUT.write(np.float(aabb['height']))
-		KD_OUT.write(np.float(aabb['depth']))
+		volume = [ aabb[XDIM], aabb[YDIM], aabb[ZDIM], aabb['width'],
+			aabb['height'], aabb['depth'] ]
 	elif TYPE == SPLITPLANE:
-		KD_OUT.write(np.uint32(DIM_P_IDX[cutdim]))
-	KD_OUT.write(np.uint32(median*3))
-	child_offset_pos = KD_OUT.tell()	
-	# reserve 8 byte for child offsets
+		volume = [ DIM_P_IDX[cutdim] ]
+	else:
+		volume = []
+	child_offset_pos = KD_OUT.node(volume, int(median)*3)
+	if job.relocations is not None:
+		job.relocations.extend([ child_offset_pos,
+			child_offset_pos+KD_OUT.width ])
+	return child_offset_pos
+	
+	
+def kdtree_ooc(job,lists,DATA,child_offset_pos,name,depth):
+	""" Build the subtree of a node whose index lists are files. The node
+	is split on disk into the lists of its children, until the subtree
+	of a node fits the memory cap of the job and is built in memory by
+	build_subtree(). Only blocks of the lists are in memory meanwhile. """
+	
+	TREE_INDEX, METRICS = job.tree_index, job.metrics
+	
+	X, Y, Z = lists
+	lists.clear()
+	m = len(X)
+	width = X.dtype.itemsize
+	if depth == job.split_depth and m > job.bucket:
+		hand_out_subtree(job,[ X, Y, Z ],child_offset_pos,name,depth)
+		return
+	if m <= job.bucket or (job.pool is None
+		and fits_memory(job, m, width, local=True)):
+		build_subtree(job,[ X, Y, Z ],DATA,child_offset_pos,name,depth)
+		return
+	
+	# write file offset to parent node
 	# --------------------------------
-	KD_OUT.write(np.uint32(-1))
-	KD_OUT.write(np.uint32(-1))
+	link_node(job, child_offset_pos)
+	
+	LISTS = {XDIM:X, YDIM:Y, ZDIM:Z}
+	cutdim, min_vals, max_vals = dim_of_largest_extend(LISTS,DATA)
+	median = LISTS[cutdim][m//2]
+	split_point = DATA[median]
+	
+	# stream the lists into the lists of the children and remove them
+	# ---------------------------------------------------------------
+	if __debug__ and job.progress:
+		log("\rSplit lists: {0}m:{1: >10d} {2}{3}".format(P,m,W,name))
+	LEFT, RIGHT = partition_files(job, [ X, Y, Z ], DATA, cutdim,
+		split_point[cutdim], median)
+	for index_file in [ X, Y, Z ]:
+		index_file.remove()
+	del X,Y,Z,LISTS
+	
+	# write current node
+	# ------------------
+	child_offset_pos = write_node(job, cutdim, median, split_point,
+		min_vals, max_vals)
+	METRICS.add(nodes=1, points=1, partitioned=m, nodes_on_disk=1)
 	
 	# branch further into recursion
 	if m/2 > 0:
-		kdtree(XL,YL,ZL,DATA,BUCKET,TYPE,KD_OUT,child_offset_pos,name+R+'>L',depth+1)
+		kdtree_ooc(job,LEFT,DATA,child_offset_pos,name+R+'>L',depth+1)
 	if m/2 +1 < m:
-		kdtree(XR,YR,ZR,DATA,BUCKET,TYPE,KD_OUT,child_offset_pos+4,name+G+'>R',depth+1)
+		kdtree_ooc(job,RIGHT,DATA,
+			child_offset_pos+np.dtype(TREE_INDEX).itemsize,name+G+'>R',depth+1)
+	
+	
+def partition_files(job, lists, DATA, cutdim, split, median):
+	""" Split the index lists of a node into the lists of its children in
+	the scratch directories, block by block. The side of a point is taken
+	from its coordinate in the memory mapped point data, with the points
+	at the split coordinate on the right and the median in neither list.
+	Returns the lists of the left and of the right child. """
+	
+	children = ([], [])
+	for index_file in lists:
+		paths = [ job.scratch.path("%s_%d.bin"%(job.list_prefix,
+			job.list_files+side)) for side in [ LEFT_SIDE, RIGHT_SIDE ] ]
+		job.list_files += 2
+		counts = [ 0, 0 ]
+		with open(paths[LEFT_SIDE],'wb') as left_file, \
+			open(paths[RIGHT_SIDE],'wb') as right_file:
+			for block in index_file.blocks():
+				right = ~(DATA[cutdim][block] < split)
+				left_block = block[~right]
+				right_block = block[right & (block != median)]
+				left_file.write(left_block)
+				right_file.write(right_block)
+				counts[LEFT_SIDE] += len(left_block)
+				counts[RIGHT_SIDE] += len(right_block)
+		for side in [ LEFT_SIDE, RIGHT_SIDE ]:
+			children[side].append(IndexFile(paths[side], counts[side],
+				index_file.dtype))
+		job.metrics.add(bytes_read=index_file.nbytes,
+			temp_bytes=sum(counts)*index_file.dtype.itemsize)
+	return children
+	
+	
+def build_subtree(job,lists,DATA,child_offset_pos,name,depth):
+	""" Build the subtree of the index files in lists in memory. Its
+	points are numbered locally in the order of their indices, so the
+	sides and the point data of the subtree take memory by its size
+	only. The index map of the job turns the local indices back into the
+	indices of the point cloud while the subtree is written. """
+	
+	X, Y, Z = lists
+	lists.clear()
+	INDEX_MAP = np.sort(X.load())
+	LOCAL = [ np.searchsorted(INDEX_MAP, index_file.load()).astype(
+		index_file.dtype) for index_file in [ X, Y, Z ] ]
+	for index_file in [ X, Y, Z ]:
+		index_file.remove()
+	del X,Y,Z
+	
+	job.side = np.empty(len(INDEX_MAP), dtype=np.uint8)
+	job.index_map = INDEX_MAP
+	# indexing the mapped point data copies the points of the subtree
+	kdtree(job,LOCAL,DATA[INDEX_MAP],child_offset_pos,name,depth)
+	job.side = None
+	job.index_map = None
+	
+	
+def hand_out_subtree(job,lists,child_offset_pos,name,depth):
+	""" Hand the subtree of a node over to the worker pool. A worker
+	builds the subtree of its index files into a segment file, which is
+	linked to the parent node by stitch_segments(). """
+	
+	files = list(lists)
+	lists.clear()
+	
+	segment = len(job.segments)
+	segment_path = job.scratch.path("segment_%d.bin"%segment)
+	job.segments.append((child_offset_pos, segment_path,
+		job.pool.submit(build_segment, files, job.data_path, segment_path,
+		job.bucket, job.boundingvolume, job.tree_index, job.scratch_dirs,
+		job.scratch.dirs, job.memcap, segment, name, depth)))
+	
+	
+def build_segment(lists, data_path, segment_path, bucket, boundingvolume,
+	tree_index, scratch_dirs, work_dirs, memcap, segment, name, depth):
+	""" Worker building the subtree of the index files in lists into the
+	segment file at segment_path, splitting its nodes on disk until they
+	fit the memory cap. Child offsets count from the start of the
+	segment. Returns the depth of the subtree, the positions of its child
+	offsets and the counters of its metrics. """
+	
+	job = TreeJob(bucket, boundingvolume, scratch_dirs)
+	job.scratch		= ScratchSpace(scratch_dirs, SCRATCH_PREFIX, work_dirs)
+	job.tree_index	= tree_index
+	job.memcap		= memcap
+	job.list_prefix = "segment_%d_list"%segment
+	job.progress	= False
+	job.relocations = array.array('q')
+	job.metrics.start('build')
+	
+	DATA = open_data(data_path)
+	with open(segment_path,'wb') as segment_file:
+		job.tree_file = TreeWriter(segment_file, tree_index, boundingvolume)
+		kdtree_ooc(job,lists,DATA,-1,name,depth)
+		job.tree_file.finish()
+	counters = job.metrics.snapshot()['stages']['build']['counters']
+	counters.pop('depth', None)
+	return { 'depth':job.depth, 'counters':counters,
+		'relocations':np.array(job.relocations, dtype=np.int64) }
+	
+	
+def stitch_segments(job):
+	""" Append the segments of the subtrees built by the workers to the
+	tree file in the order they were handed out, and link them to their
+	parent nodes. The child offsets in a segment count from its start
+	and are moved by the position of the segment in the tree file. The
+	workers return the counters of their metrics, which are added to the
+	metrics of the job, and are logged here instead of by the workers. """
+	
+	KD_OUT = job.tree_file
+	width = KD_OUT.width
+	for segment, (child_offset_pos, segment_path, future) in enumerate(
+		job.segments):
+		result = future.result()
+		job.depth = max(job.depth, result['depth'])
+		job.metrics.add(segments=1, **result['counters'])
+		job.metrics.maximum(depth=result['depth'])
+		if __debug__:
+			# the progress of the workers, which don't log themselves
+			log("\rStitch segments: {0}{1}/{2} {3}m:{4: >10d}".format(B,
+				segment+1,len(job.segments),O,
+				result['counters'].get('points',0)))
+		
+		words = KD_OUT.tell()//4
+		link_node(job, child_offset_pos)
+		relocations = result['relocations']
+		size = os.path.getsize(segment_path)
+		with open(segment_path,'rb') as segment_file:
+			start = 0
+			while start < size:
+				# blocks end behind the last child offset they hold
+				end = min(start+STITCH_BYTES, size)
+				last = np.searchsorted(relocations, end)
+				if last and relocations[last-1]+width > end:
+					end = int(relocations[last-1])+width
+				block = bytearray(segment_file.read(end-start))
+				first, last = np.searchsorted(relocations, [ start, end ])
+				relocate(block, (relocations[first:last]-start)//4, words,
+					width)
+				KD_OUT.write(block)
+				start = end
+		os.unlink(segment_path)
+	job.segments = []
+	
+	
+def relocate(block, positions, words, width):
+	# add words to the child offsets at the word positions in block
+	WORDS = np.frombuffer(block, dtype='<u4')
+	if width == 4:
+		WORDS[positions] += np.uint32(words)
+	else:
+		offsets = WORDS[positions].astype(np.uint64) \
+			| (WORDS[positions+1].astype(np.uint64) << np.uint64(32))
+		offsets += np.uint64(words)
+		WORDS[positions] = offsets & np.uint64(0xffffffff)
+		WORDS[positions+1] = offsets >> np.uint64(32)
+	
+	
+""" Buffered writer of the nodes of a tree file. Nodes are packed into a
+preallocated buffer, which is written to the file in blocks of
+TREE_BUFFER_BYTES, so writing the tree is a sequential stream instead
+of a few small writes and two seeks per node. The child offsets of
+a node are set in the buffer while the node is still buffered. Child
+offsets of nodes written to the file already, which are the few nodes
+whose left subtree doesn't fit the buffer, are written by finish(). """
+class TreeWriter:
+
+	def __init__(self, file, tree_index, boundingvolume,
+		buffer_bytes=TREE_BUFFER_BYTES):
+		code = 'I' if np.dtype(tree_index).itemsize == 4 else 'Q'
+		self.file	 = file
+		self.width	 = np.dtype(tree_index).itemsize
+		self.index	 = struct.Struct('<'+code)
+		# inner node with the index of its point and two child offsets,
+		# and the size of a leaf behind a radius of 0
+		self.inner	 = struct.Struct('<'+BV_CODES[boundingvolume]+3*code)
+		self.leaf_header = struct.Struct('<f'+code)
+		self.no_child = np.iinfo(tree_index).max
+		self.buffer	 = bytearray(buffer_bytes)
+		self.used	 = 0
+		# position of the buffer in the file
+		self.start	 = file.tell()
+		self.patches = []
+	
+	def tell(self):
+		return self.start + self.used
+	
+	def write(self, data):
+		data = memoryview(data).cast('B')
+		if self.used + len(data) > len(self.buffer):
+			self.flush()
+			if len(data) > len(self.buffer):
+				self.file.write(data)
+				self.start += len(data)
+				return
+		self.buffer[self.used:self.used+len(data)] = data
+		self.used += len(data)
+	
+	def node(self, volume, point):
+		""" Append an inner node with the values of its bounding volume and
+		the index of its point. Returns the position of its child offsets,
+		which are set by link(). """
+		position = self.tell() + self.inner.size - 2*self.width
+		self.write(self.inner.pack(*volume, point, self.no_child,
+			self.no_child))
+		return position
+	
+	def leaf(self, points):
+		# append a leaf of the point indices in an array
+		self.write(self.leaf_header.pack(0, len(points)))
+		self.write(points)
+	
+	def link(self, child_offset_pos):
+		# set the child offset at child_offset_pos to the next node, in
+		# words for direct use with float pointers in C++
+		offset = self.tell()//4
+		if child_offset_pos >= self.start:
+			self.index.pack_into(self.buffer, child_offset_pos-self.start,
+				offset)
+		else:
+			self.patches.append((child_offset_pos, offset))
+	
+	def flush(self):
+		self.file.write(memoryview(self.buffer)[:self.used])
+		self.start += self.used
+		self.used = 0
+	
+	def finish(self):
+		""" Write the buffered nodes and the child offsets of the nodes
+		written before their children were """
+		self.flush()
+		for child_offset_pos, offset in sorted(self.patches):
+			self.file.seek(child_offset_pos)
+			self.file.write(self.index.pack(offset))
+		self.file.seek(self.start)
+		self.patches = []
 	
 	
 def dim_of_largest_extend(LISTS,DATA):
@@ -312,41 +869,31 @@ def dim_of_largest_extend(LISTS,DATA):
 	
 	return largest_extend[1], min_vals, max_vals
 
-	
-""" Worker thread for handling output to console """
-class Logger(threading.Thread):
 
-	def __init__(self):
-		super(Logger,self).__init__()
-		self.daemon = True
-		self.stop_event = threading.Event()
-		self.last_line = ""
-	
-	def run(self):
-		global LOG_QUEUE
-		while True:
-			line = LOG_QUEUE.get(block=True)
-			if line != self.last_line:
-				sys.stdout.write(line+W)
-				sys.stdout.flush()
-				self.last_line = line
-			LOG_QUEUE.task_done()
 
+def build_tree(data_path=None, lists=None, ply_path=None, bucket=2,
+	boundingvolume=SPHERE, scratch_dirs=[ "." ], memcap=None, workers=3,
+	metrics=None, tree_workers=1):
+	""" Build the tree like the command line does, from the point data at
+	data_path and the index list of every axis in lists (a dict by axis),
+	or from the PLY file at ply_path, which is sorted first. The memory
+	cap in bytes decides as in main() whether the tree is built in
+	memory, the workers sort the PLY file and the tree workers build the
+	subtrees. Every call works on its own TreeJob, so trees can be built
+	concurrently from the threads of one process. Returns a dict
+	of the path of the tree file ('tree'), its number of points ('nelems')
+	and depth ('depth'), and the metrics of all stages ('metrics'),
+	recorded in metrics if given. """
+
+	job = TreeJob(bucket, boundingvolume, scratch_dirs, metrics)
+	outputs = main(job, data_path, lists, ply_path, memcap, workers,
+		tree_workers)
+	outputs['metrics'] = job.metrics.snapshot('done')
+	return outputs
 
-def log(message):
-	global LOG_QUEUE
-	try:
-		LOG_QUEUE.put_nowait(message)
-	except queue.Full:
-		pass
-	
 	
 if __name__ == '__main__':
 
-	if __debug__:
-		my_logger = Logger()
-		my_logger.start()
-			
 	# initiate argument parser
 	# ------------------------
 	parser = argparse.ArgumentParser(description = "[Datastructure Builder]\n Takes BIN point data and sorted lists for each dimension, stores them in a custom kdtree structure including bounding volumes and cluster of given size.")
@@ -362,25 +909,52 @@ if __name__ == '__main__':
 	parser.add_argument("-z",
 		help="file with indices sorted by z-axis")
 	parser.add_argument("-b","--bucket", type=int, default=2,
-		choices=range(2,9999999),
 		help="size of data cluster at the trees leafs")
 	parser.add_argument("-bv","--boundingvolume", default=SPHERE,
 		choices=['SPHERE','AABB','SPLITPLANE'],
 		help="type of metadata for different culling techniques: SPHERE, AABB or SPLITPLANE")
+	parser.add_argument("-s","--scratch", nargs='+', default=[ "." ],
+		help="directories for temp files, which are striped across them")
+	parser.add_argument("-i","--input",
+		help="PLY file, or directory or glob pattern of PLY files, to sort first instead of reading sorted lists")
+	parser.add_argument("-m","--memcap", type=float,
+		help="maximum amount of system RAM used to sort the input and build the tree in GB (default: 2 GB to sort, the available memory to build)")
+	parser.add_argument("-w","--workers", type=int, default=3,
+		help="number of worker processes sorting the input")
+	parser.add_argument("--tree-workers", type=int, default=1,
+		help="number of worker processes building subtrees, which stitches the tree from their segments instead of writing it in preorder")
+	parser.add_argument("--metrics",
+		help="JSON file the metrics of every stage are written to")
+	parser.add_argument("--status", type=float, default=0,
+		help="seconds between status lines of the metrics on stderr")
 	
 	# read arguments from command line
 	# --------------------------------
 	args = parser.parse_args()
+	if args.bucket < 2:
+		parser.error("the bucket size has to be at least 2")
 	
-	if args.x and args.y and args.z and args.data:
+	if args.input or (args.x and args.y and args.z and args.data):
 	
 		if __debug__:
 			log(O+"{0}\n START BUILD-STRUCTURE\n{0}\n".format('-'*23))
 	
 		# start main function
 		# -------------------
+		job = TreeJob(args.bucket, args.boundingvolume, args.scratch,
+			Metrics(args.metrics, args.status, script="build_tree",
+			input=os.path.abspath(args.input or args.data),
+			bucket=args.bucket, boundingvolume=args.boundingvolume))
 		main_tstart = time.time()
-		main(args)
+		try:
+			main(job, args.data, { XDIM:args.x, YDIM:args.y, ZDIM:args.z },
+				args.input and ooc_point_sorting.ply_inputs(args.input),
+				args.memcap and args.memcap*GB_IN_B, args.workers,
+				args.tree_workers)
+		except BaseException:
+			job.metrics.close('failed')
+			raise
+		job.metrics.close()
 		main_tend = time.time()		
 		
 		if __debug__:
@@ -388,13 +962,14 @@ if __name__ == '__main__':
 			log(O+"\n\n{0}\nTime total: {1:6.3f} min\n\n".format('-'*19,
 				(main_tend-main_tstart)/MIN_IN_S))
 				# stop Logger thread
-			LOG_QUEUE.join()
+			flush_log()
 		else:
 			print(O+"\n\n{0}\nTime total: {1:6.3f} min\n\n".format('-'*19,
 				(main_tend-main_tstart)/MIN_IN_S))
 		
 	else:
 		print("missing arguments\n\tbuild_structure.py -d <datafile> -x <x-list>"
-			+"-y <y-list> -z <z-list> -b <bucketsize> -t <bvhtype>")
+			+"-y <y-list> -z <z-list> -b <bucketsize> -t <bvhtype>"
+			+"\n\tbuild_structure.py -i <plyfile> -b <bucketsize> -t <bvhtype>")
 		sys.exit(2)
 	
\ No newline at end of file
@@ -8,12 +8,193 @@ Nils Harbke
 HAW Hamburg
 """
 
+import io
+import os
 import numpy as np 	# adds more control over binary size of variables
 
+import build_tree
+import ooc_point_sorting
+from fileformat import read_tree_header, index_dtype, open_list
+from benchmark.point_cloud import write_ply
+
 DIM_X, DIM_Y, DIM_Z = 0,1,2
 P_OFFSET = 12 # bytes
 DEBUG = False
 
+# bytes of indices, offsets and counts in the tree file
+WIDTH = 4
+
+# points, bucket size and memory cap of the trees of the automated checks
+TEST_POINTS = 20000
+TEST_BUCKET = 8
+TEST_MEMCAP = 400*10**6
+
+
+def sort_test_ply(tmp_path):
+	# point data and index lists of a synthetic point cloud in tmp_path
+	ply_path = str(tmp_path / "cloud.ply")
+	write_ply(ply_path, TEST_POINTS)
+	return ooc_point_sorting.sort_ply(ply_path, TEST_MEMCAP, 1,
+		[ str(tmp_path) ])
+
+
+def build_test_tree(tmp_path, sorted_ply, **options):
+	# build the tree of a sorted point cloud, returns its bytes and the
+	# counters of the build
+	outputs = build_tree.build_tree(sorted_ply['data'], sorted_ply['lists'],
+		bucket=TEST_BUCKET, scratch_dirs=[ str(tmp_path) ],
+		memcap=TEST_MEMCAP, **options)
+	with open(outputs['tree'],'rb') as tree:
+		data = tree.read()
+	return data, outputs['metrics']['stages']['build']['counters']
+
+
+def tree_nodes(data):
+	""" Nodes of a SPHERE tree in preorder, as ('N', radius, point) and
+	('L', points), with the offsets left out, so trees of different
+	layouts can be compared """
+	
+	count, width, depth, _, header_size = read_tree_header(io.BytesIO(data))
+	words = np.frombuffer(data, dtype='<f4')
+	index = lambda word: int(np.frombuffer(data, dtype=index_dtype(width),
+		count=1, offset=4*word)[0])
+	step = width//4
+	nodes, stack = [], [ header_size//4 ]
+	while stack:
+		word = stack.pop()
+		if words[word] == 0:
+			size = index(word+1)
+			nodes.append(('L', tuple(index(word+1+step*(1+i))//3
+				for i in range(size))))
+		else:
+			nodes.append(('N', float(words[word]), index(word+1)//3))
+			stack.append(index(word+1+2*step))
+			stack.append(index(word+1+step))
+	return count, depth, nodes
+
+
+def assert_complete(count, nodes):
+	# every point is the median of one node or in one leaf
+	points = [ node[2] for node in nodes if node[0] == 'N' ] \
+		+[ point for node in nodes if node[0] == 'L' for point in node[1] ]
+	assert sorted(points) == list(range(count))
+
+
+def reference_nodes(points, lists, bucket):
+	""" Nodes of the tree of the sorted index lists in preorder, as
+	tree_nodes(), split point by point the way kdtree() did before it
+	partitioned whole arrays """
+	
+	X, Y, Z = lists
+	m = len(X)
+	if m <= bucket:
+		return [ ('L', tuple(X)) ]
+	extents = [ points[L[-1]][d] - points[L[0]][d]
+		for d, L in enumerate(lists) ]
+	cutdim = extents.index(max(extents))
+	median = lists[cutdim][m//2]
+	split = points[median]
+	radius = max(abs(np.float32(split[d]) - np.float32(points[L[i]][d]))
+		for d, L in enumerate(lists) for i in [ 0, -1 ])
+	left  = [ [ i for i in L if i != median
+		and points[i][cutdim] < split[cutdim] ] for L in lists ]
+	right = [ [ i for i in L if i != median
+		and not points[i][cutdim] < split[cutdim] ] for L in lists ]
+	return [ ('N', float(radius), median) ] \
+		+ reference_nodes(points, left, bucket) \
+		+ reference_nodes(points, right, bucket)
+
+
+def test_partition_matches_point_by_point_split(tmp_path):
+	ply_path = str(tmp_path / "cloud.ply")
+	size = write_ply(ply_path, TEST_POINTS)
+	# points on the splitting planes go to the right
+	vertices = np.memmap(ply_path, dtype='<f4', mode='r+',
+		offset=size-P_OFFSET*TEST_POINTS, shape=(TEST_POINTS,3))
+	vertices[::4,DIM_X] = vertices[0,DIM_X]
+	vertices[1::3,DIM_Y] = vertices[1,DIM_Y]
+	vertices.flush()
+	del vertices
+	sorted_ply = ooc_point_sorting.sort_ply(ply_path, TEST_MEMCAP, 1,
+		[ str(tmp_path) ])
+	
+	tree, _ = build_test_tree(tmp_path, sorted_ply)
+	count, _, nodes = tree_nodes(tree)
+	assert count == TEST_POINTS
+	assert_complete(count, nodes)
+	points = np.fromfile(sorted_ply['data'], dtype='<f4').reshape(-1,3)
+	lists = [ np.array(open_list(sorted_ply['lists'][dim])).tolist()
+		for dim in [ build_tree.XDIM, build_tree.YDIM, build_tree.ZDIM ] ]
+	assert nodes == reference_nodes(points.tolist(), lists, TEST_BUCKET)
+
+
+def test_out_of_core_tree_matches_in_core_tree(tmp_path, monkeypatch):
+	sorted_ply = sort_test_ply(tmp_path)
+	in_core, counters = build_test_tree(tmp_path, sorted_ply)
+	assert counters.get('nodes_on_disk', 0) == 0
+	
+	# subtrees of more than a few hundred points don't fit the budget
+	monkeypatch.setattr(build_tree, 'in_core_bytes',
+		lambda nelems, width=4: nelems*10**6)
+	out_of_core, counters = build_test_tree(tmp_path, sorted_ply)
+	assert counters['nodes_on_disk'] > 0
+	assert in_core == out_of_core
+	
+	count, _, nodes = tree_nodes(in_core)
+	assert count == TEST_POINTS
+	assert_complete(count, nodes)
+
+
+def test_stitched_tree_matches_serial_tree(tmp_path):
+	sorted_ply = sort_test_ply(tmp_path)
+	serial, _ = build_test_tree(tmp_path, sorted_ply)
+	stitched, counters = build_test_tree(tmp_path, sorted_ply,
+		tree_workers=2)
+	assert counters['segments'] > 1
+	# the segments of the workers follow the top levels of the tree, so
+	# only the nodes in preorder match
+	assert len(stitched) == len(serial)
+	assert tree_nodes(stitched) == tree_nodes(serial)
+	count, _, nodes = tree_nodes(stitched)
+	assert_complete(count, nodes)
+	# the segments and work directories are removed
+	assert not [ name for name in os.listdir(str(tmp_path))
+		if name.startswith(build_tree.SCRATCH_PREFIX) ]
+
+
+def test_workers_leave_logging_to_main_process(tmp_path, monkeypatch):
+	sorted_ply = sort_test_ply(tmp_path)
+	main_process = os.getpid()
+	
+	def log(message):
+		# the forked workers inherit the patched module
+		assert os.getpid() == main_process, message
+	
+	# the workers split and sort nodes which would log their progress
+	monkeypatch.setattr(build_tree, 'log', log)
+	monkeypatch.setattr(build_tree, 'PROGRESS_POINTS', 0)
+	monkeypatch.setattr(build_tree, 'in_core_bytes',
+		lambda nelems, width=4: nelems*10**6)
+	_, counters = build_test_tree(tmp_path, sorted_ply, tree_workers=2)
+	assert counters['segments'] > 1
+	assert counters['nodes_on_disk'] > counters['segments']
+
+
+def test_empty_point_cloud(tmp_path):
+	ply_path = str(tmp_path / "empty.ply")
+	write_ply(ply_path, 0)
+	sorted_ply = ooc_point_sorting.sort_ply(ply_path, TEST_MEMCAP, 1,
+		[ str(tmp_path) ])
+	for options in {}, { 'tree_workers':2 }:
+		data, counters = build_test_tree(tmp_path, sorted_ply, **options)
+		# the root is an empty leaf
+		assert tree_nodes(data) == (0, 1, [ ('L', ()) ])
+		assert counters['leaves'] == 1
+
+
+def read_index(tree):
+	return int(np.frombuffer(tree.read(WIDTH), dtype = index_dtype(WIDTH))[0])
+
 def tree_test(tree, tree_offset, data, last_x_cut, last_y_cut, last_z_cut, max_depth):
 	
 	# read current node information
@@ -21,9 +202,9 @@ def tree_test(tree, tree_offset, data, last_x_cut, last_y_cut, last_z_cut, max_d
 	flag = np.frombuffer(tree.read(4), dtype = np.uint32)[0]
 	if flag == 0:
 		# is leaf node (list of elements)
-		list_size = np.frombuffer(tree.read(4), dtype = np.uint32)[0]
+		list_size = read_index(tree)
 		for i in range(0,list_size):
-			point_index = np.frombuffer(tree.read(4), dtype = np.uint32)[0]
+			point_index = read_index(tree)
 			point_offset = point_index * 3
 			data.seek(point_offset,0)
 			point_x = np.frombuffer(data.read(4), dtype = np.float32)[0]
@@ -68,9 +249,9 @@ def tree_test(tree, tree_offset, data, last_x_cut, last_y_cut, last_z_cut, max_d
 					
 	else:
 		# is node
-		point_index 	= np.frombuffer(tree.read(4), dtype = np.uint32)[0]
-		left_offset 	= np.frombuffer(tree.read(4), dtype = np.uint32)[0]
-		right_offset 	= np.frombuffer(tree.read(4), dtype = np.uint32)[0]
+		point_index 	= read_index(tree)
+		left_offset 	= read_index(tree)
+		right_offset 	= read_index(tree)
 		
 		point_offset = point_index *12
 		
@@ -150,7 +331,8 @@ if __name__ == '__main__':
 	data = open("lucy_DATA.bin",'rb')
 	tree = open("lucy_KDTREE.bin",'rb')
 	
-	tree_test(tree, 0, data, (0,""),(0,""),(0,""), 16)
+	_, WIDTH, _, _, header_size = read_tree_header(tree)
+	tree_test(tree, header_size, data, (0,""),(0,""),(0,""), 16)
 	
 	data.close()
 	tree.close()
@@ -0,0 +1,127 @@
+# bin/include/python3.7
+
+"""
+Bachelor Thesis
+Nils Harbke
+> Optimized Out-of-Core Rendering for Interactive
+> Presentation of Large Point Clouds
+HAW Hamburg
+
+"""
+
+import os
+import numpy as np
+
+# magic numbers of the sorted index lists, of the sorted chunk and merge
+# files and of the kd-tree file
+MAGIC_LIST	= b'FPVS'
+MAGIC_RUN	= b'FPVC'
+MAGIC_TREE	= b'FPVK'
+
+FORMAT_VERSION = 1
+
+# versioned header: magic number, format version, width of indices,
+# offsets and counts in bytes and the number of elements
+HEADER_DTYPE = np.dtype([ ('magic','S4'), ('version','<u2'), ('width','<u2'),
+	('count','<u8') ])
+
+# header of legacy files: number of elements as uint32
+LEGACY_HEADER_SIZE = 4
+
+# the kd-tree file continues the header with the tree depth and the type
+# of bounding volume, legacy tree files start with depth, number of
+# elements and type of bounding volume as uint32
+TREE_HEADER_SIZE		= HEADER_DTYPE.itemsize + 8
+LEGACY_TREE_HEADER_SIZE = 12
+
+# upper bound of 32 bit words per point in a kd-tree file (a node with
+# bounding box or a leaf header and the entry of the point in a leaf)
+TREE_WORDS_PER_POINT = 12
+
+
+def index_width(nelems):
+	""" Bytes per index of a list of nelems points. Indices fit uint32
+	up to 2^32 points. """
+	return 4 if nelems <= 2**32 else 8
+
+
+def tree_index_width(nelems):
+	""" Bytes per index, offset and count of a kd-tree of nelems points.
+	The tree stores points as index*3 and nodes as offsets in 32 bit
+	words, which have to fit uint32 in 32 bit mode. """
+
+	words = TREE_WORDS_PER_POINT*nelems + TREE_HEADER_SIZE//4
+	return 4 if max(3*nelems, words) < 2**32 else 8
+
+
+def index_dtype(width):
+	return np.dtype('<u%d'%width)
+
+
+def write_header(file, magic, count, width):
+	header = np.array([ (magic, FORMAT_VERSION, width, count) ],
+		dtype=HEADER_DTYPE)
+	file.write(header.tobytes())
+
+
+def read_header(file, magic, size=None):
+	""" Read the header at the start of file. Returns the number of
+	elements, the index width and the size of the header. Files without
+	the magic number are legacy files of uint32 indices. A legacy file
+	whose number of elements happens to look like the magic number is
+	told apart by its size, if given. """
+
+	file.seek(0, 0)
+	data = file.read(HEADER_DTYPE.itemsize)
+	if len(data) < LEGACY_HEADER_SIZE:
+		raise EOFError("%s is too short for a header"%file.name)
+	legacy_count = int(np.frombuffer(data[:4], dtype='<u4')[0])
+
+	if data[:4] == magic and len(data) == HEADER_DTYPE.itemsize:
+		header = np.frombuffer(data, dtype=HEADER_DTYPE)[0]
+		count, width = int(header['count']), int(header['width'])
+		if size is None or size == HEADER_DTYPE.itemsize + count*width or \
+			size != LEGACY_HEADER_SIZE + legacy_count*4:
+			if header['version'] > FORMAT_VERSION:
+				raise ValueError("%s has format version %d, only up to %d is "
+					%(file.name,header['version'],FORMAT_VERSION)+"supported")
+			if width not in (4, 8):
+				raise ValueError("%s has an index width of %d bytes"
+					%(file.name,width))
+			file.seek(HEADER_DTYPE.itemsize, 0)
+			return count, width, HEADER_DTYPE.itemsize
+
+	file.seek(LEGACY_HEADER_SIZE, 0)
+	return legacy_count, 4, LEGACY_HEADER_SIZE
+
+
+def open_list(path):
+	""" Memory map the indices of a sorted index list """
+
+	with open(path,'rb') as file:
+		count, width, offset = read_header(file, MAGIC_LIST,
+			os.path.getsize(path))
+	if count == 0:
+		return np.empty(0, dtype=index_dtype(width))
+	return np.memmap(path, dtype=index_dtype(width), mode='r', offset=offset,
+		shape=(count,))
+
+
+def read_tree_header(file):
+	""" Read the header of a kd-tree file. Returns the number of points,
+	the index width, the tree depth, the bounding volume flag and the size
+	of the header. """
+
+	file.seek(0, 0)
+	data = file.read(TREE_HEADER_SIZE)
+	if data[:4] == MAGIC_TREE:
+		header = np.frombuffer(data[:HEADER_DTYPE.itemsize], dtype=HEADER_DTYPE)[0]
+		if header['version'] > FORMAT_VERSION:
+			raise ValueError("%s has format version %d, only up to %d is "
+				%(file.name,header['version'],FORMAT_VERSION)+"supported")
+		depth, bvflag = np.frombuffer(data[HEADER_DTYPE.itemsize:], dtype='<u4')
+		return (int(header['count']), int(header['width']), int(depth),
+			int(bvflag), TREE_HEADER_SIZE)
+	depth, count, bvflag = np.frombuffer(data[:LEGACY_TREE_HEADER_SIZE],
+		dtype='<u4')
+	return int(count), 4, int(depth), int(bvflag), LEGACY_TREE_HEADER_SIZE
@@ -0,0 +1,214 @@
+# bin/include/python3.7
+
+"""
+Bachelor Thesis
+Nils Harbke
+> Optimized Out-of-Core Rendering for Interactive
+> Presentation of Large Point Clouds
+HAW Hamburg
+
+"""
+
+import os
+import sys
+import json
+import time
+import queue
+import psutil
+import threading
+
+W = '\033[0m'  # white
+
+# seconds between two samples of the resident memory
+RSS_INTERVAL = 0.1
+
+# messages waiting for the Logger
+LOG_QUEUE_SIZE = 64
+
+
+""" Counters and timers of the stages of one run. Counters are added up
+by the main process once per block, chunk or node, never per point.
+Every stage keeps its wall time, its counters and the high-water mark of
+the resident memory of the process and its workers. The metrics are
+written as JSON to path at the end of every stage, and every interval
+seconds a status line of one JSON object is written to stream. """
+class Metrics:
+
+	def __init__(self, path=None, interval=0, stream=sys.stderr, **info):
+		self.path	  = path
+		self.interval = interval
+		self.stream	  = stream
+		self.info	  = info
+		self.stages	  = {}
+		self.stage	  = None
+		self.started  = time.time()
+		self.peak_rss = 0
+		self.sampled  = 0
+		self.lock	  = threading.Lock()
+		self.process  = psutil.Process(os.getpid())
+		self.stopped  = threading.Event()
+		if interval > 0:
+			threading.Thread(target=self.report, daemon=True).start()
+
+	def start(self, stage):
+		""" Start timing a stage. A stage started again continues its
+		counters, like a resumed run does. """
+		with self.lock:
+			self.stop_stage()
+			self.stage = stage
+			self.stages.setdefault(stage, { 'seconds':0.0, 'peak_rss':0,
+				'counters':{} })['start'] = time.time()
+		self.sample(force=True)
+
+	def stop(self):
+		# end the current stage and write the metrics
+		with self.lock:
+			self.stop_stage()
+		self.write()
+
+	def stop_stage(self):
+		if self.stage is not None:
+			stage = self.stages[self.stage]
+			stage['seconds'] += time.time() - stage.pop('start')
+			self.stage = None
+
+	def add(self, **counters):
+		# add to the counters of the current stage
+		with self.lock:
+			totals = self.stages[self.stage]['counters']
+			for name, value in counters.items():
+				totals[name] = totals.get(name, 0) + value
+		self.sample()
+
+	def maximum(self, **values):
+		# raise counters of the current stage to at least the given values
+		with self.lock:
+			totals = self.stages[self.stage]['counters']
+			for name, value in values.items():
+				totals[name] = max(totals.get(name, value), value)
+
+	def counter(self, name, stage=None):
+		with self.lock:
+			stage = self.stages.get(stage or self.stage)
+			return stage['counters'].get(name, 0) if stage else 0
+
+	def sample(self, force=False):
+		""" Update the high-water mark of the resident memory of the
+		process and its workers, at most every RSS_INTERVAL seconds """
+
+		now = time.time()
+		if not force and now - self.sampled < RSS_INTERVAL:
+			return
+		self.sampled = now
+		rss = 0
+		try:
+			processes = [ self.process ]+self.process.children(recursive=True)
+		except psutil.NoSuchProcess:
+			processes = [ self.process ]
+		for process in processes:
+			try:
+				rss += process.memory_info().rss
+			except (psutil.NoSuchProcess, psutil.AccessDenied):
+				pass
+		with self.lock:
+			self.peak_rss = max(self.peak_rss, rss)
+			if self.stage is not None:
+				stage = self.stages[self.stage]
+				stage['peak_rss'] = max(stage['peak_rss'], rss)
+		return rss
+
+	def snapshot(self, status='running'):
+		""" Metrics of all stages as a dict, with the running stage timed
+		up to now """
+
+		with self.lock:
+			stages = {}
+			for name, stage in self.stages.items():
+				seconds = stage['seconds']
+				if 'start' in stage:
+					seconds += time.time() - stage['start']
+				stages[name] = { 'seconds':round(seconds, 3),
+					'peak_rss':stage['peak_rss'],
+					'counters':dict(stage['counters']) }
+			return dict(self.info, status=status, stage=self.stage,
+				elapsed=round(time.time()-self.started, 3),
+				peak_rss=self.peak_rss, stages=stages)
+
+	def write(self, status='running'):
+		# replace the metrics file at once, so readers never see half of it
+		if self.path:
+			with open(self.path+'.tmp','w') as metrics_file:
+				json.dump(self.snapshot(status), metrics_file, indent=1)
+			os.replace(self.path+'.tmp', self.path)
+
+	def status(self, status='running'):
+		# one line of JSON, prefixed for scrapers reading mixed output
+		line = "METRICS "+json.dumps(self.snapshot(status), separators=(',',':'))
+		self.stream.write(line+'\n')
+		self.stream.flush()
+
+	def report(self):
+		# status thread
+		while not self.stopped.wait(self.interval):
+			self.sample(force=True)
+			self.status()
+
+	def close(self, status='done'):
+		""" Stop the current stage and the status thread, and write the
+		final metrics """
+
+		self.stopped.set()
+		self.sample(force=True)
+		with self.lock:
+			self.stop_stage()
+		self.write(status)
+		if self.interval > 0:
+			self.status(status)
+
+
+""" Worker thread for handling output to console """
+class Logger(threading.Thread):
+
+	def __init__(self):
+		super(Logger,self).__init__()
+		self.daemon = True
+		self.stop_event = threading.Event()
+		self.last_line = ""
+
+	def run(self):
+		while True:
+			line = LOG_QUEUE.get(block=True)
+			if line != self.last_line:
+				sys.stdout.write(line+W)
+				sys.stdout.flush()
+				self.last_line = line
+			LOG_QUEUE.task_done()
+
+
+LOG_QUEUE = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+LOGGER	  = None
+
+
+def log(message):
+	""" Queue a message for the Logger, which is started with the first
+	message. Progress lines, which start with a carriage return and are
+	redrawn anyway, are skipped while the queue is full. Every other
+	message waits for the Logger, so none is lost. """
+
+	global LOGGER
+	if LOGGER is None:
+		LOGGER = Logger()
+		LOGGER.start()
+	if message.startswith('\r'):
+		try:
+			LOG_QUEUE.put_nowait(message)
+		except queue.Full:
+			pass
+	else:
+		LOG_QUEUE.put(message)
+
+
+def flush_log():
+	# wait until the Logger has written all queued messages
+	if LOGGER is not None:
+		LOG_QUEUE.join()
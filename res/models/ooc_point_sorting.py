@@ -12,12 +12,24 @@ HAW Hamburg
 import os
 import sys
 import time
-import queue
+import json
+import glob
+import errno
+import heapq
 import psutil
 import argparse
-import threading
+import warnings
 import collections
 import numpy as np
+import concurrent.futures
+
+from scratch import ScratchSpace
+from metrics import Metrics, log, flush_log
+from radix import radix_argsort, sort_keys
+from spill import RUN_DTYPES, FRAME_RECORDS, NO_CODEC, CODECS, RunWriter, \
+	RunReader, run_complete, codec_of, codec_memory
+from fileformat import MAGIC_LIST, HEADER_DTYPE, write_header, index_width, \
+	index_dtype
 
 # color codes for console output
 W = '\033[0m'  # white
@@ -40,447 +52,1631 @@ GB_IN_B		= MB_IN_B * 1000
 MIN_IN_S	= 60
 HOUR_IN_S	= MIN_IN_S * 60
 
-BYTE_OFFSET	= { 'POINT':12, XDIM:0, YDIM:4, ZDIM:8 }
+# number of vertices read from the PLY file in one block
+BLOCK_POINTS = 2**20
 
-PLY_PATH 	 = ""
-MEMORY_CAP 	 = 2
-MERGE_QUEUES = { XDIM:queue.Queue(), YDIM:queue.Queue(), ZDIM:queue.Queue() }
-FILE_CTR 	 = 0
+# size of the newline aligned byte ranges of ascii PLY files parsed by
+# the workers, and the memory a range takes up while being parsed
+ASCII_RANGE_BYTES	= 8 * MB_IN_B
+ASCII_PARSE_FACTOR	= 4
 
-if __debug__:
-	LOG_QUEUE = queue.Queue(maxsize=5)
-	MERGE_PROGRESS = { XDIM : dict(), YDIM : dict(), ZDIM : dict() }
+# record of a point in the chunk buffers, by index width (indices are
+# 64 bit once the points don't fit 32 bit indices)
+CHUNK_DTYPE	 = np.dtype([ ('I','<u4'), (XDIM,'<f4'), (YDIM,'<f4'), (ZDIM,'<f4') ])
+CHUNK_DTYPES = { 4:CHUNK_DTYPE, 8:np.dtype([ ('I','<u8'), (XDIM,'<f4'),
+	(YDIM,'<f4'), (ZDIM,'<f4') ]) }
 
+# chunk sorting algorithms: comparison based argsort or LSD radix sort
+ARGSORT	= 'argsort'
+RADIX	= 'radix'
 
-def main():
+# additional memory needed per point while a chunk is sorted
+# (argsort result as int64 and the sorted records of 32 bit indices)
+SORT_BYTES_PER_POINT = 8 + RUN_DTYPES[4].itemsize
 
-	# create/empty tmp folder for chunk files
-	# ---------------------------------------
-	if os.path.exists('tmp'):
-		for file in os.listdir('tmp'):
-			os.unlink('tmp/'+file)
+# additional memory needed per point by the radix sort (order preserving
+# keys, digits, indices of two passes as int64 and the buffer of numpy)
+RADIX_BYTES_PER_POINT = 4 + 2 + 3*8
+
+# ingest of binary PLY files: reading blocks into memory, or mapping the
+# files and sorting chunks straight from the mapped vertices, which only
+# copies the coordinates of the sorted axis into the memory of a worker
+READ = 'read'
+MMAP = 'mmap'
+VERTEX_KEY_BYTES_PER_POINT = 4
+
+# bytes copied at once if the kernel can't copy between files
+COPY_BYTES = 64 * 2**20
+
+# memory kept free for the interpreter, numpy and I/O buffers of the
+# main process and of every worker process
+RESERVED_BYTES 		  = 64 * MB_IN_B
+WORKER_RESERVED_BYTES = 32 * MB_IN_B
+
+# memory needed per buffered point during the merge (chunk record,
+# merged copy, lexsort result and the index written to the output) of
+# 32 bit indices, 64 bit indices take 3*4 bytes more
+MERGE_BYTES_PER_POINT = 2*RUN_DTYPES[4].itemsize + 8 + 4
+
+# bounds for the number of records read from a chunk at once and for
+# the number of chunks merged in one pass (limited by open file handles)
+MIN_MERGE_BLOCK	= 2**12
+MAX_MERGE_FANIN	= 512
+
+# record of the sorted chunks and finished merge steps, which allows to
+# resume an interrupted sort
+MANIFEST_NAME	 = "manifest.json"
+MANIFEST_VERSION = 2
+
+# name prefix of the work directories in the scratch directories
+SCRATCH_PREFIX	 = "ooc_sort_"
+
+
+""" Settings and state of one sort. Every sort keeps its own job instead
+of module state, so several sorts can run in the threads of one process.
+The input is a PLY file or a list of PLY files (tiles), whose points are
+numbered in the order of the list. The outputs are written to output
+followed by _DATA.bin, _X.bin and so on, which defaults to the PLY path
+without its extension, or to the directory holding all tiles. Binary
+files are mapped or read in blocks depending on ingest. The scratch
+space, manifest and index width are set up by main(). """
+class SortJob:
+
+	def __init__(self, ply_path, memcap=2*GB_IN_B, workers=3,
+		scratch_dirs=[ "." ], codec=NO_CODEC, sorter=ARGSORT, output=None,
+		metrics=None, ingest=MMAP):
+		self.ply_paths	  = [ ply_path ] if isinstance(ply_path, str) \
+			else list(ply_path)
+		if not self.ply_paths:
+			raise ValueError("no PLY files to sort")
+		if output is None and len(self.ply_paths) == 1:
+			output = os.path.splitext(self.ply_paths[0])[0]
+		elif output is None:
+			output = os.path.commonpath([ os.path.abspath(path)
+				for path in self.ply_paths ])
+		self.memcap		  = int(memcap)
+		self.workers	  = max(workers, 1)
+		self.scratch_dirs = list(scratch_dirs)
+		self.codec		  = codec
+		self.sorter		  = sorter
+		self.ingest		  = ingest
+		self.output		  = output
+		self.metrics	  = metrics if metrics is not None else Metrics()
+		self.width		  = 4
+		self.scratch	  = None
+		self.manifest_path = ""
+		# output files opened for writing by this run
+		self.outputs	  = []
+
+
+def main(job, resume=False, write_lists=True, keep_failed=True):
+	""" Sort the points of the PLY file of job into the point data,
+	attribute files and the index lists of all axes. Without write_lists,
+	the last merge pass is left out and an IndexStream per axis is
+	returned instead. Without keep_failed, a failed sort removes its work
+	directories and outputs instead of keeping them to be resumed.
+	Returns the outputs as described by sort_ply(). """
+
+	if resume:
+		# continue from the state recorded in the manifest, whose spill
+		# files keep their codec
+		manifest = find_manifest(job.scratch_dirs, job.ply_paths)
+		job.codec = tuple(manifest['codec'])
 	else:
-		os.mkdir('tmp')
+		manifest = None
 
 	# read PLY header information
 	# ---------------------------
-	PLY_IN = open(PLY_PATH, 'rb')
-	FORMAT_OPT	 = {	b'binary_big_endian'	: '>',
-						b'binary_little_endian'	: '<',
-						b'ascii' 				: '' }
-					
-	for line in PLY_IN:
-		if line.startswith(b"element vertex"):
-			nelems = np.uint32(line.split(b' ')[2])
-			if __debug__:
-				log("{:<10}: {}{}\n".format("Points",P,nelems))
-			
-		elif line.startswith(b"format"):
-			format = line.split(b' ')[1]
-			if __debug__:
-				log("{:<10}: {}{}\n".format("Format",P,format))
-			format = FORMAT_OPT[format]
-			del FORMAT_OPT
-		elif line.startswith(b"end_header"):
-			break
-	del line
-	ply_vertices_offset = PLY_IN.tell()
+	header = PlyTiles(job.ply_paths)
+	nelems = header.nelems
+	# indices switch to 64 bit if the points require it
+	job.width = index_width(nelems)
+	if __debug__:
+		log("{:<10}: {}{} ({} bit indices)\n".format("Points",P,nelems,
+			8*job.width))
+		if len(header.paths) > 1:
+			log("{:<10}: {}{}\n".format("Files",P,len(header.paths)))
+		log("{:<10}: {}{}\n".format("Format",P,header.format_name))
+		log("{:<10}: {}{}\n".format("Attributes",P,
+			' '.join(header.attributes) or '-'))
+		log("{:<10}: {}{} (level {})\n".format("Codec",P,*job.codec))
+	if manifest is not None and manifest['nelems'] != nelems:
+		raise ValueError("manifest doesn't match the points of %s"
+			%' '.join(job.ply_paths))
 
+	# the memory cap is checked before anything is written, so a sort
+	# rejected by its plan leaves no manifest to be resumed
+	plan = plan_chunks(header, job.memcap, job.workers, job.codec, job.sorter,
+		direct_ingest(job, header))
+
+	# create work directories for chunk files
+	# ---------------------------------------
+	if manifest is None:
+		job.scratch = ScratchSpace(job.scratch_dirs, SCRATCH_PREFIX)
+	else:
+		job.scratch = ScratchSpace(job.scratch_dirs, SCRATCH_PREFIX,
+			manifest['scratch'])
+	job.manifest_path = job.scratch.path(MANIFEST_NAME, 0)
 	if __debug__:
-		bar_len	= -1
-		last_memcap_percent = -1
+		log("{:<10}: {}{}\n".format("Scratch",P,' '.join(job.scratch.dirs)))
+	try:
+		if manifest is None:
+			manifest = new_manifest(job.ply_paths, nelems, job.scratch.dirs,
+				job.codec)
+			save_manifest(job.manifest_path, manifest)
+		return sort_points(job, header, plan, manifest, write_lists)
+	except BaseException:
+		# a sort is resumed from its first recorded chunk, before that
+		# there is nothing to continue from
+		if not keep_failed or manifest is None or not (manifest['chunks']
+			or manifest['split_done']):
+			discard_sort(job)
+		raise
 
-	# split data into sorted chunks
-	# -----------------------------
+
+def sort_points(job, header, plan, manifest, write_lists):
+	""" Split and merge phase of main(), continuing from the state recorded
+	in the manifest. Returns the outputs as described by sort_ply(). """
+	
+	nelems = header.nelems
+	
+	# sorting and merging is done by a pool of worker processes
+	pool = concurrent.futures.ProcessPoolExecutor(max_workers=job.workers)
+	try:
+		
+		# split data into sorted chunks
+		# -----------------------------
+		if not manifest['split_done']:
+			split_points(job, header, plan, pool, manifest)
+		elif __debug__:
+			log("All chunks have been written before\n\n")
+		
+		# merge all chunks together
+		# -------------------------
+		time_start = time.time()
+		job.metrics.start('merge')
+		if __debug__:
+			log(O+"{0}\n MERGE ALL CHUNKS TOGETHER \n{0}\n".format('-'*27))
+
+		out_paths = None
+		if write_lists:
+			out_paths = { dim:"%s_%s.bin"%(job.output,dim) for dim in [XDIM,YDIM,ZDIM] }
+			job.outputs.extend(out_paths.values())
+		spilled, runs = merge_chunks(job, pool, manifest, out_paths, nelems)
+	finally:
+		pool.shutdown()
+	
+	time_end = time.time()
+	saved = 3 * merge_io_saved(nelems, plan['chunks'], plan['merge_passes'],
+		job.width)
+	if __debug__:
+		log("Time: {}{:6.3f}m\n".format(O,(time_end-time_start)/MIN_IN_S))
+		log("Temp I/O saved compared to pairwise merging: {}{} MB\n".format(
+			O,saved//MB_IN_B))
+		log("Temp I/O: {}{}\n\n".format(O,spill_report(spilled,
+			time_end-time_start)))
+	else:
+		print("Merge: {:6.3f}m ({} MB temp I/O saved)".format(
+			(time_end-time_start)/MIN_IN_S,saved//MB_IN_B))
+		print("Merge temp I/O: "+spill_report(spilled, time_end-time_start))
+	job.metrics.stop()
+	
+	outputs = { 'data':job.output+"_DATA.bin",
+		'attributes':AttributeWriter.paths(job.output, header),
+		'lists':out_paths, 'streams':None }
+	if not write_lists:
+		# the last merge pass is done by the consumer of the streams
+		outputs['streams'] = open_streams(job, runs, nelems)
+		return outputs
+		
+	# clean up work directories
+	# -------------------------
+	os.unlink(job.manifest_path)
+	for file in job.scratch.remove():
+		# this should never be called as the merge removes all merged
+		# chunks after recording the merge in the manifest
+		print(R+"%s wasn't properly removed from the scratch directory\n"%file)
+	return outputs
+
+
+def discard_sort(job):
+	""" Remove the work directories of a failed sort, which won't be
+	resumed, and the outputs it has started to write, which are
+	incomplete. """
+	
+	for path in job.outputs:
+		if os.path.exists(path):
+			os.unlink(path)
+	job.outputs = []
+	if job.scratch is not None:
+		job.scratch.remove()
+
+
+def split_points(job, header, plan, pool, manifest):
+	""" Split phase: read all points from the PLY files, write the point
+	data and attributes and hand chunks of points over to the workers to
+	be sorted. Chunks may hold the points of several files. Every sorted
+	chunk is recorded in the manifest, and the phase continues behind the
+	last recorded chunk. """
+	
+	nelems = header.nelems
+	start  = resume_split(job, manifest)
+	
+	if __debug__:
+		bar_len	= -1
+	
+	time_start 	= time.time()
+	job.metrics.start('split')
+	job.metrics.add(resumed_points=start)
 	if __debug__:
-		time_start 	= time.time()
 		log(O+"{0}\n SPLIT DATA TO SORTED CHUNKS \n{0}\n".format('-'*29))
-	c_points = collections.deque()
-	# collections.deque elements can be removed and added on either ends
-	# this is benefitial when emptying it into chunks
-	
-	for i in range(nelems):
-		
-		if format == '':
-			# load point from ascii context
-			data = PLY_IN.readline().split(b' ')
-			XVAL = np.float32(data[0])
-			YVAL = np.float32(data[1])
-			ZVAL = np.float32(data[2])
+		log("{:<10}: {}{} points ({} chunks)\n".format("Chunk size",P,
+			plan['capacity'],plan['chunks']))
+		if start > 0:
+			log("{:<10}: {}{} points in {} chunks\n".format("Resumed",P,
+				start,len(manifest['chunks'])))
+	
+	# point data and additional vertex properties are written in the
+	# same pass over the PLY file as the chunks
+	job.outputs.extend([ job.output+"_DATA.bin" ]
+		+AttributeWriter.paths(job.output, header))
+	p_data	   = open_output(job.output+"_DATA.bin", start*12)
+	attributes = AttributeWriter(job.output, header, start)
+	
+	# chunks of mapped binary input are sorted by the workers straight
+	# from the PLY files, otherwise two preallocated chunk buffers, backed
+	# by files to hand them over to the workers, take turns: one is filled
+	# while the other one is being sorted
+	direct	 = direct_ingest(job, header)
+	capacity = max(min(plan['capacity'],nelems),1)
+	c_buffers = [] if direct else [ np.memmap(job.scratch.path(
+		"buffer%d.bin"%b, b), dtype=CHUNK_DTYPES[job.width], mode='w+',
+		shape=(capacity,)) for b in range(2) ]
+	c_sorts	 = [ None, None ]
+	c_slot	 = 0
+	c_points = None if direct else c_buffers[c_slot]
+	c_size	 = 0
+	c_first	 = start
+	c_number = len(manifest['chunks'])
+	# bytes of the chunk files before and after compression
+	spilled	 = [ 0, 0 ]
+	
+	def spill():
+		# data of the chunk must be on disk before the chunk is recorded
+		sync_output(p_data)
+		attributes.sync()
+		if direct:
+			return sort_vertex_chunk(job, pool, header, c_size, c_first,
+				c_number)
+		return write_sorted_chunks(job, pool, c_points, c_size, c_first,
+			c_number)
+	
+	def commit(slot):
+		# record the chunk of a buffer once all its axes are sorted
+		if c_sorts[slot] is not None:
+			entry, sorts = c_sorts[slot]
+			for sort in sorts:
+				spilled[0] += run_bytes(entry['count'], job.width)
+				size = sort.result()
+				spilled[1] += size
+				job.metrics.add(bytes_written=size)
+			manifest['chunks'].append(entry)
+			save_manifest(job.manifest_path, manifest)
+			job.metrics.add(chunks=1)
+			c_sorts[slot] = None
+	
+	if direct and header.xyz_only:
+		# the point data is the vertex data of the files, which is copied
+		# by the kernel one chunk after the other
+		blocks = header.copy_blocks(p_data, COPY_BYTES//header.stride, start,
+			job.metrics)
+	else:
+		blocks = header.read_blocks(pool, job.workers+1, start, job.metrics,
+			mmap=job.ingest == MMAP)
+	for first, block in blocks:
+		
+		if isinstance(block, int):
+			size, points = block, None
 		else:
-			# load point from binary context
-			XVAL = np.frombuffer(PLY_IN.read(4),dtype=format+'f')[0]
-			YVAL = np.frombuffer(PLY_IN.read(4),dtype=format+'f')[0]
-			ZVAL = np.frombuffer(PLY_IN.read(4),dtype=format+'f')[0]
+			size = len(block)
+			points = np.empty((size,3), dtype='<f4')
+			points[:,0] = block['x']
+			points[:,1] = block['y']
+			points[:,2] = block['z']
+			points.tofile(p_data)
+			written = attributes.write(block)
+			job.metrics.add(points=size, bytes_written=points.nbytes+written)
 		
-		c_points.append((XVAL,YVAL,ZVAL,i))
-	
-		used_bytes = PROCESS.memory_info()[0]
+		# copy points into the chunk buffer, or only count the points of
+		# direct chunks, spilling full chunks
+		b_pos = 0
+		while b_pos < size:
+			count = min(capacity-c_size, size-b_pos)
+			if not direct:
+				c_chunk = c_points[c_size:c_size+count]
+				c_chunk['I'] = np.arange(first+b_pos, first+b_pos+count,
+					dtype=c_chunk.dtype['I'])
+				c_chunk[XDIM] = points[b_pos:b_pos+count,0]
+				c_chunk[YDIM] = points[b_pos:b_pos+count,1]
+				c_chunk[ZDIM] = points[b_pos:b_pos+count,2]
+			c_size += count
+			b_pos  += count
+			
+			if c_size == capacity:
+				if __debug__:
+					log(O+"\nchunk buffer full\n")
+				c_sorts[c_slot] = spill()
+				c_first	 += c_size
+				c_number += 1
+				# continue with the other buffer once it has been sorted
+				c_slot = 1 - c_slot
+				commit(c_slot)
+				if not direct:
+					c_points = c_buffers[c_slot]
+				c_size = 0
+		del block, points
 
 		# print progress
 		if __debug__:
-			memcap_percent = int((used_bytes / MEMORY_CAP)*100)
-			if memcap_percent > last_memcap_percent or (i+1) == nelems:
-				last_memcap_percent = memcap_percent
-				megabytes = int(used_bytes/MB_IN_B)
-				progress = ((i+1)/nelems)
-				if round(30*progress) > bar_len:
-					# update progress bar string
-					bar_len = int(30*progress)
-					bar = "<{:30}>".format('='*bar_len)	
-				log("\r{}{} {:6.2f}% {}| memory usage: {} MB".format(
-					G,bar,progress*100,W,megabytes))
-		
-		if used_bytes >= MEMORY_CAP:
-			if __debug__:
-				log(O+"\nmemory cap reached\n")
-			write_sorted_chunks(c_points)
-			if __debug__:
-				log("discard chached points\n")
-				last_memcap_percent = -1
-			del c_points
-			c_points 	= collections.deque()
+			megabytes = int(PROCESS.memory_info()[0]/MB_IN_B)
+			progress = ((first+b_pos)/nelems)
+			if round(30*progress) > bar_len:
+				# update progress bar string
+				bar_len = int(30*progress)
+				bar = "<{:30}>".format('='*bar_len)
+			log("\r{}{} {:6.2f}% {}| memory usage: {} MB".format(
+				G,bar,progress*100,W,megabytes))
 
 	# store remaining points and indices in the last chunk
 	if __debug__: log("\n")
 	
-	write_sorted_chunks(c_points)
+	if c_size > 0:
+		c_sorts[c_slot] = spill()
+	commit(1 - c_slot)
+	commit(c_slot)
 	
 	if __debug__: log("remove points from memory\n\n")
 	
-	del c_points
+	buffer_paths = [ c_buffer.filename for c_buffer in c_buffers ]
+	del c_points, c_buffers
+	for path in buffer_paths:
+		os.unlink(path)
+	attributes.close()
+	p_data.close()
 	
+	manifest['split_done'] = True
+	save_manifest(job.manifest_path, manifest)
+	
+	time_end = time.time()
+	points_per_s = (nelems-start) / max(time_end-time_start, 1e-9)
 	if __debug__:
-		time_end = time.time()
-		log("Time: {}{:6.3f}m\n\n".format(O,(time_end-time_start)/MIN_IN_S))
+		log("Time: {}{:6.3f}m {}({:.0f} points/s)\n".format(
+			O,(time_end-time_start)/MIN_IN_S,W,points_per_s))
+		log("Chunks: {}{}\n\n".format(O,spill_report(spilled,
+			time_end-time_start)))
+	else:
+		print("Split: {:6.3f}m ({:.0f} points/s)".format(
+			(time_end-time_start)/MIN_IN_S,points_per_s))
+		print("Split chunks: "+spill_report(spilled, time_end-time_start))
+	job.metrics.stop()
+
+
+def spill_report(spilled, seconds):
+	""" Describe the temp I/O of a stage from the bytes before and after
+	compression, with the throughput of uncompressed data """
 	
-	# move point data from PLY to binary file
-	# ---------------------------------------
-	def store_p_data( ply_file, nelems, offset, format ):
-		ply_file.seek( offset, 0 )
-		p_data = open( PLY_PATH[:-4]+"_DATA.bin", 'wb' )
-		for _ in range(nelems):
-			if format == '':
-				# load point from ascii context
-				data = ply_file.readline().split(b' ')
-				p_data.write(np.float32(data[0]))
-				p_data.write(np.float32(data[1]))
-				p_data.write(np.float32(data[2]))
+	raw, written = spilled
+	return "{} MB -> {} MB ({:.2f}x, {:.0f} MB/s)".format(raw//MB_IN_B,
+		written//MB_IN_B, raw/max(written,1), raw/MB_IN_B/max(seconds,1e-9))
+
+
+
+""" Model of a PLY header. Parses the header of an opened PLY file and
+describes the layout of the vertex element with a structured dtype. """
+class PlyHeader:
+
+	FORMATS	= {	b'binary_big_endian'	: '>',
+				b'binary_little_endian'	: '<',
+				b'ascii'				: '' }
+	
+	TYPES	= {	b'char'	 : 'i1', b'int8'	: 'i1',
+				b'uchar' : 'u1', b'uint8'	: 'u1',
+				b'short' : 'i2', b'int16'	: 'i2',
+				b'ushort': 'u2', b'uint16'	: 'u2',
+				b'int'	 : 'i4', b'int32'	: 'i4',
+				b'uint'	 : 'u4', b'uint32'	: 'u4',
+				b'float' : 'f4', b'float32'	: 'f4',
+				b'double': 'f8', b'float64'	: 'f8' }
+
+	def __init__(self, ply_file):
+		self.format_name = None
+		self.format	  = None
+		# list of [name, count, properties] in order of appearance
+		# properties are (name, type) or (name, type, list count type)
+		self.elements = []
+		
+		if ply_file.readline().strip() != b'ply':
+			raise ValueError("%s is not a PLY file"%ply_file.name)
+		
+		for line in ply_file:
+			words = line.split()
+			if not words or words[0] in (b'comment', b'obj_info'):
+				continue
+			elif words[0] == b'format':
+				self.format_name = words[1].decode()
+				self.format = self.FORMATS[words[1]]
+			elif words[0] == b'element':
+				self.elements.append([words[1].decode(), int(words[2]), []])
+			elif words[0] == b'property':
+				if words[1] == b'list':
+					prop = (words[4].decode(), self.TYPES[words[3]],
+						self.TYPES[words[2]])
+				else:
+					prop = (words[2].decode(), self.TYPES[words[1]])
+				self.elements[-1][2].append(prop)
+			elif words[0] == b'end_header':
+				break
+		else:
+			raise ValueError("PLY header is missing end_header")
+		
+		self.header_size = ply_file.tell()
+		
+		if self.format is None:
+			raise ValueError("PLY header is missing the format line")
+		
+		# vertex element layout
+		# ---------------------
+		names = [ element[0] for element in self.elements ]
+		if 'vertex' not in names:
+			raise ValueError("PLY file contains no vertex element")
+		self.vertex_element = names.index('vertex')
+		_, self.nelems, properties = self.elements[self.vertex_element]
+		
+		if any(len(prop) > 2 for prop in properties):
+			raise ValueError("list properties of vertices are not supported")
+		for axis in ['x','y','z']:
+			if axis not in [ prop[0] for prop in properties ]:
+				raise ValueError("vertex property %s is missing"%axis)
+		
+		self.vertex_dtype = self.element_dtype(self.vertex_element)
+		self.stride		  = self.vertex_dtype.itemsize
+		self.attributes	  = [ prop[0] for prop in properties
+			if prop[0] not in ('x','y','z') ]
+	
+	def element_dtype(self, element):
+		# dtype of one element in the byte order of the file
+		return np.dtype([ (prop[0], (self.format or '=')+prop[1])
+			for prop in self.elements[element][2] ])
+	
+	def seek_vertices(self, ply_file):
+		""" Move the file pointer to the first vertex, skipping all
+		elements stored in front of the vertex element. """
+		ply_file.seek(self.header_size, 0)
+		for element in range(self.vertex_element):
+			_, count, properties = self.elements[element]
+			if self.format == '':
+				for _ in range(count):
+					ply_file.readline()
+			elif any(len(prop) > 2 for prop in properties):
+				raise ValueError("list properties in front of the vertex "
+					+"element are not supported")
 			else:
-				# load point from binary context
-				p_data.write(np.frombuffer(ply_file.read(4),dtype=format+'f')[0])
-				p_data.write(np.frombuffer(ply_file.read(4),dtype=format+'f')[0])
-				p_data.write(np.frombuffer(ply_file.read(4),dtype=format+'f')[0])
-		ply_file.close()
-	p_data_thread = threading.Thread(target=store_p_data,
-		args=(PLY_IN,nelems,ply_vertices_offset,format))
-	p_data_thread.start()
-	
-	# merge all chunks together
-	# -------------------------
-	if MERGE_QUEUES[XDIM].qsize() > 1:
+				ply_file.seek(count*self.element_dtype(element).itemsize, 1)
+
+
+""" The PLY files of one sort, read as one vertex element in the order of
+the files. The points of every file are numbered behind the points of
+the files before it, so all files share one numbering and the sort
+writes a single point data file. The files may differ in their format,
+but need the same vertex properties. Describes the vertices like a
+PlyHeader, with the format and stride of the files that need the most
+memory while being read. The vertex regions of binary files start at
+their offsets. """
+class PlyTiles:
+
+	XYZ_DTYPE = np.dtype([ ('x','<f4'), ('y','<f4'), ('z','<f4') ])
+
+	def __init__(self, ply_paths):
+		self.paths	 = list(ply_paths)
+		self.headers = []
+		self.offsets = []
+		for path in self.paths:
+			with open(path,'rb') as ply_file:
+				header = PlyHeader(ply_file)
+				offset = None
+				if header.format != '':
+					header.seek_vertices(ply_file)
+					offset = ply_file.tell()
+					available = (os.fstat(ply_file.fileno()).st_size
+						- offset) // header.stride
+					if available < header.nelems:
+						raise EOFError("PLY file %s ended after %d of %d "
+							%(path,available,header.nelems)+"vertices")
+			self.headers.append(header)
+			self.offsets.append(offset)
+		
+		# all files have to fit the attribute files of the first one
+		first = self.headers[0]
+		types = lambda header: [ (attr, header.vertex_dtype[attr].str[1:])
+			for attr in header.attributes ]
+		for path, header in zip(self.paths, self.headers):
+			if types(header) != types(first):
+				raise ValueError("vertex properties of %s differ from %s"
+					%(path,self.paths[0]))
+		
+		self.firsts		  = np.cumsum([ 0 ]+[ header.nelems
+			for header in self.headers ])[:-1].tolist()
+		self.nelems		  = sum(header.nelems for header in self.headers)
+		self.attributes	  = first.attributes
+		self.vertex_dtype = first.vertex_dtype
+		self.format_name  = ' '.join(sorted(set( header.format_name
+			for header in self.headers )))
+		self.format		  = '' if any(header.format == ''
+			for header in self.headers) else first.format
+		self.stride		  = max(header.stride for header in self.headers)
+		# the vertex data of all files is the point data as it is
+		self.xyz_only	  = all(header.vertex_dtype == self.XYZ_DTYPE
+			for header in self.headers)
+	
+	def read_blocks(self, pool, window, start=0, metrics=None, mmap=False):
+		""" Generator reading the vertices of all files in blocks, beginning
+		with point start. Ascii files are parsed by the worker pool with up
+		to window ranges in flight, binary files are mapped with mmap. Yields
+		the number of the first point and a structured array of the vertex
+		dtype of its file for every block, like read_vertex_blocks(). """
 		
+		for path, header, first in zip(self.paths, self.headers, self.firsts):
+			if first + header.nelems <= start:
+				continue
+			skip = max(start - first, 0)
+			with open(path,'rb') as ply_file:
+				header.seek_vertices(ply_file)
+				if header.format == '':
+					# ascii is parsed by the workers in parallel
+					skip_ascii_lines(ply_file, skip)
+					blocks = read_ascii_ranges(pool, ply_file, header,
+						ply_file.tell(), window, skip, metrics)
+				else:
+					ply_file.seek(skip*header.stride, 1)
+					blocks = read_vertex_blocks(ply_file, header, start=skip,
+						metrics=metrics, mmap=mmap)
+				for block_first, block in blocks:
+					yield first + block_first, block
+			if metrics is not None:
+				metrics.add(files=1)
+	
+	def copy_blocks(self, data_file, block_points, start=0, metrics=None):
+		""" Generator appending the vertices of all files, which have to be
+		xyz_only, to data_file in blocks of up to block_points points,
+		beginning with point start. Yields the number of the first point
+		and the number of points of every block. """
+		
+		for path, header, offset, first in zip(self.paths, self.headers,
+			self.offsets, self.firsts):
+			if first + header.nelems <= start:
+				continue
+			with open(path,'rb') as ply_file:
+				for block in range(max(start-first,0), header.nelems,
+					block_points):
+					count = min(block_points, header.nelems-block)
+					copy_range(ply_file, data_file, offset+block*header.stride,
+						count*header.stride)
+					if metrics is not None:
+						metrics.add(points=count, bytes_read=count*header.stride,
+							bytes_written=count*header.stride)
+					yield first + block, count
+			if metrics is not None:
+				metrics.add(files=1)
+	
+	def segments(self, first, count):
+		""" Vertex regions of count points beginning with point first, as
+		(path, offset, dtype, number of points) of every binary file they
+		are stored in """
+		
+		segments = []
+		for path, header, offset, tile in zip(self.paths, self.headers,
+			self.offsets, self.firsts):
+			begin = max(first, tile)
+			end	  = min(first+count, tile+header.nelems)
+			if begin < end:
+				segments.append((path, offset+(begin-tile)*header.stride,
+					header.vertex_dtype, end-begin))
+		return segments
+
+
+def ply_inputs(pattern):
+	""" Paths of the PLY files of an input, which is a PLY file, a
+	directory of PLY files or a glob pattern. The files are sorted by
+	name, which gives the order of their points. """
+	
+	if os.path.isdir(pattern):
+		paths = [ os.path.join(pattern,name) for name in os.listdir(pattern)
+			if name.lower().endswith('.ply') ]
+	elif any(c in pattern for c in '*?['):
+		paths = glob.glob(pattern)
+	else:
+		return [ pattern ]
+	if not paths:
+		raise IOError("no PLY files found in %s"%pattern)
+	return sorted(paths)
+
+
+def direct_ingest(job, header):
+	# chunks are sorted straight from the input if all files are mapped
+	return job.ingest == MMAP and header.format != ''
+
+
+def memory_budget(memcap, workers):
+	""" Bytes of the memory cap left for chunk and merge buffers """
+	return memcap - RESERVED_BYTES - workers*WORKER_RESERVED_BYTES
+
+
+def plan_chunks(header, memcap, workers, codec=NO_CODEC, sorter=ARGSORT,
+	direct=False):
+	""" Derive the chunk size from the memory cap. Every chunk holds the
+	same number of points, so the number of chunks and merge passes only
+	depend on the number of points, the memory cap and the number of
+	workers. Two chunk buffers are held at the same time, and up to one
+	worker per axis sorts the older one. Direct chunks are sorted from the
+	mapped PLY files without chunk buffers. Every worker writing a chunk
+	holds the compressor of the codec. """
+	
+	nelems = header.nelems
+	width  = index_width(nelems)
+	if header.format == '':
+		ingest_bytes = (workers+1) * ASCII_RANGE_BYTES * ASCII_PARSE_FACTOR
+	else:
+		ingest_bytes = BLOCK_POINTS * header.stride
+	budget = memory_budget(memcap, workers) - ingest_bytes \
+		- min(workers,3)*codec_memory(codec)[0]
+	sort_bytes = (RADIX_BYTES_PER_POINT if sorter == RADIX else
+		SORT_BYTES_PER_POINT) + width - 4
+	if direct:
+		capacity = budget // (min(workers,3)
+			* (sort_bytes+VERTEX_KEY_BYTES_PER_POINT))
+	else:
+		capacity = budget // (2*CHUNK_DTYPES[width].itemsize
+			+ min(workers,3)*sort_bytes)
+	if capacity < 1:
+		raise ValueError("memory cap of %d MB is too small, at least %d MB "
+			%(memcap//MB_IN_B, (memcap-budget)//MB_IN_B+1)+"are required")
+	chunks = -(-nelems // capacity)
+	fanin  = merge_fanin(memcap, workers, codec, width)
+	# every pass reduces the number of runs by the fan-in
+	merge_passes, runs = 1, chunks
+	while runs > fanin:
+		runs = -(-runs // fanin)
+		merge_passes += 1
+	return { 'capacity':int(capacity), 'chunks':int(chunks),
+		'merge_passes':merge_passes, 'fanin':fanin, 'width':width }
+
+
+def merge_fanin(memcap, workers, codec=NO_CODEC, width=4):
+	""" Number of chunks merged in one pass, so that every chunk gets a
+	read buffer of at least MIN_MERGE_BLOCK records, and a decoded frame
+	and a decompressor for compressed chunks. Up to three merges run at
+	the same time and share the memory cap, and every merge holds a
+	compressor for its output. """
+	
+	compress, decompress = codec_memory(codec)
+	budget = max(memory_budget(memcap, workers), 0) // min(workers,3) \
+		- compress
+	fanin  = budget // (merge_bytes(width)*MIN_MERGE_BLOCK
+		+ frame_bytes(codec, width) + decompress)
+	return int(min(max(fanin, 2), MAX_MERGE_FANIN))
+
+
+def frame_bytes(codec, width=4):
+	# memory of a decoded frame held by the reader of a compressed run
+	return 0 if codec == NO_CODEC else FRAME_RECORDS*RUN_DTYPES[width].itemsize
+
+
+def merge_bytes(width):
+	# memory needed per buffered point during the merge by index width
+	return MERGE_BYTES_PER_POINT + 3*(width-4)
+
+
+def run_bytes(count, width):
+	# size of an uncompressed run file of count records
+	return HEADER_DTYPE.itemsize + count*RUN_DTYPES[width].itemsize
+
+
+def merge_io_saved(nelems, chunks, merge_passes, width=4):
+	""" Bytes of temp file I/O of one axis saved by the k-way merge of
+	key-only records compared to merging chunks of full point records
+	pairwise. Every pass but the last writes all records to a temp file,
+	every pass reads all records. """
+	
+	pairwise_passes = max(int(np.ceil(np.log2(chunks))), 1) if chunks else 0
+	io_bytes = lambda passes, record_size: ((2*passes - 1) * nelems
+		* record_size if passes else 0)
+	return (io_bytes(pairwise_passes, CHUNK_DTYPES[width].itemsize)
+		- io_bytes(merge_passes, RUN_DTYPES[width].itemsize))
+
+
+def dry_run(job):
+	""" Print the chunk plan for the input file of job without sorting it """
+	
+	header = PlyTiles(job.ply_paths)
+	plan = plan_chunks(header, job.memcap, job.workers, job.codec, job.sorter,
+		direct_ingest(job, header))
+	print("{:<13}: {} ({} bit indices)".format("Points",header.nelems,
+		8*plan['width']))
+	print("{:<13}: {}".format("Files",len(header.paths)))
+	print("{:<13}: {} MB".format("Memory cap",job.memcap//MB_IN_B))
+	print("{:<13}: {}".format("Workers",job.workers))
+	print("{:<13}: {}".format("Scratch",' '.join(job.scratch_dirs)))
+	print("{:<13}: {} (level {})".format("Codec",*job.codec))
+	print("{:<13}: {}".format("Sorter",job.sorter))
+	print("{:<13}: {}".format("Ingest",job.ingest if header.format
+		else "ascii"))
+	print("{:<13}: {} points ({} MB)".format("Chunk size",plan['capacity'],
+		plan['capacity']*CHUNK_DTYPES[plan['width']].itemsize//MB_IN_B))
+	print("{:<13}: {} per axis".format("Chunks",plan['chunks']))
+	print("{:<13}: {} per axis ({} chunks per pass)".format("Merge passes",
+		plan['merge_passes'],plan['fanin']))
+
+
+def new_manifest(ply_paths, nelems, scratch_dirs, codec):
+	""" Manifest of a new sort of the PLY files at ply_paths using the work
+	directories scratch_dirs and spill files compressed with codec. The
+	input files are identified by their paths, sizes and modification
+	times. """
+	
+	stats = [ os.stat(path) for path in ply_paths ]
+	return { 'version':MANIFEST_VERSION,
+		'input':[ os.path.abspath(path) for path in ply_paths ],
+		'input_size':[ stat.st_size for stat in stats ],
+		'input_mtime':[ stat.st_mtime for stat in stats ],
+		'nelems':nelems, 'scratch':list(scratch_dirs), 'codec':list(codec),
+		'chunks':[],
+		'split_done':False, 'merges':[] }
+
+
+def find_manifest(scratch_dirs, ply_paths):
+	""" Manifest of the latest interrupted sort of the PLY files at
+	ply_paths, looked up in the work directories of the first scratch
+	directory. """
+	
+	inputs = [ os.path.abspath(path) for path in ply_paths ]
+	for path in ScratchSpace.find(scratch_dirs, SCRATCH_PREFIX):
+		path = os.path.join(path, MANIFEST_NAME)
+		if not os.path.exists(path):
+			continue
+		with open(path,'r') as file:
+			manifest = json.load(file)
+		if manifest.get('input') == inputs:
+			return load_manifest(path, ply_paths)
+	raise IOError("no interrupted sort of %s found in %s, the sort can't "
+		%(' '.join(ply_paths),scratch_dirs[0])+"be resumed")
+
+
+def load_manifest(path, ply_paths):
+	""" Read the manifest of an interrupted sort and make sure it belongs
+	to the unchanged PLY files at ply_paths. """
+	
+	if not os.path.exists(path):
+		raise IOError("no manifest found at %s, the sort can't be resumed"
+			%path)
+	with open(path,'r') as file:
+		manifest = json.load(file)
+	if manifest.get('version') != MANIFEST_VERSION:
+		raise ValueError("manifest version %s is not supported"
+			%manifest.get('version'))
+	
+	stats = [ os.stat(path) for path in ply_paths ]
+	if (manifest['input'] != [ os.path.abspath(path) for path in ply_paths ]
+		or manifest['input_size'] != [ stat.st_size for stat in stats ]
+		or manifest['input_mtime'] != [ stat.st_mtime for stat in stats ]):
+		raise ValueError("manifest belongs to %s, or the files were changed "
+			%' '.join(manifest['input'])+"since the interrupted sort")
+	return manifest
+
+
+def save_manifest(path, manifest):
+	# replace the manifest atomically, so it is complete at any time
+	with open(path+'.tmp','w') as file:
+		json.dump(manifest, file)
+		sync_output(file)
+	os.replace(path+'.tmp', path)
+
+
+def resume_split(job, manifest):
+	""" Keep the recorded chunks of an interrupted split whose chunk files
+	and point data are complete, and remove every other temp file.
+	Returns the index of the first point not contained in a chunk. """
+	
+	data_path = job.output+"_DATA.bin"
+	data_points = os.path.getsize(data_path)//12 if os.path.exists(data_path) else 0
+	
+	first  = 0
+	chunks = []
+	for entry in manifest['chunks']:
+		if (entry['first'] != first or first+entry['count'] > data_points
+			or not all(run_complete(path, entry['count'], job.codec)
+			for path in entry['files'].values())):
+			break
+		chunks.append(entry)
+		first += entry['count']
+	
+	if len(chunks) < len(manifest['chunks']):
 		if __debug__:
-			time_start = time.time()
-			log(O+"{0}\n MERGE ALL CHUNKS TOGETHER \n{0}\n".format('-'*27))
+			log(R+"dropping %d incomplete chunks\n"%(len(manifest['chunks'])
+				-len(chunks)))
+		manifest['chunks'] = chunks
+		save_manifest(job.manifest_path, manifest)
+	
+	job.scratch.clean([ job.manifest_path ]+[ path for entry in chunks
+		for path in entry['files'].values() ])
+	return first
+
+
+def valid_list(path, count, width):
+	# a complete index list holds its header and all indices
+	return (os.path.exists(path)
+		and os.path.getsize(path) == HEADER_DTYPE.itemsize + count*width)
+
+
+def open_output(path, offset):
+	""" Open an output file for writing at byte offset. Data behind offset
+	was written by an interrupted run and is dropped. """
+	
+	if offset == 0:
+		return open(path,'wb')
+	if not os.path.exists(path) or os.path.getsize(path) < offset:
+		raise IOError("%s holds less data than recorded in the manifest"%path)
+	file = open(path,'r+b')
+	file.truncate(offset)
+	file.seek(offset, 0)
+	return file
+
+
+def sync_output(file):
+	# write buffered data through to the disk
+	file.flush()
+	os.fsync(file.fileno())
+
 
-		xmerge = QueueHandler(XDIM)
-		ymerge = QueueHandler(YDIM)
-		zmerge = QueueHandler(ZDIM)
-		xmerge.start() ; ymerge.start() ; zmerge.start()
+def copy_range(src, dst, offset, nbytes):
+	""" Append nbytes of the file src beginning at offset to the file dst.
+	The data is copied by the kernel if it supports copy_file_range, which
+	some file systems even do without copying the blocks, otherwise it is
+	read and written in blocks of COPY_BYTES. """
+	
+	dst.flush()
+	kernel_copy = getattr(os, 'copy_file_range', None)
+	while nbytes > 0:
+		copied = None
+		if kernel_copy is not None:
+			try:
+				copied = kernel_copy(src.fileno(), dst.fileno(), nbytes, offset)
+			except OSError as error:
+				if error.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+					errno.EOPNOTSUPP):
+					raise
+				kernel_copy = None
+		if copied is None:
+			data = os.pread(src.fileno(), min(nbytes, COPY_BYTES), offset)
+			copied = os.write(dst.fileno(), data) if data else 0
+		if copied == 0:
+			raise EOFError("%s ended %d bytes before the copied range"
+				%(src.name,nbytes))
+		offset += copied
+		nbytes -= copied
+
+
+def skip_ascii_lines(ply_file, count):
+	""" Move the file pointer of an ascii PLY file behind the next count
+	lines, reading the file in blocks instead of line by line. """
+	
+	while count > 0:
+		position = ply_file.tell()
+		data = ply_file.read(ASCII_RANGE_BYTES)
+		if not data:
+			raise EOFError("PLY file ended %d lines before the resumed vertex"
+				%count)
+		lines = data.count(b'\n')
+		if lines < count:
+			count -= lines
+			continue
+		# find the end of the count-th line within the block
+		end = -1
+		for _ in range(count):
+			end = data.index(b'\n', end+1)
+		ply_file.seek(position+end+1, 0)
+		count = 0
+
+
+def read_vertex_blocks(ply_file, header, block_points=BLOCK_POINTS, start=0,
+	metrics=None, mmap=False):
+	""" Generator reading the vertex region of a PLY file in blocks of up
+	to block_points vertices, beginning with vertex start at the current
+	file position. Yields the index of the first vertex and a structured
+	array of header.vertex_dtype for every block. The vertex region of a
+	binary file is mapped with mmap, and the blocks are views of it, which
+	are paged in as they are used. The bytes read are counted in metrics,
+	if given. """
+
+	nelems = header.nelems
+	dtype  = header.vertex_dtype
+	
+	if mmap and header.format != '' and start < nelems:
+		vertices = np.memmap(ply_file.name, dtype=dtype, mode='r',
+			offset=ply_file.tell(), shape=(nelems-start,))
+		for first in range(start, nelems, block_points):
+			block = vertices[first-start:first-start+block_points]
+			if metrics is not None:
+				metrics.add(bytes_read=block.nbytes)
+			yield first, block
+		return
+	
+	for first in range(start, nelems, block_points):
+		count = min(block_points, nelems-first)
 		
-		# wait for merger threads to finish the chunk queues
-		if __debug__:
-			while xmerge.is_alive() or ymerge.is_alive() or zmerge.is_alive():
-				log("\r")
-				for dim in [XDIM,YDIM,ZDIM]:
-					log("%s%s "%(DIM_COLOR[dim],dim))
-					for progress in MERGE_PROGRESS[dim].values():
-						log(DIM_COLOR[dim]+"{: >4.1f}% ".format(progress*100))
-				time.sleep(1)
-			log("\n\n")
-		else:	
-			xmerge.join() ; ymerge.join() ; zmerge.join()
+		if header.format == '':
+			# parse a block of lines from ascii context
+			lines = b''.join(ply_file.readline() for _ in range(count))
+			if metrics is not None:
+				metrics.add(bytes_read=len(lines))
+			block = parse_ascii_lines(lines, dtype)
+			if len(block) < count:
+				raise EOFError("PLY file ended after %d of %d vertices"
+					%(first + len(block), nelems))
+		else:
+			# view a block of bytes from binary context
+			buffer = ply_file.read(count * dtype.itemsize)
+			if metrics is not None:
+				metrics.add(bytes_read=len(buffer))
+			if len(buffer) < count * dtype.itemsize:
+				raise EOFError("PLY file ended after %d of %d vertices"
+					%(first + len(buffer)//dtype.itemsize, nelems))
+			block = np.frombuffer(buffer, dtype=dtype)
 		
-		if __debug__:
-			time_end = time.time()
-			log("Time: {}{:6.3f}m\n".format(O,(time_end-time_start)/MIN_IN_S))
+		yield first, block
+
+
+def read_ascii_ranges(pool, ply_file, header, offset, window, start=0,
+	metrics=None):
+	""" Generator parsing the vertex region of an ascii PLY file in
+	parallel. The file is split into newline aligned byte ranges starting
+	with vertex start at offset, which are parsed by the worker pool with
+	up to window ranges in flight. Yields the same blocks as
+	read_vertex_blocks(). """
+	
+	nelems	  = header.nelems
+	file_size = os.fstat(ply_file.fileno()).st_size
+	jobs	  = collections.deque()
+	first	  = start
+	start	  = offset
+	
+	while first < nelems:
+		
+		# keep the workers busy with the following ranges
+		while len(jobs) < window and start < file_size:
+			end = start + ASCII_RANGE_BYTES
+			if end < file_size:
+				# extend range up to the end of the current line
+				ply_file.seek(end-1, 0)
+				ply_file.readline()
+				end = ply_file.tell()
+			else:
+				end = file_size
+			jobs.append((pool.submit(parse_ascii_range, ply_file.name,
+				start, end, header.vertex_dtype), end-start))
+			start = end
+		
+		if not jobs:
+			raise EOFError("PLY file ended after %d of %d vertices"
+				%(first, nelems))
+		
+		# lines behind the last vertex belong to other elements
+		job, nbytes = jobs.popleft()
+		block = job.result()[:nelems-first]
+		if metrics is not None:
+			metrics.add(bytes_read=nbytes)
+		yield first, block
+		first += len(block)
+	
+	for job, _ in jobs:
+		job.cancel()
+
+
+def parse_ascii_range(ply_path, start, end, dtype):
+	""" Worker job parsing the lines between the byte offsets start and
+	end of an ascii PLY file """
+	
+	with open(ply_path,'rb') as ply_file:
+		ply_file.seek(start, 0)
+		lines = ply_file.read(end-start)
+	return parse_ascii_lines(lines, dtype)
+
+
+def parse_ascii_lines(lines, dtype):
+	""" Parse lines of ascii vertices into a structured array of dtype.
+	Lines of other elements are parsed as far as possible, so that the
+	result holds one entry for every line. """
+	
+	ncols  = len(dtype.names)
+	nlines = lines.count(b'\n')
+	if lines and not lines.endswith(b'\n'):
+		nlines += 1
+	
+	with warnings.catch_warnings():
+		# unparsable tokens end the fast path below
+		warnings.simplefilter('ignore', DeprecationWarning)
+		values = np.fromstring(lines, dtype=np.float64, sep=' ')
+		
+	if values.size == nlines * ncols:
+		values = values.reshape(nlines, ncols)
 	else:
-		# no multiple chunks available - move and rename single chunk
-		ifile = open(MERGE_QUEUES[XDIM].get(),'rb');
-		ofile = open("%s_X.bin"%PLY_PATH[:-4],'wb')
-		ifile.seek(0)
-		ofile.write(np.frombuffer(ifile.read(4),dtype=np.uint32)[0])
-		for i in range(nelems):
-			ofile.write(np.frombuffer(ifile.read(4),dtype=np.uint32)[0])
-			ifile.seek(12,1)
-		ofile.close() ; ifile.close()
-		os.remove(ifile.name)
-		
-		ifile = open(MERGE_QUEUES[YDIM].get(),'rb');
-		ofile = open("%s_Y.bin"%PLY_PATH[:-4],'wb')
-		ifile.seek(0)
-		ofile.write(np.frombuffer(ifile.read(4),dtype=np.uint32)[0])
-		for i in range(nelems):
-			ofile.write(np.frombuffer(ifile.read(4),dtype=np.uint32)[0])
-			ifile.seek(12,1)
-		ofile.close() ; ifile.close()
-		os.remove(ifile.name)
-		
-		ifile = open(MERGE_QUEUES[ZDIM].get(),'rb');
-		ofile = open("%s_Z.bin"%PLY_PATH[:-4],'wb')
-		ifile.seek(0)
-		ofile.write(np.frombuffer(ifile.read(4),dtype=np.uint32)[0])
-		for i in range(nelems):
-			ofile.write(np.frombuffer(ifile.read(4),dtype=np.uint32)[0])
-			ifile.seek(12,1)
-		ofile.close() ; ifile.close()
-		os.remove(ifile.name)
-		
-	# clean up tmp folder
-	# -------------------
-	for file in os.listdir('tmp'):
-		os.unlink('tmp/'+file)
-		# this should never be called as each merge thread calls os.unlink()
-		# on merged chunks to remove them
-		print(R+"%s wasn't properly removed from tmp/ folder\n"%file)
-	os.rmdir('tmp')
-	
-	# wait for P_DATA to be written
-	if p_data_thread.is_alive():
-		if __debug__: log("Waiting for point data to be written to binary file...\n\n")
-		p_data_thread.join()
-
-
-
-def write_sorted_chunks(points):
-
-	global FILE_CTR
+		# line by line for lines of other lengths (e.g. faces)
+		values = np.zeros((nlines, ncols), dtype=np.float64)
+		for i, line in enumerate(lines.splitlines()[:nlines]):
+			tokens = line.split()[:ncols]
+			values[i,:len(tokens)] = [ float(t) for t in tokens ]
+	
+	block = np.empty(nlines, dtype=dtype)
+	for column, name in enumerate(dtype.names):
+		block[name] = values[:,column]
+	return block
+
+
+""" Writes the vertex properties besides x, y and z into side files next
+to the point data. Colors are packed into <name>_RGB.bin as three uchars
+per point, every other property goes to <name>_ATTR_<property>.bin in
+little endian byte order using its type from the PLY header. Writing
+begins behind the first points already written by an interrupted run. """
+class AttributeWriter:
+
+	COLORS = [ ('red','green','blue'), ('diffuse_red','diffuse_green',
+		'diffuse_blue'), ('r','g','b') ]
+
+	def __init__(self, name, header, first=0):
+		self.header = header
+		self.colors = self.color_channels(header)
+		self.files = {}
+		for attr in header.attributes:
+			if self.colors and attr in self.colors:
+				continue
+			self.files[attr] = open_output("%s_ATTR_%s.bin"%(name,attr),
+				first*header.vertex_dtype[attr].itemsize)
+		if self.colors:
+			self.rgb = open_output("%s_RGB.bin"%name, first*3)
+	
+	@classmethod
+	def color_channels(cls, header):
+		# properties packed into the colors, if the vertices have colors
+		for channels in cls.COLORS:
+			if all(c in header.attributes for c in channels):
+				return channels
+		return None
 	
+	@classmethod
+	def paths(cls, name, header):
+		# paths of the files written for the vertices of header
+		colors = cls.color_channels(header)
+		paths = [ "%s_ATTR_%s.bin"%(name,attr) for attr in header.attributes
+			if not colors or attr not in colors ]
+		return paths+[ "%s_RGB.bin"%name ] if colors else paths
+	
+	def write(self, block):
+		# returns the number of bytes written
+		written = 0
+		for attr, file in self.files.items():
+			values = block[attr]
+			written += file.write(values.astype(values.dtype.newbyteorder('<'),
+				copy=False).tobytes())
+		if self.colors:
+			rgb = np.empty((len(block),3), dtype=np.uint8)
+			for channel, attr in enumerate(self.colors):
+				rgb[:,channel] = self.to_uchar(block[attr])
+			written += self.rgb.write(rgb.tobytes())
+		return written
+	
+	@staticmethod
+	def to_uchar(values):
+		# scale color channels of any type to the range of uchar
+		if values.dtype.kind == 'f':
+			return np.clip(np.rint(values*255), 0, 255)
+		elif values.dtype.itemsize == 1:
+			return values
+		return values >> (8*values.dtype.itemsize - 8)
+	
+	def sync(self):
+		for file in self.files.values():
+			sync_output(file)
+		if self.colors:
+			sync_output(self.rgb)
+	
+	def close(self):
+		for file in self.files.values():
+			file.close()
+		if self.colors:
+			self.rgb.close()
+
+
+def write_sorted_chunks(job, pool, c_points, count, first, number):
+	""" Hand the first count points of a file backed chunk buffer over to
+	the worker pool, which sorts it by every axis into one chunk file per
+	axis. The points start with index first and form chunk number.
+	Returns the manifest entry of the chunk and the futures of the sorting
+	jobs. """
+
+	c_points.flush()
+	entry = { 'first':int(first), 'count':int(count), 'files':{} }
+	sorts = []
 	for dim in [XDIM,YDIM,ZDIM]:
+		# the chunk files are striped across the scratch directories
+		chunk_path = job.scratch.path("%s_chunk%d.bin"%(dim,number),
+			3*number+DIM_P_IDX[dim])
+		if __debug__:
+			log("sort indices by %s%s-axis into %s\n"%(DIM_COLOR[dim],dim,
+				chunk_path))
+		sorts.append(pool.submit(sort_chunk, c_points.filename, count, dim,
+			chunk_path, job.codec, job.sorter, job.width))
+		entry['files'][dim] = chunk_path
+	return entry, sorts
+
+
+def sort_vertex_chunk(job, pool, header, count, first, number):
+	""" Hand count points beginning with point first over to the worker
+	pool, which sorts them straight from the vertex regions of the PLY
+	files by every axis into one chunk file per axis, like
+	write_sorted_chunks() does for a chunk buffer. """
 	
-		# sort arrays by points dim-value
+	segments = header.segments(first, count)
+	entry = { 'first':int(first), 'count':int(count), 'files':{} }
+	sorts = []
+	for dim in [XDIM,YDIM,ZDIM]:
+		chunk_path = job.scratch.path("%s_chunk%d.bin"%(dim,number),
+			3*number+DIM_P_IDX[dim])
 		if __debug__:
-			log("sort indices by %s%s-axis\t\t"%(DIM_COLOR[dim],dim))
-			time_start = time.time()
-			
-		# transform deque objects to lists
-		points	= list(points)
-		#points, indices = [list(t) for t in zip(*sorted(zip(points, indices),
-		#	key = lambda e: e[0][DIM_P_IDX[dim]]))]
-		points.sort(key=lambda XDIM: XDIM[DIM_P_IDX[dim]])
+			log("sort indices by %s%s-axis into %s\n"%(DIM_COLOR[dim],dim,
+				chunk_path))
+		sorts.append(pool.submit(sort_vertices, segments, first, count, dim,
+			chunk_path, job.codec, job.sorter, job.width))
+		entry['files'][dim] = chunk_path
+	return entry, sorts
+
+
+def sort_vertices(segments, first, count, dim, chunk_path, codec=NO_CODEC,
+	sorter=ARGSORT, width=4):
+	""" Worker job sorting count points, beginning with point first, by
+	dim-value straight from the vertex regions of binary PLY files given
+	as segments by PlyTiles.segments(). Only the dim-values are copied
+	into memory, as float32 like the point data, so the chunk file is
+	the same as the one sort_chunk() writes. Returns the size of the
+	chunk file. """
+	
+	keys = np.empty(count, dtype='<f4')
+	position = 0
+	for path, offset, dtype, points in segments:
+		vertices = np.memmap(path, dtype=dtype, mode='r', offset=offset,
+			shape=(points,))
+		keys[position:position+points] = vertices[dim.lower()]
+		position += points
+		del vertices
+	
+	if sorter == RADIX:
+		order = radix_argsort(keys)
+	else:
+		order = np.argsort(keys, kind='stable')
+	
+	run = np.empty(count, dtype=RUN_DTYPES[width])
+	run['I'] = order
+	run['I'] += first
+	run['K'] = keys[order]
+	del keys, order
+	
+	chunk = RunWriter(chunk_path, count, codec, width)
+	chunk.write(run)
+	return chunk.close()
+
+
+def sort_chunk(buffer_path, count, dim, chunk_path, codec=NO_CODEC,
+	sorter=ARGSORT, width=4):
+	""" Worker job sorting the first count points of the chunk buffer at
+	buffer_path by dim-value and writing them to chunk_path, compressed
+	with codec. Both sorters produce the same order. Returns the size of
+	the chunk file. """
+	
+	points = np.memmap(buffer_path, dtype=CHUNK_DTYPES[width], mode='r',
+		shape=(count,))
+	
+	# points are ordered by index, so the stable sort keeps points
+	# of equal value in order of their index
+	if sorter == RADIX:
+		order = radix_argsort(points[dim])
+	else:
+		order = np.argsort(points[dim], kind='stable')
+	
+	run = np.empty(count, dtype=RUN_DTYPES[width])
+	run['I'] = points['I'][order]
+	run['K'] = points[dim][order]
+	del points, order
+	
+	# write sorted index list with the dim-value of every point
+	chunk = RunWriter(chunk_path, count, codec, width)
+	chunk.write(run)
+	return chunk.close()
+
+
+def wait_for(jobs):
+	# wait for worker jobs and raise their exceptions
+	for job in jobs:
+		job.result()
+
+
+def merge_chunks(job, pool, manifest, out_paths, nelems):
+	""" Merge all sorted chunks of every axis into the sorted index lists
+	at out_paths, or up to the last pass if out_paths is None. All chunks
+	of an axis are merged in one pass unless there are more chunks than
+	the fan-in, then groups of chunks are merged into temp files first.
+	The merges of all axes share the worker
+	pool, with up to three merges running at a time. Every finished merge
+	step is recorded in the manifest before its input files are removed,
+	so an interrupted merge continues with the steps left. Returns the
+	bytes of temp files read and written before and after compression and
+	the runs left for every axis. """
+	
+	fanin = merge_fanin(job.memcap, job.workers, job.codec, job.width)
+	slots = min(job.workers, 3)
+	
+	# runs of every axis as (path, number of records, merge level)
+	runs = { dim:[ (entry['files'][dim], entry['count'], 0)
+		for entry in manifest['chunks'] ] for dim in [XDIM,YDIM,ZDIM] }
+	done = set()
+	
+	# replay the merge steps of an interrupted run
+	for step in manifest['merges']:
+		dim = step['dim']
+		runs[dim] = [ run for run in runs[dim] if run[0] not in step['inputs'] ]
+		for path in step['inputs']:
+			if os.path.exists(path):
+				os.unlink(path)
+		if step['final']:
+			done.add(dim)
+		else:
+			runs[dim].append((step['output'], step['count'], step['level']))
+	
+	for dim in [XDIM,YDIM,ZDIM]:
+		if dim in done:
+			valid = valid_list(out_paths[dim], nelems, job.width)
+			damaged = out_paths[dim]
+		else:
+			invalid = [ run[0] for run in runs[dim]
+				if not run_complete(run[0], run[1], job.codec) ]
+			valid = not invalid
+			damaged = invalid[0] if invalid else None
+		if not valid:
+			raise IOError("%s is missing or incomplete, the sort has to be "
+				%damaged+"started again without resuming")
+	job.scratch.clean([ job.manifest_path ]+[ run[0] for dim in runs
+		for run in runs[dim] ])
+	
+	number  = max([ step['number'] for step in manifest['merges'] ]+[-1]) + 1
+	pending = {}
+	spilled = [ 0, 0 ]
+	
+	while len(done) < 3:
 		
-		if __debug__:
-			time_end = time.time()
-			log(O+" {:6.3f}s\n".format(time_end-time_start))
-			
-		# create chunk file
-		chunk = open("tmp/%s_chunk%d.bin"%(dim,FILE_CTR),'wb+')
+		# start the next merge steps of every axis
+		for dim in [XDIM,YDIM,ZDIM]:
+			while len(pending) < slots and dim not in done:
+				busy = [ step for step in pending.values() if step['dim'] == dim ]
+				group, final = next_merge_group(runs[dim], busy, fanin)
+				if group is None:
+					break
+				if final and out_paths is None:
+					# the runs left are merged by the index streams
+					done.add(dim)
+					break
+				step = { 'dim':dim, 'number':number,
+					'inputs':[ run[0] for run in group ],
+					'count':sum(run[1] for run in group),
+					'level':max([ run[2] for run in group ]+[0]) + 1,
+					'final':final }
+				step['output'] = out_paths[dim] if final else \
+					job.scratch.path("%s_merge%d.bin"%(dim,number), number)
+				number += 1
+				runs[dim] = [ run for run in runs[dim] if run not in group ]
+				spilled[0] += sum(run_bytes(run[1], job.width) for run in group)
+				read = sum(os.path.getsize(run[0]) for run in group)
+				spilled[1] += read
+				job.metrics.add(bytes_read=read)
+				if __debug__:
+					log("\rmerge %d runs into %s%s\n"%(len(group),
+						DIM_COLOR[dim],step['output']))
+				block = merge_block(job.memcap, job.workers, max(len(group),1),
+					job.codec, job.width)
+				merge = pool.submit(merge_runs, step['inputs'], dim,
+					step['output'], block, final, job.codec, job.width)
+				pending[merge] = step
+				if final:
+					break
 		
-		if __debug__:
-			log("write data to %s%s\t"%(DIM_COLOR[dim],chunk.name))
-			time_start = time.time()
-			
-		# write number of elements
-		chunk.write(np.uint32(len(points)))
-		
-		# write sorted index list including point data
-		for p in points:
-			chunk.write(np.uint32(p[3]))
-			chunk.write(np.float32(p[0]))
-			chunk.write(np.float32(p[1]))
-			chunk.write(np.float32(p[2]))
-			
-		if __debug__:
-			time_end = time.time()
-			log(O+" {:6.3f}s\n".format(time_end-time_start))
-			
-		# append chunk to merge sort queue
-		MERGE_QUEUES[dim].put(chunk.name)
-		chunk.close()
-		del chunk
-		
-	del points
-	FILE_CTR += 1
-		
-
-""" Worker thread to start new Merger() 
-as long as there are more than one chunk in queue """		
-class QueueHandler(threading.Thread):
-
-	def __init__(self,dim):
-		super(QueueHandler,self).__init__()
-		self.daemon = True
-		self.dim 	= dim
-		self.ctr 	= FILE_CTR
-		self.st_ctr = 0
-	
-	def run(self):
-	
-		result_queue = queue.Queue()
-		
-		while True:
-			while MERGE_QUEUES[self.dim].qsize() > 2:
-				a = MERGE_QUEUES[self.dim].get() 
-				b = MERGE_QUEUES[self.dim].get()
-				merge_res = open("tmp/%s_chunk%d.bin"%(self.dim,self.ctr), 'wb+')
-				self.ctr += 1
-				st = Merger(a,b,self.dim,merge_res,result_queue)
-				st.name = merge_res.name
-				st.start()
-				self.st_ctr += 1
-			if self.st_ctr > 0:
-				# wait for the next subthread to post a merge result into queue
-				merge_res_name = result_queue.get(block=True)
-				self.st_ctr -= 1
-				MERGE_QUEUES[self.dim].put(merge_res_name)
+		finished, _ = concurrent.futures.wait(pending, timeout=1,
+			return_when=concurrent.futures.FIRST_COMPLETED)
+		
+		for merge in finished:
+			size = merge.result()
+			step = pending.pop(merge)
+			job.metrics.add(merge_steps=1, bytes_written=size)
+			job.metrics.maximum(merge_passes=step['level'])
+			if not step['final']:
+				spilled[0] += run_bytes(step['count'], job.width)
+				spilled[1] += size
 			else:
-				# no more open subthreads. Merge last two chunks.
-				a = MERGE_QUEUES[self.dim].get()
-				b = MERGE_QUEUES[self.dim].get()
-				merge_res = open(sys.argv[1][:-4]+'_%s.bin'%self.dim, 'wb+')
-				st = Merger(a,b,self.dim,merge_res,result_queue)
-				st.name = merge_res.name
-				st.start()
-				st.join()
-				break
+				job.metrics.add(indices=step['count'])
+			manifest['merges'].append(step)
+			save_manifest(job.manifest_path, manifest)
+			for path in step['inputs']:
+				os.unlink(path)
+			if step['final']:
+				done.add(step['dim'])
+			else:
+				runs[step['dim']].append((step['output'], step['count'],
+					step['level']))
+		
+		# print progress of the merges
+		if __debug__:
+			log("\r")
+			for dim in [XDIM,YDIM,ZDIM]:
+				busy = [ step for step in pending.values() if step['dim'] == dim ]
+				if dim in done:
+					log(DIM_COLOR[dim]+"{} done ".format(dim))
+				elif any(step['final'] for step in busy):
+					# progress is read from the size of the output file
+					written = 0
+					if os.path.exists(out_paths[dim]):
+						written = max(os.path.getsize(out_paths[dim])
+							-HEADER_DTYPE.itemsize, 0) // job.width
+					log(DIM_COLOR[dim]+"{} {: >5.1f}% ".format(dim,
+						written/max(nelems,1)*100))
+				else:
+					log(DIM_COLOR[dim]+"{} {} runs ".format(dim,
+						len(runs[dim])+len(busy)))
+	if __debug__:
+		log("\n\n")
+	return spilled, runs
 
 
-""" Worker thread that combines two chunks into one """				
-class Merger( threading.Thread):
+def next_merge_group(runs, busy, fanin):
+	""" Choose the runs merged in the next step of one axis out of the
+	runs not being merged, with the steps in busy still running. Returns
+	the runs and whether the step writes the final index list, or None if
+	the step has to wait for running steps. The runs of the lowest merge
+	level are merged in groups of fanin, so the number of passes is the
+	same as for merging level by level. """
+	
+	while True:
+		if not busy and len(runs) <= fanin:
+			return runs, True
+		level = min([ run[2] for run in runs ]
+			+[ step['level']-1 for step in busy ])
+		group = [ run for run in runs if run[2] == level ]
+		if len(group) > 1:
+			return group[:fanin], False
+		if not group or any(step['level']-1 == level for step in busy):
+			return None, False
+		# a single run left on its level moves to the next level unmerged
+		runs[runs.index(group[0])] = (group[0][0], group[0][1], level+1)
 
-	def __init__( self, a, b, dim, merge_res, result_queue):
-		super( Merger,self).__init__()
-		self.a = open( a, 'rb')
-		self.b = open( b, 'rb')
-		self.dim = dim
-		# file to write the merge result to
-		self.merge_res = merge_res
-		# used to hand over the finished merge file to parent process
-		self.result_queue = result_queue
-		if __debug__:
-			self.points_written = 0
-	
-	def run( self):		
-		# store sum of to be merged elements at the beginning of chunk_c
-		size_a = np.frombuffer( self.a.read(4), dtype = np.uint32)[0]
-		size_b = np.frombuffer( self.b.read(4), dtype = np.uint32)[0]
-		size_c = size_a + size_b
-		self.merge_res.write( np.uint32( size_c))
-		# now all file pointer are exactly behind the number of elements
-
-		# load the first two indices as buffer objects
-		# those objects have size 0 when end of file is reached
-		index_a = np.frombuffer( self.a.read(4), dtype = np.uint32)
-		index_b = np.frombuffer( self.b.read(4), dtype = np.uint32)
-		
-		self.a.seek( BYTE_OFFSET[self.dim], 1)
-		self.b.seek( BYTE_OFFSET[self.dim], 1)
-
-		point_a = np.frombuffer( self.a.read(4), dtype = np.float32)
-		point_b = np.frombuffer( self.b.read(4), dtype = np.float32)
-		# move to next index position
-		self.a.seek( 8-BYTE_OFFSET[self.dim], 1)
-		self.b.seek( 8-BYTE_OFFSET[self.dim], 1)
-
-		while index_a.size > 0 and index_b.size > 0:
-			
-			if point_a[0] <= point_b[0]:
-				# write index_a to chunk_c
-				self.merge_res.write( index_a[0])
-				if not self.i_only: self.merge_res.write( point_a[0])
-				# load next index_a
-				index_a = np.frombuffer( self.a.read(4), dtype = np.uint32)
-				self.a.seek( BYTE_OFFSET[self.dim], 1)
-				point_a = np.frombuffer( self.a.read(4), dtype = np.float32)
-				# move to next index position
-				self.a.seek( 8-BYTE_OFFSET[self.dim], 1)
-			else:
-				# write index_b to chunk_c
-				self.merge_res.write( index_b[0])
-				if not self.i_only: self.merge_res.write( point_b[0])
-				# load next index_b
-				index_b = np.frombuffer( self.b.read(4), dtype = np.uint32)
-				self.b.seek( BYTE_OFFSET[self.dim], 1)
-				point_b = np.frombuffer( self.b.read(4), dtype = np.float32)
-				# move to next index position
-				self.b.seek( 8-BYTE_OFFSET[self.dim], 1)
-
-			if __debug__:
-				self.points_written += 1
-				MERGE_PROGRESS[self.dim][self.name] = self.points_written / size_c
-		
-		# continue to write remaining indices for either chunk_a or _b
-		while index_a.size > 0:
-			self.merge_res.write(index_a[0])
-			if not self.i_only: self.merge_res.write(point_a[0])
-			index_a = np.frombuffer(self.a.read(4), dtype = np.uint32)
-			self.a.seek(BYTE_OFFSET[self.dim],1)
-			point_a = np.frombuffer(self.a.read(4), dtype = np.float32)
-			# move to next index position
-			self.a.seek(8-BYTE_OFFSET[self.dim],1)
-
-			if __debug__:
-				self.points_written += 1
-				MERGE_PROGRESS[self.dim][self.name] = self.points_written / size_c
-				
-		while index_b.size > 0:
-			self.merge_res.write(index_b[0])
-			if not self.i_only: self.merge_res.write(point_b[0])
-			index_b = np.frombuffer(self.b.read(4), dtype = np.uint32)
-			self.b.seek(BYTE_OFFSET[self.dim],1)
-			point_b = np.frombuffer(self.b.read(4), dtype = np.float32)
-			# move to next index position
-			self.b.seek(8-BYTE_OFFSET[self.dim],1)
-
-			if __debug__:
-				self.points_written += 1
-				MERGE_PROGRESS[self.dim][self.name] = self.points_written / size_c
-			
-		self.a.close() ; self.b.close()
-		os.unlink(self.a.name) ; os.unlink(self.b.name)
-		del self.a ; del self.b
+
+def merge_block(memcap, workers, nruns, codec=NO_CODEC, width=4):
+	# number of records read from each of nruns chunks at once
+	compress, decompress = codec_memory(codec)
+	budget = max(memory_budget(memcap, workers), 0) // min(workers,3) \
+		- compress
+	block = (budget // nruns - frame_bytes(codec, width) - decompress) \
+		// merge_bytes(width)
+	return int(min(max(block, MIN_MERGE_BLOCK), BLOCK_POINTS))
+
+
+def merge_runs(run_files, dim, out_path, block_points, indices_only,
+	codec=NO_CODEC, width=4):
+	""" Worker job merging sorted chunk files into out_path, which holds
+	only the indices if indices_only is set. Runs are compressed with
+	codec, the final index list is not. Indices are written with width
+	bytes. Returns the size of the output file. """
+	
+	runs = [ RunReader(path, codec) for path in run_files ]
+	total = sum(run.count for run in runs)
+	
+	if indices_only:
+		merge_res = open(out_path,'wb')
+		write_header(merge_res, MAGIC_LIST, total, width)
+	else:
+		merge_res = RunWriter(out_path, total, codec, width)
+	
+	written = 0
+	for merged in merge_blocks(runs, block_points):
+		if indices_only:
+			merged['I'].astype(index_dtype(width)).tofile(merge_res)
+		else:
+			merge_res.write(merged)
+		written += len(merged)
+	
+	if indices_only:
+		sync_output(merge_res)
+		size = merge_res.tell()
+		merge_res.close()
+	else:
+		size = merge_res.close()
+	for run in runs:
+		run.close()
+	
+	if written != total:
+		raise IOError("merged %d of %d records into %s"%(written,total,out_path))
+	return size
+
+
+def merge_blocks(runs, block_points):
+	""" Generator of the k-way merge of sorted runs. Every run is read in
+	blocks of block_points (index, key) records. A heap keeps the runs
+	ordered by the last record of their buffered block: all buffered
+	records up to the smallest of these can be yielded, as no unread
+	record can precede them. Records are ordered by their key and by index
+	for equal values, which keeps the order of a stable sort over all
+	points. Keys are compared as their order preserving bits, so NaNs
+	follow +inf like in the sorted chunks. """
+	
+	def fill(r):
+		buffers[r] = runs[r].read(block_points)
+		bits[r] = sort_keys(buffers[r]['K'])
+		if len(buffers[r]) > 0:
+			heapq.heappush(heap, (int(bits[r][-1]),
+				int(buffers[r]['I'][-1]), r))
+	
+	buffers = [None] * len(runs)
+	bits 	= [None] * len(runs)
+	heap 	= []
+	for r in range(len(runs)):
+		fill(r)
+	
+	while heap:
+		key, index, r = heapq.heappop(heap)
 		
-		if __debug__: del MERGE_PROGRESS[self.dim][self.name]
+		# take all buffered records up to (key, index) from every run
+		parts = []
+		part_bits = []
+		for j, buffer in enumerate(buffers):
+			if len(buffer) == 0:
+				continue
+			keys = bits[j]
+			lo = np.searchsorted(keys, key, 'left')
+			hi = np.searchsorted(keys, key, 'right')
+			n = lo + np.searchsorted(buffer['I'][lo:hi], index, 'right')
+			if n > 0:
+				parts.append(buffer[:n])
+				part_bits.append(keys[:n])
+				buffers[j] = buffer[n:]
+				bits[j] = keys[n:]
 		
-		self.merge_res.close()
-		if not self.i_only: self.result_queue.put(self.merge_res.name)
-		del self.merge_res
-
+		if len(parts) > 1:
+			merged = np.concatenate(parts)
+			merged = merged[np.lexsort((merged['I'], np.concatenate(part_bits)))]
+		else:
+			merged = parts[0]
+		del parts, part_bits
 		
-""" Worker thread for handling output to console """	
-class Logger(threading.Thread):
+		yield merged
+		del merged
+		
+		# the buffer of run r is empty now
+		fill(r)
+
 
-	def __init__(self):
-		super(Logger,self).__init__()
-		self.daemon = True
-		self.stop_event = threading.Event()
-		self.last_line = ""
+""" Iterator over the sorted indices of one axis in blocks of the index
+type of the sort (dtype), which is uint64 if the points require 64 bit
+indices and uint32 otherwise, like the index lists. The runs left by
+the sort are merged on the fly, which replaces the last merge pass
+writing the index list. The run files are removed once the stream is
+exhausted or closed. """
+class IndexStream:
+
+	def __init__(self, dim, run_files, count, block_points, codec, width=4,
+		on_close=None):
+		self.dim		  = dim
+		self.run_files	  = list(run_files)
+		self.count		  = count
+		self.dtype		  = index_dtype(width)
+		self.block_points = block_points
+		self.codec		  = codec
+		self.on_close	  = on_close
+		self.closed		  = False
+	
+	def __len__(self):
+		return self.count
+	
+	def __iter__(self):
+		if self.closed:
+			raise IOError("index stream of axis %s is closed"%self.dim)
+		runs = [ RunReader(path, self.codec) for path in self.run_files ]
+		written = 0
+		try:
+			for merged in merge_blocks(runs, self.block_points):
+				written += len(merged)
+				yield np.ascontiguousarray(merged['I'])
+		finally:
+			for run in runs:
+				run.close()
+		if written != self.count:
+			raise IOError("merged %d of %d indices of axis %s"%(written,
+				self.count,self.dim))
+		self.close()
 	
-	def run(self):
-		global LOG_QUEUE
-		while True:
-			line = LOG_QUEUE.get(block=True)
-			if line != self.last_line:
-				sys.stdout.write(line+W)
-				sys.stdout.flush()
-				self.last_line = line
-			LOG_QUEUE.task_done()
+	def close(self):
+		# remove the runs, also if the stream wasn't read to the end
+		if not self.closed:
+			self.closed = True
+			for path in self.run_files:
+				os.unlink(path)
+			if self.on_close:
+				self.on_close(self.dim)
 
 
-def log(message):
-	global LOG_QUEUE
-	try:
-		LOG_QUEUE.put_nowait(message)
-	except queue.Full:
-		pass
+def open_streams(job, runs, nelems):
+	""" Index streams of all axes over the runs left by merge_chunks().
+	The manifest and the work directories are removed once all streams
+	are closed. """
+	
+	scratch, manifest_path = job.scratch, job.manifest_path
+	closed = set()
+	
+	def on_close(dim):
+		closed.add(dim)
+		if len(closed) == 3:
+			os.unlink(manifest_path)
+			for file in scratch.remove():
+				print(R+"%s wasn't properly removed from the scratch "%file
+					+"directory\n")
+	
+	streams = {}
+	for dim in [XDIM,YDIM,ZDIM]:
+		if nelems > 0 and not runs[dim]:
+			raise IOError("the index list of axis %s was written by the "%dim
+				+"interrupted sort, resume it without streams")
+		streams[dim] = IndexStream(dim, [ run[0] for run in runs[dim] ],
+			nelems, merge_block(job.memcap, job.workers, max(len(runs[dim]),1),
+			job.codec, job.width), job.codec, job.width, on_close)
+	return streams
+
 
+def sort_ply(ply_path, memcap=2*GB_IN_B, workers=3, scratch_dirs=[ "." ],
+	codec=NO_CODEC, sorter=ARGSORT, resume=False, write_lists=True,
+	output=None, metrics=None, ingest=MMAP, keep_failed=True):
+	""" Sort the PLY file at ply_path, or the PLY files of a list of paths
+	into one dataset, like the command line does, with the memory cap in
+	bytes. Every call works on its own SortJob and worker
+	pool, so files can be sorted concurrently from the threads of one
+	process, as long as their outputs and scratch directories differ.
+	Returns a dict of the paths of the point data ('data'), attribute
+	files ('attributes') and index lists ('lists'), and the metrics of the
+	split and merge stages ('metrics'). Without write_lists, 'lists' is
+	None and 'streams' holds an IndexStream per axis. Without keep_failed,
+	a failed sort is cleaned up instead of being kept to be resumed. """
 	
-if __name__ == '__main__':
+	job = SortJob(ply_path, memcap, workers, scratch_dirs, codec, sorter,
+		output, metrics, ingest)
+	outputs = main(job, resume, write_lists, keep_failed)
+	outputs['metrics'] = job.metrics.snapshot('done')
+	return outputs
 
-	if __debug__:
-		my_logger = Logger()
-		my_logger.start()
+
+def sort_streams(ply_path, memcap=2*GB_IN_B, workers=3, scratch_dirs=[ "." ],
+	codec=NO_CODEC, sorter=ARGSORT, resume=False, output=None, metrics=None,
+	ingest=MMAP, keep_failed=True):
+	""" Sort the PLY file at ply_path without writing the index lists,
+	with the options of sort_ply(). Returns an IndexStream per axis, which
+	yields the indices sorted by that axis in blocks. The point data and
+	attributes are written as usual. """
+	
+	return sort_ply(ply_path, memcap, workers, scratch_dirs, codec, sorter,
+		resume, False, output, metrics, ingest, keep_failed)['streams']
+
+
+if __name__ == '__main__':
 
 	# initiate argument parser
 	# ------------------------
@@ -489,9 +1685,32 @@ if __name__ == '__main__':
 	# add arguments to the parser
 	# ---------------------------
 	parser.add_argument("-i","--input",
-		help="input PLY-file")
-	parser.add_argument("-m","--memcap", type=int, default=2,
+		help="input PLY-file, or a directory or glob pattern of PLY files sorted into one dataset")
+	parser.add_argument("-o","--output",
+		help="path prefix of the output files (default: input without extension)")
+	parser.add_argument("-m","--memcap", type=float, default=2,
 		help="maximum amount of system RAM to be used in GB")
+	parser.add_argument("-w","--workers", type=int, default=3,
+		help="number of worker processes sorting and merging the chunks")
+	parser.add_argument("--dryrun", action='store_true',
+		help="only print the number of chunks and merge passes")
+	parser.add_argument("--resume", action='store_true',
+		help="continue the latest interrupted sort of the input file")
+	parser.add_argument("-s","--scratch", nargs='+', default=[ "." ],
+		help="directories for temp files, which are striped across them")
+	parser.add_argument("-c","--compress", default=NO_CODEC[0],
+		choices=[ NO_CODEC[0] ]+sorted(CODECS),
+		help="codec compressing the chunk and merge files")
+	parser.add_argument("-l","--level", type=int,
+		help="compression level of the codec")
+	parser.add_argument("--sort", default=ARGSORT, choices=[ ARGSORT, RADIX ],
+		help="algorithm sorting the chunks, radix is faster but needs more memory")
+	parser.add_argument("--ingest", default=MMAP, choices=[ MMAP, READ ],
+		help="mmap sorts binary PLY files straight from the mapped files, read copies them in blocks")
+	parser.add_argument("--metrics",
+		help="JSON file the metrics of every stage are written to")
+	parser.add_argument("--status", type=float, default=0,
+		help="seconds between status lines of the metrics on stderr")
 		
 	# read arguments from command line
 	# --------------------------------
@@ -499,8 +1718,16 @@ if __name__ == '__main__':
 	
 	if args.input and args.memcap:
 		
-		PLY_PATH = args.input;
-		MEMORY_CAP = int(args.memcap)*GB_IN_B
+		job = SortJob(ply_inputs(args.input), args.memcap*GB_IN_B,
+			args.workers, args.scratch, codec_of(args.compress, args.level),
+			args.sort, args.output, ingest=args.ingest)
+		job.metrics = Metrics(args.metrics, args.status,
+			script="ooc_point_sorting", input=os.path.abspath(args.input),
+			memcap=job.memcap, workers=job.workers)
+		
+		if args.dryrun:
+			dry_run(job)
+			sys.exit(0)
 		
 		if __debug__:
 			log(O+"{0}\n START OOC-POINT-SORTING\n{0}\n".format('-'*25))
@@ -508,7 +1735,12 @@ if __name__ == '__main__':
 		# start main function
 		# -------------------
 		main_tstart = time.time()
-		main()
+		try:
+			main(job, resume=args.resume)
+		except BaseException:
+			job.metrics.close('failed')
+			raise
+		job.metrics.close()
 		main_tend = time.time()
 
 		if __debug__:
@@ -516,7 +1748,7 @@ if __name__ == '__main__':
 			log(O+"{0}\nTime total: {1:6.3f} min\n\n".format('-'*19,
 				(main_tend-main_tstart)/MIN_IN_S))
 				# stop Logger thread
-			LOG_QUEUE.join()
+			flush_log()
 		else:
 			print(O+"{0}\nTime total: {1:6.3f} min\n\n".format('-'*19,
 				(main_tend-main_tstart)/MIN_IN_S))
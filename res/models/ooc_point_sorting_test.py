@@ -8,12 +8,165 @@ Nils Harbke
 HAW Hamburg
 """
 
+import os
 import numpy as np 	# adds more control over binary size of variables
 
+import ooc_point_sorting
+from fileformat import MAGIC_LIST, MAGIC_RUN, read_header, index_dtype, \
+	open_list
+from radix import radix_argsort
+from spill import RUN_DTYPES, CODECS, NO_CODEC, RunWriter, RunReader, \
+	codec_of, run_complete
+from benchmark.point_cloud import write_ply
+
 DIM_X, DIM_Y, DIM_Z = 0,1,2
 P_OFFSET = 12 # bytes
 DEBUG = False
 
+# points and memory cap of the sorts of the automated checks
+TEST_POINTS = 5000
+TEST_MEMCAP = 300*10**6
+
+
+def sort_test_ply(tmp_path, name, **options):
+	# sort a synthetic PLY file into tmp_path, returns the outputs
+	ply_path = str(tmp_path / "cloud.ply")
+	if not os.path.exists(ply_path):
+		write_ply(ply_path, TEST_POINTS)
+	scratch = tmp_path / ("scratch_"+name)
+	scratch.mkdir(exist_ok=True)
+	options.setdefault('output', str(tmp_path / name))
+	return ooc_point_sorting.sort_ply(ply_path, TEST_MEMCAP, 1,
+		[ str(scratch) ], **options)
+
+
+def read_lists(outputs):
+	# index lists of all axes of a sort
+	return { dim:np.array(open_list(path))
+		for dim, path in outputs['lists'].items() }
+
+
+def test_radix_argsort_matches_stable_argsort():
+	keys = np.random.default_rng(0).normal(size=10000).astype(np.float32)
+	# duplicates, signed zeros and infinities keep their order
+	keys[::7] = keys[3]
+	keys[1:100:9] = -0.0
+	keys[2:100:9] = 0.0
+	keys[5], keys[6] = np.inf, -np.inf
+	assert (radix_argsort(keys) == np.argsort(keys, kind='stable')).all()
+
+
+def test_radix_sort_matches_argsort_sort(tmp_path):
+	argsort = read_lists(sort_test_ply(tmp_path, "argsort",
+		sorter=ooc_point_sorting.ARGSORT))
+	radix = read_lists(sort_test_ply(tmp_path, "radix",
+		sorter=ooc_point_sorting.RADIX))
+	data = np.fromfile(str(tmp_path / "argsort_DATA.bin"), dtype='<f4')
+	for axis, dim in enumerate(sorted(argsort)):
+		assert (argsort[dim] == radix[dim]).all()
+		keys = data[axis::3][argsort[dim]]
+		assert (np.diff(keys) >= 0).all()
+		assert (np.sort(argsort[dim]) == np.arange(TEST_POINTS)).all()
+
+
+def test_codecs_round_trip(tmp_path):
+	for width in RUN_DTYPES:
+		records = np.empty(100000, dtype=RUN_DTYPES[width])
+		records['K'] = np.sort(np.random.default_rng(width).normal(
+			size=len(records)).astype(np.float32))
+		records['I'] = np.random.default_rng(width).permutation(len(records))
+		for codec in [ NO_CODEC ]+[ codec_of(name) for name in CODECS ]:
+			path = str(tmp_path / ("run_%s_%d.bin"%(codec[0],width)))
+			writer = RunWriter(path, len(records), codec, width)
+			# blocks not aligned with the frames of compressed runs
+			for first in range(0, len(records), 30000):
+				writer.write(records[first:first+30000])
+			writer.close()
+			assert run_complete(path, len(records), codec)
+			reader = RunReader(path, codec)
+			assert reader.width == width
+			read = np.concatenate([ reader.read(25000) for _ in range(5) ])
+			reader.close()
+			assert (read == records).all()
+
+
+def test_compressed_sort_matches_plain_sort(tmp_path):
+	plain = read_lists(sort_test_ply(tmp_path, "plain"))
+	for name in CODECS:
+		compressed = read_lists(sort_test_ply(tmp_path, name,
+			codec=codec_of(name)))
+		for dim in plain:
+			assert (plain[dim] == compressed[dim]).all()
+
+
+def test_resume_from_manifest(tmp_path, monkeypatch):
+	complete = read_lists(sort_test_ply(tmp_path, "complete"))
+	
+	def interrupt(*args, **kwargs):
+		raise RuntimeError("interrupted")
+	
+	# the split is recorded in the manifest, so the failed sort is kept
+	with monkeypatch.context() as patch:
+		patch.setattr(ooc_point_sorting, 'merge_chunks', interrupt)
+		try:
+			sort_test_ply(tmp_path, "resumed", codec=codec_of('zlib'))
+		except RuntimeError:
+			pass
+		else:
+			raise AssertionError("the sort wasn't interrupted")
+	work_dirs = os.listdir(str(tmp_path / "scratch_resumed"))
+	assert len(work_dirs) == 1
+	assert ooc_point_sorting.MANIFEST_NAME in os.listdir(str(tmp_path
+		/ "scratch_resumed" / work_dirs[0]))
+	
+	# the resumed sort takes the codec from the manifest
+	resumed = read_lists(sort_test_ply(tmp_path, "resumed", resume=True))
+	for dim in complete:
+		assert (complete[dim] == resumed[dim]).all()
+	assert os.listdir(str(tmp_path / "scratch_resumed")) == []
+
+
+def test_rejected_sort_leaves_no_manifest(tmp_path):
+	write_ply(str(tmp_path / "cloud.ply"), TEST_POINTS)
+	scratch = tmp_path / "scratch"
+	scratch.mkdir()
+	try:
+		ooc_point_sorting.sort_ply(str(tmp_path / "cloud.ply"), 10**6, 1,
+			[ str(scratch) ])
+	except ValueError:
+		pass
+	else:
+		raise AssertionError("a memory cap of 1 MB was accepted")
+	assert os.listdir(str(scratch)) == []
+
+
+def test_merge_of_chunks_with_nans(tmp_path, monkeypatch):
+	ply_path = str(tmp_path / "cloud.ply")
+	size = write_ply(ply_path, TEST_POINTS)
+	vertices = np.memmap(ply_path, dtype='<f4', mode='r+',
+		offset=size-12*TEST_POINTS, shape=(TEST_POINTS,3))
+	vertices[::97,DIM_X] = np.nan
+	vertices[5::101,DIM_Y] = np.nan
+	vertices[::5,DIM_Z] = vertices[0,DIM_Z]
+	vertices.flush()
+	del vertices
+	
+	# several runs per axis, each ending with NaNs
+	plan_chunks = ooc_point_sorting.plan_chunks
+	def small_chunks(header, *args, **kwargs):
+		plan = plan_chunks(header, *args, **kwargs)
+		plan['capacity'] = TEST_POINTS//5 + 1
+		plan['chunks'] = 5
+		return plan
+	monkeypatch.setattr(ooc_point_sorting, 'plan_chunks', small_chunks)
+	
+	for name in ooc_point_sorting.ARGSORT, ooc_point_sorting.RADIX:
+		lists = read_lists(sort_test_ply(tmp_path, name, sorter=name))
+		data = np.fromfile(str(tmp_path / (name+"_DATA.bin")), dtype='<f4')
+		for axis, dim in enumerate(sorted(lists)):
+			assert (lists[dim] == np.argsort(data[axis::3],
+				kind='stable')).all()
+
 if __name__ == '__main__':
 
 	points = open("points.bin",'rb')
@@ -21,37 +174,38 @@ if __name__ == '__main__':
 	y_sort = open("y_sort.bin",'rb')
 	z_sort = open("z_sort.bin",'rb')
 	
-	size_x = np.frombuffer(x_sort.read(4), dtype = np.uint32)[0]
-	size_y = np.frombuffer(y_sort.read(4), dtype = np.uint32)[0]
-	size_z = np.frombuffer(z_sort.read(4), dtype = np.uint32)[0]
+	size_x, width_x, _ = read_header(x_sort, MAGIC_LIST)
+	size_y, width_y, _ = read_header(y_sort, MAGIC_LIST)
+	size_z, width_z, _ = read_header(z_sort, MAGIC_LIST)
 	
 	print("Check x_sort.bin")
-	idx = np.frombuffer(x_sort.read(4), dtype = np.uint32)
+	idx = np.frombuffer(x_sort.read(width_x), dtype = index_dtype(width_x))
 	val = 0
 	while idx.size > 0:
-		val += idx[0]
-		idx = np.frombuffer(x_sort.read(4), dtype = np.uint32)
+		val += int(idx[0])
+		idx = np.frombuffer(x_sort.read(width_x), dtype = index_dtype(width_x))
 	print("> Sum index %d"%val)
 	
 	val = 0
-	for i in range(35947):
-		val += np.uint32(i)
+	for i in range(size_x):
+		val += i
 	print("> Check val = %d"%val)
 	
 	print("Check 0_chunk_0.bin")
 	test = open("0_chunk_0.bin", 'rb')
-	test_size = np.frombuffer(test.read(4), dtype = np.uint32)[0]
-	idx = np.frombuffer(test.read(4), dtype = np.uint32)
+	test_size, test_width, _ = read_header(test, MAGIC_RUN)
+	record = np.dtype([ ('I',index_dtype(test_width)), ('K','<f4') ])
+	idx = np.frombuffer(test.read(record.itemsize), dtype = record)
 	val = 0
 	while idx.size > 0:
-		val += idx[0]
-		idx = np.frombuffer(test.read(4), dtype = np.uint32)
+		val += int(idx[0]['I'])
+		idx = np.frombuffer(test.read(record.itemsize), dtype = record)
 	print("> Sum index %d"%val)
 	test.close()
 	
 	val = 0
-	for i in range(30000):
-		val += np.uint32(i)
+	for i in range(test_size):
+		val += i
 	print("> Check val = %d"%val)	
 	
 	x_sort.close()
@@ -68,14 +222,14 @@ if __name__ == '__main__':
 
 	def test_sorted_list(dim):
 		with open(PLY_PATH[:-4]+'_%s.bin'%dim, 'rb') as f:
-			f_nelems = np.frombuffer(f.read(4), dtype=np.uint32)[0]
+			f_nelems, f_width, _ = read_header(f, MAGIC_LIST)
 			if f_nelems != nelems:
 				log(R+"\nWrong number of elements given! "
 					+"Expected %d but was %d.\n"%(nelems,f_nelems))
 			#last_point = np.float32('-Infinity')
 			for i in range(f_nelems):
 					# read index
-				index = np.frombuffer(f.read(4), dtype=np.uint32)
+				index = np.frombuffer(f.read(f_width), dtype=index_dtype(f_width))
 				if index.size <= 0:
 					log(R+"Point sorting failure! Not enough elements.")
 					break
@@ -0,0 +1,78 @@
+# bin/include/python3.7
+
+"""
+Bachelor Thesis
+Nils Harbke
+> Optimized Out-of-Core Rendering for Interactive
+> Presentation of Large Point Clouds
+HAW Hamburg
+
+"""
+
+import numpy as np
+
+# bits of the digit sorted by one radix pass
+RADIX_BITS = 16
+
+# number of keys converted at once, which bounds the temporary arrays
+RADIX_BATCH = 2**20
+
+# quiet NaN every NaN is mapped to, sorting behind +inf like in argsort
+CANONICAL_NAN = np.uint32(0x7fc00000)
+
+
+def ordered_bits(keys, out=None):
+	""" Map float32 keys to uint32 of the same order: the sign bit of
+	positive values is set, negative values are inverted. """
+
+	bits = keys.view('<u4') if keys.dtype == np.dtype('<f4') else \
+		keys.astype('<f4').view('<u4')
+	if out is None:
+		out = np.empty(len(bits), dtype=np.uint32)
+	np.copyto(out, np.where(bits >> 31, ~bits, bits | np.uint32(0x80000000)))
+	return out
+
+
+def float_bits(bits):
+	# inverse of ordered_bits()
+	return np.where(bits >> 31, bits & np.uint32(0x7fffffff), ~bits) \
+		.astype('<u4').view('<f4')
+
+
+def sort_keys(keys):
+	""" Order preserving uint32 of float32 keys for sorting. -0.0 sorts
+	as equal to 0.0 and all NaNs as equal behind +inf, as in argsort. """
+
+	bits = np.empty(len(keys), dtype=np.uint32)
+	for first in range(0, len(keys), RADIX_BATCH):
+		with np.errstate(invalid='ignore'):
+			batch = keys[first:first+RADIX_BATCH] + np.float32(0) # -0.0 to 0.0
+		batch[np.isnan(batch)] = CANONICAL_NAN.view('<f4')
+		ordered_bits(batch, bits[first:first+RADIX_BATCH])
+	return bits
+
+
+def radix_argsort(keys):
+	""" Stable argsort of float32 keys by an LSD radix sort. Every pass
+	sorts the indices by one RADIX_BITS digit of the order preserving
+	bits of the keys, least significant digit first, with a stable
+	counting sort (numpy sorts 16 bit integers by radix). Passes over a
+	digit equal for all keys are skipped. The result is identical to
+	np.argsort(keys, kind='stable'). """
+
+	bits  = sort_keys(keys)
+	order = None
+	for shift in range(0, 32, RADIX_BITS):
+		digits = np.empty(len(bits), dtype=np.uint16)
+		for first in range(0, len(bits), RADIX_BATCH):
+			batch = bits[first:first+RADIX_BATCH] if order is None else \
+				bits[order[first:first+RADIX_BATCH]]
+			digits[first:first+RADIX_BATCH] = batch >> shift
+		if len(digits) == 0 or digits.min() == digits.max():
+			continue
+		step = np.argsort(digits, kind='stable')
+		del digits
+		order = step if order is None else order[step]
+	if order is None:
+		order = np.arange(len(bits))
+	return order
@@ -0,0 +1,83 @@
+# bin/include/python3.7
+
+"""
+Bachelor Thesis
+Nils Harbke
+> Optimized Out-of-Core Rendering for Interactive
+> Presentation of Large Point Clouds
+HAW Hamburg
+
+"""
+
+import os
+import tempfile
+
+
+""" Temp files of one run, spread over one or more scratch directories.
+Every run creates its own work directory in each scratch directory, so
+several runs can share them. Files are striped round-robin across the
+scratch directories by a stripe number, which allows to put the temp I/O
+on several devices at once. """
+class ScratchSpace:
+
+	def __init__(self, roots, prefix, dirs=None):
+		self.roots	= [ os.path.abspath(root) for root in roots ]
+		self.prefix = prefix
+		if dirs is None:
+			for root in self.roots:
+				os.makedirs(root, exist_ok=True)
+			dirs = [ tempfile.mkdtemp(prefix=prefix, dir=root)
+				for root in self.roots ]
+		elif len(dirs) != len(self.roots):
+			raise ValueError("%d work directories for %d scratch directories"
+				%(len(dirs),len(self.roots)))
+		for path in dirs:
+			if not os.path.isdir(path):
+				raise IOError("work directory %s doesn't exist"%path)
+		self.dirs	= list(dirs)
+		self.stripe = 0
+
+	@staticmethod
+	def find(roots, prefix):
+		""" Work directories of earlier runs in the first scratch directory,
+		latest first """
+
+		root = os.path.abspath(roots[0])
+		if not os.path.isdir(root):
+			return []
+		dirs = [ os.path.join(root,name) for name in os.listdir(root)
+			if name.startswith(prefix) ]
+		return sorted(( path for path in dirs if os.path.isdir(path) ),
+			key=os.path.getmtime, reverse=True)
+
+	def path(self, name, stripe=None):
+		""" Path of a temp file in the scratch directory of its stripe.
+		Without a stripe, the files take turns. """
+
+		if stripe is None:
+			stripe = self.stripe
+			self.stripe += 1
+		return os.path.join(self.dirs[stripe % len(self.dirs)], name)
+
+	def files(self):
+		# paths of all files in the work directories
+		return [ os.path.join(path,name) for path in self.dirs
+			for name in os.listdir(path) ]
+
+	def clean(self, keep):
+		# remove all files but the ones in keep
+		keep = set(os.path.abspath(path) for path in keep)
+		for path in self.files():
+			if os.path.abspath(path) not in keep:
+				os.unlink(path)
+
+	def remove(self):
+		""" Remove the work directories. Returns the files left in them,
+		which are removed as well. """
+
+		left = self.files()
+		for path in left:
+			os.unlink(path)
+		for path in self.dirs:
+			os.rmdir(path)
+		return left
@@ -0,0 +1,232 @@
+# bin/include/python3.7
+
+"""
+Bachelor Thesis
+Nils Harbke
+> Optimized Out-of-Core Rendering for Interactive
+> Presentation of Large Point Clouds
+HAW Hamburg
+
+"""
+
+import os
+import bz2
+import lzma
+import zlib
+import numpy as np
+
+from radix import ordered_bits, float_bits
+from fileformat import MAGIC_RUN, HEADER_DTYPE, write_header, read_header
+
+# record of the sorted chunk and merge files of one axis, which only
+# keep the index and the coordinate (key) of that axis, by index width
+RUN_DTYPE	 = np.dtype([ ('I','<u4'), ('K','<f4') ])
+RUN_DTYPES	 = { 4:RUN_DTYPE, 8:np.dtype([ ('I','<u8'), ('K','<f4') ]) }
+
+# number of records compressed together in one frame of a compressed run
+FRAME_RECORDS = 2**15
+
+# frame header: number of records and bytes of the compressed payload
+FRAME_DTYPE	 = np.dtype([ ('records','<u4'), ('bytes','<u4') ])
+
+# codecs as (compress(data, level), decompress(data), default level)
+CODECS = {
+	'zlib' : (lambda data, level: zlib.compress(data, level),
+		zlib.decompress, 1),
+	'lzma' : (lambda data, level: lzma.compress(data, preset=level),
+		lzma.decompress, 0),
+	'bz2'  : (lambda data, level: bz2.compress(data, level),
+		bz2.decompress, 1) }
+
+NO_CODEC = ('none', 0)
+
+# resident working memory in MiB of compressing and of decompressing one
+# frame by codec level, measured with frames of FRAME_RECORDS records,
+# which only touch a part of the lzma dictionary; the lzma match finder
+# grows with the preset
+CODEC_MEMORY = {
+	'zlib' : lambda level: (1, 1),
+	'lzma' : lambda level: ((3,5,7,11,12,20,20,36,70,70)[level], 1),
+	'bz2'  : lambda level: (1 + level//4, 1) }
+
+
+def codec_of(name, level=None):
+	""" Codec setting (name, level) of a spill file, using the default
+	level of the codec if level is None """
+
+	if name == NO_CODEC[0]:
+		return NO_CODEC
+	if name not in CODECS:
+		raise ValueError("unknown codec %s"%name)
+	return (name, CODECS[name][2] if level is None else int(level))
+
+
+def codec_memory(codec):
+	""" Bytes of working memory of a compressor and of a decompressor of
+	codec, which are held by every process writing a compressed run and
+	for every compressed run being read """
+
+	if codec == NO_CODEC:
+		return 0, 0
+	compress, decompress = CODEC_MEMORY[codec[0]](codec[1])
+	return compress*2**20, decompress*2**20
+
+
+def encode_frame(records, codec):
+	""" Compress sorted run records. Keys are mapped to unsigned integers
+	of the same order and delta encoded, indices are delta encoded with
+	zigzag encoded signs. The bytes of both are shuffled, so the bytes of
+	equal significance follow each other. """
+
+	keys = np.diff(ordered_bits(records['K']), prepend=np.uint32(0)).astype('<u4')
+
+	unsigned = records['I'].dtype
+	signed	 = np.dtype('<i%d'%unsigned.itemsize)
+	deltas	 = np.diff(records['I'], prepend=unsigned.type(0)).view(signed)
+	indices	 = ((deltas << 1) ^ (deltas >> (8*signed.itemsize-1))).view(unsigned)
+
+	data = b''.join(np.ascontiguousarray(column.view(np.uint8)
+		.reshape(-1,column.itemsize).T).tobytes() for column in (keys, indices))
+	return CODECS[codec[0]][0](data, codec[1])
+
+
+def decode_frame(payload, count, codec, width=4):
+	""" Decompress count run records of index width written by
+	encode_frame() """
+
+	dtype = RUN_DTYPES[width]
+	data = np.frombuffer(CODECS[codec[0]][1](payload), dtype=np.uint8)
+	if len(data) != dtype.itemsize*count:
+		raise IOError("compressed frame holds %d instead of %d bytes"
+			%(len(data),dtype.itemsize*count))
+
+	unsigned = dtype['I']
+	signed	 = np.dtype('<i%d'%width)
+	keys = np.ascontiguousarray(data[:4*count].reshape(4,-1).T).view('<u4').ravel()
+	indices = np.ascontiguousarray(data[4*count:].reshape(width,-1).T) \
+		.view(unsigned).ravel()
+
+	records = np.empty(count, dtype=dtype)
+	records['K'] = float_bits(np.cumsum(keys, dtype=np.uint32))
+	deltas = (indices >> 1).view(signed) ^ -(indices & 1).view(signed)
+	records['I'] = np.cumsum(deltas.view(unsigned), dtype=unsigned)
+	return records
+
+
+""" Writes a run file of count sorted records: the versioned header
+followed by the raw records, or by frames of FRAME_RECORDS compressed
+records if a codec is set. Every frame starts with its number of records
+and the size of its payload. """
+class RunWriter:
+
+	def __init__(self, path, count, codec=NO_CODEC, width=4):
+		self.codec	 = codec
+		self.dtype	 = RUN_DTYPES[width]
+		self.file	 = open(path,'wb')
+		self.pending = []
+		self.buffered = 0
+		write_header(self.file, MAGIC_RUN, count, width)
+
+	def write(self, records):
+		if self.codec == NO_CODEC:
+			records.tofile(self.file)
+			return
+		# collect records until a frame is full
+		self.pending.append(records)
+		self.buffered += len(records)
+		if self.buffered >= FRAME_RECORDS:
+			self.flush_frames(final=False)
+
+	def flush_frames(self, final):
+		if len(self.pending) == 1:
+			records = self.pending[0]
+		else:
+			records = np.concatenate(self.pending) if self.pending else \
+				np.empty(0, dtype=self.dtype)
+		first = 0
+		while len(records)-first >= FRAME_RECORDS or (final
+			and first < len(records)):
+			frame = records[first:first+FRAME_RECORDS]
+			payload = encode_frame(frame, self.codec)
+			header = np.array([ (len(frame), len(payload)) ], dtype=FRAME_DTYPE)
+			self.file.write(header.tobytes())
+			self.file.write(payload)
+			first += len(frame)
+		self.pending = [ records[first:] ]
+		self.buffered = len(records) - first
+
+	def close(self):
+		""" Write the remaining records through to the disk. Returns the
+		size of the file. """
+
+		if self.codec != NO_CODEC:
+			self.flush_frames(final=True)
+		self.file.flush()
+		os.fsync(self.file.fileno())
+		size = self.file.tell()
+		self.file.close()
+		return size
+
+
+""" Reads the records of a run file written by RunWriter in blocks """
+class RunReader:
+
+	def __init__(self, path, codec=NO_CODEC):
+		self.codec	= codec
+		self.file	= open(path,'rb')
+		self.count, self.width, _ = read_header(self.file, MAGIC_RUN)
+		self.dtype	= RUN_DTYPES[self.width]
+		self.frame	= np.empty(0, dtype=self.dtype)
+
+	def read(self, count):
+		# read up to count records, fewer only at the end of the run
+		if self.codec == NO_CODEC:
+			return np.fromfile(self.file, dtype=self.dtype, count=count)
+		parts = []
+		while count > 0:
+			if len(self.frame) == 0:
+				self.frame = self.read_frame()
+				if len(self.frame) == 0:
+					break
+			parts.append(self.frame[:count])
+			self.frame = self.frame[count:]
+			count -= len(parts[-1])
+		if len(parts) == 1:
+			return parts[0]
+		return np.concatenate(parts) if parts else self.frame[:0]
+
+	def read_frame(self):
+		header = np.fromfile(self.file, dtype=FRAME_DTYPE, count=1)
+		if len(header) == 0:
+			return np.empty(0, dtype=self.dtype)
+		payload = self.file.read(int(header['bytes'][0]))
+		return decode_frame(payload, int(header['records'][0]), self.codec,
+			self.width)
+
+	def close(self):
+		self.file.close()
+
+
+def run_complete(path, count, codec=NO_CODEC):
+	""" Check if the run file at path exists and holds all of its count
+	records, walking the frame headers of compressed runs. """
+
+	if not os.path.exists(path):
+		return False
+	size = os.path.getsize(path)
+	if size < HEADER_DTYPE.itemsize:
+		return False
+
+	with open(path,'rb') as file:
+		stored, width, position = read_header(file, MAGIC_RUN)
+		if stored != count:
+			return False
+		if codec == NO_CODEC:
+			return size == position + count*RUN_DTYPES[width].itemsize
+		records = 0
+		while position + FRAME_DTYPE.itemsize <= size:
+			file.seek(position, 0)
+			header = np.fromfile(file, dtype=FRAME_DTYPE, count=1)[0]
+			records += int(header['records'])
+			position += FRAME_DTYPE.itemsize + int(header['bytes'])
+	return position == size and records == count
@@ -3,6 +3,7 @@
 
 #include "FPVConfig.h"
 #include "Camera.h"
+#include "TreeFormat.h"
 
 
 
@@ -13,6 +14,8 @@ class Loader
 private:
 	const float* Data;
 	const float* Tree;
+	TreeHeader Header;
+	const unsigned char* Colors;
 	const float* FBuffer;
 	const float* BBuffer;
 	mutex* FBufferMtx;
@@ -35,10 +38,13 @@ public:
 	Loader::Loader(const float* tree, const float* data,
 		const float* fbuffer, const float* bbuffer,
 		mutex* front_buffer_mtx, mutex* back_buffer_mtx,
-		Camera* camera, int* nbLoadPoints)
+		Camera* camera, int* nbLoadPoints,
+		const unsigned char* colors = nullptr)
 	{
 		Data	= data;
+		Colors	= colors;
 		Tree	= tree;
+		Header	= read_tree_header(tree);
 		FBuffer	= fbuffer;
 		BBuffer = bbuffer;
 		FBufferMtx = front_buffer_mtx;
@@ -53,20 +59,36 @@ public:
 		while (isActive) {
 			// fill front buffer
 			FBufferMtx->lock();
-			ptr = load_kdt((float *) Tree + 3, ptr, 0);
+			ptr = load_kdt((float *) Tree + Header.header_words, ptr, 0);
 			*NumberLoadedPoints = (ptr - FBuffer) / 6;
 			ptr = (float*) BBuffer;
 			FBufferMtx->unlock();
 
 			// fill back buffer
 			BBufferMtx->lock();
-			ptr = load_kdt((float *) Tree + 3, ptr, 0);
+			ptr = load_kdt((float *) Tree + Header.header_words, ptr, 0);
 			*NumberLoadedPoints = (ptr - BBuffer) / 6;
 			ptr = (float*) FBuffer;
 			BBufferMtx->unlock();
 		}
 	}
 
+	// write the color of the point at point_offset behind its position
+	// points are drawn green if no colors are given
+	void load_color(float* buffer_ptr, int64_t point_offset) {
+		if (Colors != nullptr) {
+			// one uchar per channel, so the point offset is also the color offset
+			buffer_ptr[3] = Colors[point_offset] / 255.0f;
+			buffer_ptr[4] = Colors[point_offset + 1] / 255.0f;
+			buffer_ptr[5] = Colors[point_offset + 2] / 255.0f;
+		}
+		else {
+			buffer_ptr[3] = 0.0f;
+			buffer_ptr[4] = 1.0f;
+			buffer_ptr[5] = 0.0f;
+		}
+	}
+
 	float* load_kdt(float* tree_ptr, float* buffer_ptr, int depth) {
 
 		float first_val;
@@ -77,10 +99,10 @@ public:
 			// NODE
 
 			// read node point (sphere center) (same as in oview function)
+			int64_t point_offset;
 			{
 				// load point into buffer
-				int point_offset;
-				memcpy(&point_offset, (tree_ptr + 1), sizeof(int));
+				point_offset = read_index(tree_ptr + 1, Header.index_words);
 				memcpy(buffer_ptr, (Data + point_offset), sizeof(float) * 3);
 			}
 			glm::vec3 point_scaled = transformation_matrix * glm::vec4(buffer_ptr[0], buffer_ptr[1], buffer_ptr[2], 1.0f);
@@ -124,12 +146,9 @@ public:
 			if (depth < 14) //max_depth
 			{
 				// progress further into recursion
-				int l_off, r_off;
-				memcpy(&l_off, (tree_ptr + 2), sizeof(int));
-				memcpy(&r_off, (tree_ptr + 3), sizeof(int));
-				buffer_ptr[3] = 0.0f;
-				buffer_ptr[4] = 1.0f;
-				buffer_ptr[5] = 0.0f;
+				int64_t l_off = read_index(tree_ptr + 1 + Header.index_words, Header.index_words);
+				int64_t r_off = read_index(tree_ptr + 1 + 2 * Header.index_words, Header.index_words);
+				load_color(buffer_ptr, point_offset);
 				buffer_ptr += 6;
 
 				buffer_ptr = load_kdt((float*) Tree + l_off, buffer_ptr, depth + 1);
@@ -140,15 +159,12 @@ public:
 		else
 		{
 			// LEAF
-			int size, point_offset;
-			memcpy(&size, (tree_ptr + 1), sizeof(int));
-			for (int i = 0; i < size; i++)
+			int64_t size = read_index(tree_ptr + 1, Header.index_words);
+			for (int64_t i = 0; i < size; i++)
 			{
-				memcpy(&point_offset, (tree_ptr + 2 + (i)), sizeof(int));
+				int64_t point_offset = read_index(tree_ptr + 1 + Header.index_words * (1 + i), Header.index_words);
 				memcpy(buffer_ptr, (Data + point_offset), sizeof(float) * 3);
-				buffer_ptr[3] = 0.0f;
-				buffer_ptr[4] = 1.0f;
-				buffer_ptr[5] = 0.0f;
+				load_color(buffer_ptr, point_offset);
 				buffer_ptr += 6;
 			}
 		}
@@ -2,6 +2,7 @@
 #include "FPVConfig.h"
 #include "Camera.h"
 #include "Shader.h"
+#include "TreeFormat.h"
 
 #include <glad/glad.h>
 #include <GLFW/glfw3.h>
@@ -33,14 +34,17 @@ using namespace std;
 
 const float * datamap_ptr;
 const float * treemap_ptr;
+const unsigned char * colormap_ptr = nullptr;
 
 // CONFIGURATION
 string tree_file			= ROOT_DIR + string("res/models/lucy_SPHERE_B20.bin");
 string data_file			= ROOT_DIR + string("res/models/lucy_DATA.bin");
+string color_file			= ROOT_DIR + string("res/models/lucy_RGB.bin");
 string vertex_shader_file	= ROOT_DIR + string("res/shaders/4.3.shader.vs");
 string fragment_shader_file = ROOT_DIR + string("res/shaders/4.3.shader.fs");
 const char* tree_filepath   = &tree_file[0];
 const char* data_filepath   = &data_file[0];
+const char* color_filepath  = &color_file[0];
 const char* vertex_shader   = &vertex_shader_file[0];
 const char* fragment_shader = &fragment_shader_file[0];
 
@@ -66,8 +70,10 @@ enum State { NORMAL, LOCKED, BENCHMARK };
 enum BVType { SPHERE, AABB };
 int state = NORMAL;
 int max_depth;
-int num_elements;
+int64_t num_elements;
 int bvtype;
+int index_words;  // floats per index, offset or count in the tree file
+int header_words; // floats before the root node
 
 // debugging values and time
 int nbOviewPoints = 0;
@@ -177,20 +183,34 @@ void mouse_callback(GLFWwindow* window, double xpos, double ypos)
 	}
 }
 
+// write the color of the point at point_offset behind its position
+// points are drawn green if the dataset comes without colors
+inline void load_color(float* buffer_ptr, int64_t point_offset) {
+	if (colormap_ptr != nullptr) {
+		// one uchar per channel, so the point offset is also the color offset
+		buffer_ptr[3] = colormap_ptr[point_offset] / 255.0f;
+		buffer_ptr[4] = colormap_ptr[point_offset + 1] / 255.0f;
+		buffer_ptr[5] = colormap_ptr[point_offset + 2] / 255.0f;
+	}
+	else {
+		buffer_ptr[3] = 0.0f;
+		buffer_ptr[4] = 1.0f;
+		buffer_ptr[5] = 0.0f;
+	}
+}
+
 float* load_oview(float* tree_ptr, float * buffer_ptr, int height) {
 
 	{ // Load point into buffer
-		int point_offset; // is point index times three
-		memcpy(&point_offset, (tree_ptr + 1), sizeof(int));
+		int64_t point_offset = read_index(tree_ptr + 1, index_words); // is point index times three
 		memcpy(buffer_ptr, (datamap_ptr + point_offset), sizeof(float) * 3);
 		buffer_ptr += 3;
 	}
 
 	// travel down the tree
 	if (height > 0) {
-		int l_off, r_off;
-		memcpy(&l_off, (tree_ptr + 2), sizeof(int));
-		memcpy(&r_off, (tree_ptr + 3), sizeof(int));
+		int64_t l_off = read_index(tree_ptr + 1 + index_words, index_words);
+		int64_t r_off = read_index(tree_ptr + 1 + 2 * index_words, index_words);
 		buffer_ptr = load_oview((float*)(treemap_ptr + l_off), buffer_ptr, height - 1);
 		buffer_ptr = load_oview((float*)(treemap_ptr + r_off), buffer_ptr, height - 1);
 	}
@@ -208,10 +228,10 @@ float* read_kdtree(float* tree_ptr, float * buffer_ptr, int depth) {
 		// NODE
 
 		// read node point (sphere center) (same as in oview function)
+		int64_t point_offset;
 		{
 			// load point into buffer
-			int point_offset;
-			memcpy(&point_offset, (tree_ptr + 1), sizeof(int));
+			point_offset = read_index(tree_ptr + 1, index_words);
 			memcpy(buffer_ptr, (datamap_ptr + point_offset), sizeof(float) * 3);
 		}
 		glm::vec3 point_scaled = transformation_matrix * glm::vec4(buffer_ptr[0], buffer_ptr[1], buffer_ptr[2], 1.0f);
@@ -253,12 +273,9 @@ float* read_kdtree(float* tree_ptr, float * buffer_ptr, int depth) {
 		if (depth < max_depth)
 		{
 			// progress further into recursion
-			int l_off, r_off;
-			memcpy(&l_off, (tree_ptr + 2), sizeof(int));
-			memcpy(&r_off, (tree_ptr + 3), sizeof(int));
-			buffer_ptr[3] = 0.0f;
-			buffer_ptr[4] = 1.0f;
-			buffer_ptr[5] = 0.0f;
+			int64_t l_off = read_index(tree_ptr + 1 + index_words, index_words);
+			int64_t r_off = read_index(tree_ptr + 1 + 2 * index_words, index_words);
+			load_color(buffer_ptr, point_offset);
 			buffer_ptr += 6;
 
 			buffer_ptr = read_kdtree((float*)treemap_ptr + l_off, buffer_ptr, depth + 1);
@@ -269,15 +286,12 @@ float* read_kdtree(float* tree_ptr, float * buffer_ptr, int depth) {
 	else
 	{
 		// LEAF
-		int size, point_offset;
-		memcpy(&size, (tree_ptr + 1), sizeof(int));
-		for (int i = 0; i < size; i++)
+		int64_t size = read_index(tree_ptr + 1, index_words);
+		for (int64_t i = 0; i < size; i++)
 		{
-			memcpy(&point_offset, (tree_ptr + 2 + (i)), sizeof(int));
+			int64_t point_offset = read_index(tree_ptr + 1 + index_words * (1 + i), index_words);
 			memcpy(buffer_ptr, (datamap_ptr + point_offset), sizeof(float) * 3);
-			buffer_ptr[3] = 0.0f;
-			buffer_ptr[4] = 1.0f;
-			buffer_ptr[5] = 0.0f;
+			load_color(buffer_ptr, point_offset);
 			buffer_ptr += 6;
 		}
 	}
@@ -298,7 +312,7 @@ void treeWorker() {
 			// fill front buffer
 			fnt_buffer_mtx.lock();
 			start_time = glfwGetTime();
-			ptr = read_kdtree((float *)treemap_ptr + 3, ptr, 0);
+			ptr = read_kdtree((float *)treemap_ptr + header_words, ptr, 0);
 			nbLoadPoints = (ptr - ptr_fnt) / 6;
 			ptr = (float*)ptr_bck;
 			buffertime = glfwGetTime() - start_time;
@@ -309,7 +323,7 @@ void treeWorker() {
 			// fill back buffer
 			bck_buffer_mtx.lock();
 			start_time = glfwGetTime();
-			ptr = read_kdtree((float *)treemap_ptr + 3, ptr, 0);
+			ptr = read_kdtree((float *)treemap_ptr + header_words, ptr, 0);
 			nbLoadPoints = (ptr - ptr_bck) / 6;
 			ptr = (float*)ptr_fnt;
 			buffertime = glfwGetTime() - start_time;
@@ -367,9 +381,21 @@ int main() {
 	treemap_ptr = static_cast<const float*>(tree_region.get_address());
 	datamap_ptr = static_cast<const float*>(data_region.get_address());
 
-	memcpy(&max_depth, treemap_ptr, sizeof(int));
-	memcpy(&num_elements, treemap_ptr + 1, sizeof(int));
-	memcpy(&bvtype, treemap_ptr + 2, sizeof(int));
+	// point colors are optional and only mapped if the file exists
+	boost::interprocess::mapped_region color_region;
+	if (ifstream(color_filepath).good()) {
+		boost::interprocess::file_mapping color_filemap(color_filepath, boost::interprocess::read_only);
+		boost::interprocess::mapped_region(color_filemap, boost::interprocess::read_only).swap(color_region);
+		colormap_ptr = static_cast<const unsigned char*>(color_region.get_address());
+	}
+
+	// versioned or legacy tree file header
+	TreeHeader tree_header = read_tree_header(treemap_ptr);
+	max_depth	 = tree_header.max_depth;
+	num_elements = tree_header.num_elements;
+	bvtype		 = tree_header.bvtype;
+	index_words	 = tree_header.index_words;
+	header_words = tree_header.header_words;
 
 	// generate array/vertex/element buffer objects
 	glGenVertexArrays(5, VAOs);
@@ -380,7 +406,7 @@ int main() {
 	{
 		//int tree_level = log2 (SCR_WIDTH*SCR_HEIGHT);
 		int tree_level = 14; // manually set to 14
-		float * points_end = load_oview((float*) treemap_ptr + 3, oviewPoints, tree_level-1);
+		float * points_end = load_oview((float*) treemap_ptr + header_words, oviewPoints, tree_level-1);
 		nbOviewPoints = (points_end - oviewPoints) / 3;
 		glBindVertexArray(VAOs[0]);
 		glBindBuffer(GL_ARRAY_BUFFER, VBOs[0]);
@@ -0,0 +1,72 @@
+#pragma once
+
+#include <cstring>
+#include <cstdint>
+
+// Header of the kd-tree file written by build_tree.py. Versioned files
+// start with the magic number "FPVK", the format version, the width of
+// indices, offsets and counts in bytes and the number of elements,
+// followed by the tree depth and the type of bounding volume. Legacy
+// files start with depth, number of elements and type of bounding volume
+// as 32 bit values and store all indices with 32 bit.
+struct TreeHeader
+{
+	int version;		// 0 for legacy files
+	int index_words;	// floats per index, offset or count (1 or 2)
+	int header_words;	// floats before the root node
+	int64_t num_elements;
+	int max_depth;
+	int bvtype;
+};
+
+const char TREE_MAGIC[4] = { 'F', 'P', 'V', 'K' };
+const int TREE_HEADER_WORDS = 6;
+const int LEGACY_TREE_HEADER_WORDS = 3;
+
+// indices, offsets and counts are stored as unsigned integers of one or
+// two floats width, offsets count in floats from the start of the file
+inline int64_t read_index(const float* ptr, int index_words)
+{
+	if (index_words == 1) {
+		uint32_t value;
+		memcpy(&value, ptr, sizeof(uint32_t));
+		return value;
+	}
+	uint64_t value;
+	memcpy(&value, ptr, sizeof(uint64_t));
+	return (int64_t) value;
+}
+
+inline TreeHeader read_tree_header(const float* tree)
+{
+	TreeHeader header;
+	if (memcmp(tree, TREE_MAGIC, sizeof(TREE_MAGIC)) == 0) {
+		uint16_t version, width;
+		uint64_t count;
+		uint32_t depth, bvtype;
+		memcpy(&version, (const char*) tree + 4, sizeof(uint16_t));
+		memcpy(&width, (const char*) tree + 6, sizeof(uint16_t));
+		memcpy(&count, tree + 2, sizeof(uint64_t));
+		memcpy(&depth, tree + 4, sizeof(uint32_t));
+		memcpy(&bvtype, tree + 5, sizeof(uint32_t));
+		header.version		= version;
+		header.index_words	= width / sizeof(float);
+		header.header_words = TREE_HEADER_WORDS;
+		header.num_elements = (int64_t) count;
+		header.max_depth	= depth;
+		header.bvtype		= bvtype;
+	}
+	else {
+		uint32_t depth, count, bvtype;
+		memcpy(&depth, tree, sizeof(uint32_t));
+		memcpy(&count, tree + 1, sizeof(uint32_t));
+		memcpy(&bvtype, tree + 2, sizeof(uint32_t));
+		header.version		= 0;
+		header.index_words	= 1;
+		header.header_words = LEGACY_TREE_HEADER_WORDS;
+		header.num_elements = count;
+		header.max_depth	= depth;
+		header.bvtype		= bvtype;
+	}
+	return header;
+}